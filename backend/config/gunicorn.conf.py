@@ -0,0 +1,32 @@
+"""
+Gunicorn config for serving the backend over ASGI in production.
+
+    gunicorn config.asgi:application -c config/gunicorn.conf.py
+
+Each worker is a uvicorn event loop, so it can hold hundreds of concurrent lightweight
+requests (taxonomy, feature search, scatter) while correlations run in its bounded
+CORRELATION_WORKERS thread pool. All settings can be overridden from the environment.
+"""
+from os import getenv
+
+bind = getenv('BIND', '0.0.0.0:8000')
+
+# Worker processes; each one serves many concurrent requests on its event loop. Each
+# worker keeps its own /metrics registry, which restarts from zero when it is recycled
+workers = int(getenv('WEB_CONCURRENCY', 2))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Maximum number of simultaneous connections per worker
+worker_connections = int(getenv('WORKER_CONNECTIONS', 1000))
+
+# Large correlations can take a while, so allow longer than the 30s default
+timeout = int(getenv('WORKER_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(getenv('MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+accesslog = '-'
+errorlog = '-'
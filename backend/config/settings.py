@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'database.middleware.TimingMiddleware',
+    'database.middleware.DatabaseRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -79,6 +81,52 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+ASGI_APPLICATION = 'config.asgi.application'
+
+# Directory of the memory-mapped feature matrix snapshot (see `manage.py build_matrix_snapshot`).
+# When a snapshot exists, feature values are read from it instead of the database.
+MATRIX_SNAPSHOT_DIR = Path(getenv('MATRIX_SNAPSHOT_DIR', BASE_DIR / 'snapshots'))
+
+# Write snapshots with float32 values and ranks (see database/utils/compact.py)
+MATRIX_SNAPSHOT_COMPACT = getenv('MATRIX_SNAPSHOT_COMPACT', 'false').lower() == 'true'
+
+# Directory of the on-disk archive of correlation results (see database/archive.py), which keeps
+# results beyond CACHE_DURATION and across restarts so past queries can be recalled without recomputing.
+# The archive holds at most RESULT_ARCHIVE_MAX_MB of results, evicting the least recently used; 0 disables it.
+RESULT_ARCHIVE_DIR = Path(getenv('RESULT_ARCHIVE_DIR', BASE_DIR / 'result_archive'))
+RESULT_ARCHIVE_MAX_MB = int(getenv('RESULT_ARCHIVE_MAX_MB', 1024))
+
+# Largest number of feature pairs a single correlation matrix request may compute
+MATRIX_MAX_CELLS = int(getenv('MATRIX_MAX_CELLS', 5_000_000))
+
+# Permutation p-values: largest number of permutations a request may ask for, and time
+# budget (in seconds) per request
+PERMUTATION_MAX = int(getenv('PERMUTATION_MAX', 10000))
+PERMUTATION_TIME_BUDGET = float(getenv('PERMUTATION_TIME_BUDGET', 5))
+
+# Bootstrap confidence intervals: largest number of resamples a request may ask for,
+# confidence level, and memory cap (in MB) for the resampled arrays
+BOOTSTRAP_MAX = int(getenv('BOOTSTRAP_MAX', 5000))
+BOOTSTRAP_CONFIDENCE = float(getenv('BOOTSTRAP_CONFIDENCE', 0.95))
+BOOTSTRAP_MEMORY_CAP_MB = int(getenv('BOOTSTRAP_MEMORY_CAP_MB', 256))
+
+# Random seed for permutations and bootstrap resamples, so that results are reproducible
+RESAMPLING_SEED = int(getenv('RESAMPLING_SEED', 0))
+
+# Number of correlations computed concurrently per process (see database/utils/executor.py)
+CORRELATION_WORKERS = int(getenv('CORRELATION_WORKERS', 2))
+
+# Admission control for correlation work (see database/utils/admission.py). Costs are in
+# relative units of about one cell line of one pairwise test: requests up to
+# ADMISSION_CHEAP_COST run immediately, more expensive ones wait in a lane that runs
+# ADMISSION_EXPENSIVE_WORKERS at a time per process, with at most ADMISSION_QUEUE_SIZE
+# waiting for up to ADMISSION_QUEUE_TIMEOUT seconds. Requests over ADMISSION_MAX_COST are rejected
+ADMISSION_CHEAP_COST = float(getenv('ADMISSION_CHEAP_COST', 25_000))
+ADMISSION_MAX_COST = float(getenv('ADMISSION_MAX_COST', 50_000_000))
+ADMISSION_EXPENSIVE_WORKERS = int(getenv('ADMISSION_EXPENSIVE_WORKERS', 1))
+ADMISSION_QUEUE_SIZE = int(getenv('ADMISSION_QUEUE_SIZE', 8))
+ADMISSION_QUEUE_TIMEOUT = float(getenv('ADMISSION_QUEUE_TIMEOUT', 30))
+
 # Cache with redis if installed; otherwise cache with local memory
 if getenv('CACHE_BACKEND', 'locmem') == 'redis':
     print('Caching with Redis')
@@ -100,6 +148,13 @@ else:
         }
     }
 
+# Identical concurrent correlation requests are computed once: the others wait up to
+# SINGLEFLIGHT_WAIT seconds for the result, then compute it themselves. With Redis the wait
+# also spans processes, through a lock that expires after SINGLEFLIGHT_LOCK_TTL seconds
+# in case the process holding it dies
+SINGLEFLIGHT_WAIT = float(getenv('SINGLEFLIGHT_WAIT', 60))
+SINGLEFLIGHT_LOCK_TTL = int(getenv('SINGLEFLIGHT_LOCK_TTL', 300))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -121,6 +176,56 @@ DATABASES = {
     }
 }
 
+# Read replicas (see database/routers.py): read-only API requests read from one of
+# DB_REPLICA_HOSTS (comma-separated host or host:port, with the database name and credentials
+# of the primary), picked at random per request. Writes and management commands use the primary
+DATABASE_REPLICAS = []
+for i, replica in enumerate(filter(None, getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    host, _, port = replica.strip().partition(':')
+    DATABASES[f'replica{i}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{i}')
+
+DATABASE_ROUTERS = ['database.routers.ReplicaRouter']
+
+# Statement timeouts (in seconds) of the queries of API requests, so runaway scans are cancelled:
+# DB_SCAN_STATEMENT_TIMEOUT for the endpoints that scan value tables (correlations, matrices,
+# exports), DB_STATEMENT_TIMEOUT for the others. 0 disables the timeout
+DB_STATEMENT_TIMEOUT = float(getenv('DB_STATEMENT_TIMEOUT', 10))
+DB_SCAN_STATEMENT_TIMEOUT = float(getenv('DB_SCAN_STATEMENT_TIMEOUT', 60))
+
+# Connection reuse, to avoid paying a TCP+TLS handshake on every request:
+# - 'none': open a new connection for every request (Django's default)
+# - 'persistent': keep each thread's connection open for DB_CONN_MAX_AGE seconds,
+#   checking it is still usable before reusing it
+# - 'pool': share a psycopg 3 connection pool between all threads of a process
+DB_POOL_MODE = getenv('DB_POOL_MODE', 'none')
+
+if DB_POOL_MODE == 'persistent':
+    for database in DATABASES.values():
+        database['CONN_MAX_AGE'] = int(getenv('DB_CONN_MAX_AGE', 600))
+        database['CONN_HEALTH_CHECKS'] = True
+elif DB_POOL_MODE == 'pool':
+    from psycopg_pool import ConnectionPool
+
+    # One pool per database (primary and each replica)
+    for database in DATABASES.values():
+        database['OPTIONS']['pool'] = {
+            'min_size': int(getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(getenv('DB_POOL_MAX_SIZE', 10)),
+            # Seconds to wait for a free connection before failing the request
+            'timeout': float(getenv('DB_POOL_TIMEOUT', 10)),
+            # Close idle connections above min_size after this many seconds
+            'max_idle': float(getenv('DB_POOL_MAX_IDLE', 300)),
+            # Check connections are alive before handing them out
+            'check': ConnectionPool.check_connection,
+        }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -163,11 +268,33 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Structured request timing logs (see database/middleware.py)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'database': {
+            'handlers': ['console'],
+            'level': getenv('LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
 # CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
 ]
 
+# Let the browser read per-stage timings from cross-origin responses
+CORS_EXPOSE_HEADERS = [
+    'Server-Timing',
+]
+
 CORS_ALLOW_METHODS = [
     'GET',
     'POST',
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Feature, Nuclear, Molecular, DrugScreen, Correlation
+from .models import Feature, Nuclear, Molecular, DrugScreen, Correlation, FeatureStats, ArchivedResult, FeatureNeighbor
 
 # Register your models here.
 admin.site.register(Feature)
@@ -7,3 +7,6 @@ admin.site.register(Nuclear)
 admin.site.register(Molecular)
 admin.site.register(DrugScreen)
 admin.site.register(Correlation)
+admin.site.register(FeatureStats)
+admin.site.register(ArchivedResult)
+admin.site.register(FeatureNeighbor)
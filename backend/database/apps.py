@@ -1,5 +1,22 @@
-# from django.apps import AppConfig
+from django.apps import AppConfig
+from django.db import connections
+from django.db.backends.signals import connection_created
 
-# class DataConfig(AppConfig):
-#     default_auto_field = 'django.db.models.BigAutoField'
-#     name = 'data'
+
+class DatabaseConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'database'
+
+    def ready(self):
+        from . import routers
+        from .utils import dbstats, timing
+
+        receivers = [timing.install_query_wrapper, dbstats.count_connection, routers.install_statement_timeout]
+        for receiver in receivers:
+            connection_created.connect(receiver)
+
+        # Connections opened before the app was ready (e.g. by other apps' ready()) missed the signal
+        for connection in connections.all(initialized_only=True):
+            if connection.connection is not None:
+                for receiver in receivers:
+                    receiver(sender=connection.__class__, connection=connection)
@@ -0,0 +1,188 @@
+"""
+Durable archive of correlation results.
+
+Results are only kept in the cache for CACHE_DURATION (and, with the local memory cache,
+only until the worker restarts). The archive also writes each result to a compressed
+columnar file under RESULT_ARCHIVE_DIR (see `utils.resultfile`), indexed by the
+`ArchivedResult` table, so replaying a past query reloads its result instead of recomputing it.
+
+Entries are keyed by the normalized request (its cache key) and the version of the data it
+was computed from, a hash of the value hashes and metadata of the requested features, so an
+entry is only reused while none of its features changed. Features without statistics are
+hashed from their values instead. The archive holds at most
+RESULT_ARCHIVE_MAX_MB of files and evicts the least recently used entries beyond that.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from . import routers
+from .models import CATEGORY_MODELS, ArchivedResult, Feature, FeatureStats
+from .utils.constants import CELL_LINES
+from .utils.ingest import value_hashes
+from .utils.resultfile import read_results, write_results
+
+# Index entries deleted per query when evicting
+EVICT_BATCH = 100
+
+# Default and largest number of queries listed by the history endpoint
+HISTORY_LENGTH = 20
+HISTORY_MAX_LENGTH = 100
+
+
+def enabled() -> bool:
+    return settings.RESULT_ARCHIVE_MAX_MB > 0
+
+
+def _root() -> Path:
+    return Path(settings.RESULT_ARCHIVE_DIR)
+
+
+def _version_rows(wanted: set) -> list:
+    """
+    (feature, database, value hash, data type, sub_category) of each existing (feature, database)
+    pair of `wanted`. The value hash is the one stored in `FeatureStats` or, for features without
+    one (e.g. loaded without refreshing their statistics), computed from the value table, and
+    empty if the table holds no values for the feature.
+    """
+    rows = FeatureStats.objects.filter(feature__in={name for name, _ in wanted}, database__in={db for _, db in wanted}) \
+        .exclude(value_hash="") \
+        .values_list("feature", "database", "value_hash", "feature__data_type", "feature__sub_category")
+    rows = [row for row in rows if row[:2] in wanted]
+
+    missing = wanted - {row[:2] for row in rows}
+    for db in sorted({db for _, db in missing}):
+        names = [name for name, other in missing if other == db]
+        values = {row[0]: row[1:] for row in CATEGORY_MODELS[db].objects.filter(feature__in=names)
+                  .values_list("feature", *CELL_LINES)}
+        for name, data_type, sub_category in Feature.objects.filter(name__in=names) \
+                .values_list("name", "data_type", "sub_category"):
+            value_hash = value_hashes([values[name]])[0] if name in values else ""
+            rows.append((name, db, value_hash, data_type, sub_category))
+    return sorted(set(rows))
+
+
+def data_version(params: dict):
+    """
+    Version of the data read by a parsed correlation request, which changes whenever the
+    values or metadata of one of its features (or covariates) change. None if the archive is disabled.
+    """
+    if not enabled():
+        return None
+
+    wanted = {(params["feature1"], db) for db in params["database1"]}
+    wanted.update((name, db) for name in params["feature2"] for db in params["database2"])
+    if params.get("covariates"):
+        # Covariates are read from the table of their category, whatever the request's databases
+        wanted.update(Feature.objects.filter(name__in=params["covariates"]).values_list("name", "category"))
+    return hashlib.md5(json.dumps(_version_rows(wanted)).encode()).hexdigest()
+
+
+def history_query(data, params: dict) -> dict:
+    """
+    Query to list in the history: the normalized request, with the other fields the client
+    sent (e.g. the state of its form) so it can be restored as it was submitted.
+    """
+    extra = {key: value for key, value in data.items() if key not in params} if isinstance(data, dict) else {}
+    return {**extra, **params}
+
+
+def load(request_key: str, version):
+    """Archived result of request `request_key` computed from data `version`, or None."""
+    if version is None:
+        return None
+
+    entry = ArchivedResult.objects.filter(request_key=request_key, data_version=version).first()
+    if entry is None:
+        return None
+    try:
+        results = read_results(_root() / entry.path)
+    except OSError:
+        # The file was removed behind our back
+        entry.delete()
+        return None
+
+    ArchivedResult.objects.filter(pk=entry.pk).update(last_accessed=timezone.now(), hits=F("hits") + 1)
+    return results
+
+
+def save(request_key: str, version, query: dict, results: dict):
+    """Archive `results` of request `request_key`, computed from data `version`."""
+    if version is None:
+        return
+
+    root = _root()
+    root.mkdir(parents=True, exist_ok=True)
+    path = hashlib.md5(f"{request_key}-{version}".encode()).hexdigest() + ".parquet"
+    size = write_results(root / path, results)
+
+    try:
+        ArchivedResult.objects.update_or_create(
+            request_key=request_key, data_version=version,
+            defaults={"query": query, "path": path, "size": size, "last_accessed": timezone.now()})
+    except IntegrityError:
+        # Another process archived the same result (to the same file) at the same time
+        pass
+
+    # Results of the same request computed from older data won't be looked up again
+    # (read from the primary, where the entry was just written)
+    with routers.use_primary():
+        _delete(ArchivedResult.objects.filter(request_key=request_key).exclude(data_version=version))
+        evict(settings.RESULT_ARCHIVE_MAX_MB * 2 ** 20)
+
+
+def _delete(queryset) -> int:
+    entries = list(queryset.values_list("pk", "path"))
+    for _, path in entries:
+        (_root() / path).unlink(missing_ok=True)
+    ArchivedResult.objects.filter(pk__in=[pk for pk, _ in entries]).delete()
+    return len(entries)
+
+
+def evict(max_bytes: int) -> int:
+    """
+    Delete the least recently used entries until the archive holds at most `max_bytes`.
+
+    :returns: number of entries deleted
+    """
+    excess = (ArchivedResult.objects.aggregate(total=Sum("size"))["total"] or 0) - max_bytes
+    deleted = 0
+    while excess > 0:
+        batch = list(ArchivedResult.objects.order_by("last_accessed").values_list("pk", "size")[:EVICT_BATCH])
+        if not batch:
+            break
+        victims = []
+        for pk, size in batch:
+            if excess <= 0:
+                break
+            victims.append(pk)
+            excess -= size
+        deleted += _delete(ArchivedResult.objects.filter(pk__in=victims))
+    return deleted
+
+
+def history(limit: int) -> list:
+    """Queries of the `limit` most recently computed or recalled results, most recent first."""
+    entries = ArchivedResult.objects.order_by("-last_accessed").values_list("query", "last_accessed")[:limit]
+    return [{**query, "last_run": last_accessed.isoformat()} for query, last_accessed in entries]
+
+
+async def adata_version(params: dict):
+    """Async version of `data_version`."""
+    return await sync_to_async(data_version)(params)
+
+
+async def aload(request_key: str, version):
+    """Async version of `load`."""
+    return await sync_to_async(load)(request_key, version)
+
+
+async def asave(request_key: str, version, query: dict, results: dict):
+    """Async version of `save`."""
+    await sync_to_async(save)(request_key, version, query, results)
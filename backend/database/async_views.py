@@ -0,0 +1,440 @@
+"""
+Async versions of the read endpoints, served under /api/async/ when running on ASGI.
+
+Database access uses Django's async ORM, and CPU-bound correlation work is handed to
+a bounded thread pool, so cheap requests (taxonomy, feature search, scatter) keep being
+served while heavy correlations are running.
+"""
+import asyncio
+import json
+import traceback
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from . import archive, dataset, planner, routers, store
+from .models import Feature, CATEGORY_MODELS
+from .utils import admission, cancellation, correlations, invalidation, metrics, singleflight, streaming, timing
+from .utils.constants import CACHE_DURATION, CELL_LINES
+from .utils.executor import run_cpu_bound
+from .utils.params import parse_correlation_request, correlation_cache_key, parse_cell_lines
+
+
+def _error(message, status, headers=None):
+    return JsonResponse({"error": message}, status=status, headers=headers)
+
+
+def _parse_body(request) -> dict:
+    try:
+        data = json.loads(request.body or b"{}")
+    except json.JSONDecodeError:
+        raise ValueError("Request body must be valid JSON.")
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object.")
+    return data
+
+
+@require_GET
+async def categories(request):
+    """Async version of /api/features/categories/."""
+    qs = Feature.objects.values_list('category', flat=True).distinct()
+    return JsonResponse({'categories': [c async for c in qs]})
+
+
+@require_GET
+async def subcategories(request):
+    """Async version of /api/features/subcategories/."""
+    categories = request.GET.getlist('categories')
+    if not categories:
+        return _error('Categories parameter is required', 400)
+
+    qs = Feature.objects.filter(category__in=categories)\
+        .values_list('sub_category', flat=True)\
+        .distinct()
+    return JsonResponse({'subcategories': [s async for s in qs]})
+
+
+@require_GET
+async def feature_search(request):
+    """
+    Async version of /api/features/ with the same `databaseList` and `subCategoryList`
+    filters, plus an optional case-insensitive `search` on the feature name.
+    """
+    qs = Feature.objects.all()
+
+    database_list = request.GET.getlist('databaseList')
+    sub_category_list = request.GET.getlist('subCategoryList')
+    search = request.GET.get('search')
+
+    if database_list:
+        qs = qs.filter(category__in=database_list)
+    if sub_category_list:
+        qs = qs.filter(sub_category__in=sub_category_list)
+    if search:
+        qs = qs.filter(name__icontains=search)
+
+    features = [f async for f in qs.values('name', 'data_type', 'category', 'sub_category')]
+    return JsonResponse(features, safe=False)
+
+
+@require_GET
+@routers.read_only("scan")
+async def export(request):
+    """
+    Async version of /api/export/. The file is sent one chunk of rows at a time, which
+    the synchronous endpoint can't do under ASGI.
+    """
+    category = request.GET.get("category")
+    if category not in CATEGORY_MODELS:
+        return _error(f"category must be one of {list(CATEGORY_MODELS)}.", 400)
+
+    file_format = request.GET.get("file_format", "csv")
+    if file_format not in dataset.STREAM_FORMATS:
+        return _error(f"file_format must be one of {list(dataset.STREAM_FORMATS)}.", 400)
+
+    try:
+        cell_lines = parse_cell_lines({"cell_lines": request.GET.getlist("cell_lines")})
+    except ValueError as e:
+        return _error(str(e), 400)
+
+    response = StreamingHttpResponse(
+        dataset.astream_values(
+            category,
+            sub_categories=request.GET.getlist("sub_category"),
+            features=request.GET.getlist("features"),
+            cell_lines=cell_lines,
+            file_format=file_format),
+        content_type="text/csv" if file_format == "csv" else "application/vnd.apache.parquet")
+    filename = category.lower().replace(" ", "_") + "." + file_format
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@csrf_exempt
+@require_POST
+@routers.read_only("lookup")
+async def scatter(request):
+    """Async version of /api/scatter/."""
+    try:
+        try:
+            data = _parse_body(request)
+        except ValueError as e:
+            return _error(str(e), 400)
+
+        f1_name = data.get("feature1")
+        f2_name = data.get("feature2")
+
+        # Ensure input features are provided
+        if not f1_name:
+            return _error("Feature 1 is required.", 400)
+        if not f2_name:
+            return _error("Feature 2 is required.", 400)
+
+        try:
+            cell_lines = parse_cell_lines(data)
+        except ValueError as e:
+            return _error(str(e), 400)
+
+        with timing.stage("lookup"):
+            try:
+                feature1 = await Feature.objects.aget(name=f1_name)
+            except Feature.DoesNotExist:
+                return _error(f"Feature '{f1_name}' not found.", 404)
+
+            try:
+                feature2 = await Feature.objects.aget(name=f2_name)
+            except Feature.DoesNotExist:
+                return _error(f"Feature '{f2_name}' not found.", 404)
+
+        # Each feature is read from the table of its category, whatever database1/database2 say
+        f1_df = await store.afetch_values(feature1.category, [feature1.name], cell_lines) \
+            if feature1.category in CATEGORY_MODELS else None
+        f2_df = await store.afetch_values(feature2.category, [feature2.name], cell_lines) \
+            if feature2.category in CATEGORY_MODELS else None
+        if f1_df is None or f1_df.empty or f2_df is None or f2_df.empty:
+            return _error("No cell line data found for the specified features.", 404)
+
+        scatter_data = correlations.build_scatter_records(
+            f1_df, f2_df, f1_name, f2_name, cell_lines=cell_lines)
+
+        return JsonResponse({
+            "scatter_data": scatter_data,
+            "feature1_type": feature1.data_type,
+            "feature2_type": feature2.data_type,
+        })
+
+    except Exception as e:
+        print("Error:", traceback.format_exc())
+        return JsonResponse({"Error": str(e)}, status=500)
+
+
+def _compute_correlations(f1_rows, f2_rows, feature_to_subcategory, feature_to_datatype,
+                          permutations=0, bootstrap=0, cell_lines=None, covariates=None) -> dict:
+    """CPU-bound part of a correlation request. Runs in the correlation pool."""
+    f1_df = correlations.build_feature_frame(
+        f1_rows, feature_to_subcategory, feature_to_datatype, cell_lines=cell_lines)
+    f2_df = correlations.build_feature_frame(
+        f2_rows, feature_to_subcategory, feature_to_datatype, cell_lines=cell_lines)
+
+    with timing.stage("compute"):
+        results_df_dict = correlations.calculate_correlations(
+            f1_df, f2_df, permutations=permutations,
+            seed=settings.RESAMPLING_SEED, time_budget=settings.PERMUTATION_TIME_BUDGET,
+            bootstrap=bootstrap, confidence=settings.BOOTSTRAP_CONFIDENCE,
+            bootstrap_max_bytes=settings.BOOTSTRAP_MEMORY_CAP_MB * 2 ** 20, covariates=covariates)
+
+    with timing.stage("serialize"):
+        return {
+            key: df.to_dict(orient="records")
+            for key, df in results_df_dict.items()
+        }
+
+
+async def _correlations(params: dict, cache_key: str, epoch: int, version, query: dict):
+    """Compute the correlations of a parsed request, cache them under `cache_key` and archive them."""
+    f1_name = params["feature1"]
+    f2_names = params["feature2"]
+
+    with timing.stage("lookup"):
+        try:
+            f1_object = await Feature.objects.aget(name=f1_name)
+        except Feature.DoesNotExist:
+            return _error(f"Feature '{f1_name}' not found.", 404)
+
+        f2_objects = [f async for f in Feature.objects.filter(name__in=f2_names)]
+    if not f2_objects:
+        return _error(f"None of the provided features in Feature 2 were found: {f2_names}.", 404)
+
+    # Values of the features to control for, for partial correlations
+    covariates = None
+    if params["covariates"]:
+        try:
+            covariates = await planner.afetch_covariates(params["covariates"], params["cell_lines"])
+        except ValueError as e:
+            return _error(str(e), 400)
+
+    # Expensive requests wait for a slot so they can't starve cheap ones
+    f2_read = [f for f in f2_objects if f.category in params["database2"]]
+    cost = admission.estimate_cost(
+        f1_object.data_type, [f.data_type for f in f2_read], len(params["cell_lines"] or CELL_LINES),
+        params["permutations"], params["bootstrap"])
+    async with admission.aadmit(cost):
+        # The query may have been superseded while waiting for a slot
+        await cancellation.acheck()
+
+        # Read each feature from its own table, skipping features that can't have any correlation
+        f1_rows = await planner.afetch_features([f1_object], params["database1"], params["cell_lines"])
+        f2_rows = {}
+        if any(len(rows) for rows in f1_rows.values()):
+            f2_rows = await planner.afetch_features(f2_objects, params["database2"], params["cell_lines"])
+
+        feature_to_subcategory = {f.name: f.sub_category for f in f2_objects}
+        feature_to_subcategory[f1_object.name] = f1_object.sub_category
+        feature_to_datatype = {f.name: f.data_type for f in f2_objects}
+        feature_to_datatype[f1_object.name] = f1_object.data_type
+
+        results_json = await run_cpu_bound(
+            _compute_correlations, f1_rows, f2_rows, feature_to_subcategory, feature_to_datatype,
+            params["permutations"], params["bootstrap"], params["cell_lines"], covariates)
+
+    await invalidation.aset_result(cache_key, results_json, epoch, timeout=CACHE_DURATION)
+    with timing.stage("archive"):
+        await archive.asave(cache_key, version, query, results_json)
+    return JsonResponse({"correlations": results_json})
+
+
+@csrf_exempt
+@require_POST
+@routers.read_only("scan")
+async def correlations_view(request):
+    """Async version of /api/correlations/."""
+    # Queries of the same session (browser tab) supersede each other, see `utils.cancellation`
+    session = request.GET.get("session")
+    token = None
+    try:
+        async with cancellation.aactive(session) as token:
+            try:
+                data = _parse_body(request)
+                params = parse_correlation_request(data)
+            except ValueError as e:
+                return _error(str(e), 400)
+
+            cache_key = correlation_cache_key(params)
+            feature_names = [params["feature1"], *params["feature2"], *params["covariates"]]
+
+            # Retrieve correlation from cache if possible (unless the features changed since)
+            with timing.stage("cache"):
+                cached_result = await invalidation.aget_result(cache_key, feature_names)
+            if cached_result is not None:
+                metrics.CACHE_REQUESTS.inc(cache="correlations", result="hit")
+                return JsonResponse({"correlations": cached_result})
+
+            # Identical requests in flight are computed once: wait for them and reuse their result
+            async with singleflight.ahold(cache_key):
+                with timing.stage("cache"):
+                    cached_result = await invalidation.aget_result(cache_key, feature_names)
+                if cached_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="coalesced")
+                    return JsonResponse({"correlations": cached_result})
+
+                # Reload the result from the archive if it was computed before from the same data
+                epoch = await invalidation.acurrent_epoch()
+                with timing.stage("archive"):
+                    version = await archive.adata_version(params)
+                    archived_result = await archive.aload(cache_key, version)
+                if archived_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="archived")
+                    await invalidation.aset_result(cache_key, archived_result, epoch, timeout=CACHE_DURATION)
+                    return JsonResponse({"correlations": archived_result})
+                metrics.CACHE_REQUESTS.inc(cache="correlations", result="miss")
+
+                return await _correlations(params, cache_key, epoch, version, archive.history_query(data, params))
+    except asyncio.CancelledError:
+        # The client disconnected: stop the computation still running in the pool
+        if token is not None:
+            token.cancel("disconnect")
+        raise
+    except admission.Rejected as e:
+        return _error(str(e), e.status_code, e.headers)
+    except cancellation.Cancelled as e:
+        return _error(str(e), cancellation.CANCELLED_STATUS)
+    except Exception as e:
+        print("Error:", traceback.format_exc())
+        return JsonResponse({"Error": str(e)}, status=500)
+
+
+def _correlation_stream(f1_rows, f2_rows, feature_to_subcategory, feature_to_datatype,
+                        permutations=0, bootstrap=0, cell_lines=None, covariates=None):
+    """`streaming.CorrelationStream` of the fetched rows. Runs in the correlation pool."""
+    return streaming.CorrelationStream(
+        correlations.build_feature_frame(f1_rows, feature_to_subcategory, feature_to_datatype, cell_lines=cell_lines),
+        correlations.build_feature_frame(f2_rows, feature_to_subcategory, feature_to_datatype, cell_lines=cell_lines),
+        permutations=permutations, seed=settings.RESAMPLING_SEED, time_budget=settings.PERMUTATION_TIME_BUDGET,
+        bootstrap=bootstrap, confidence=settings.BOOTSTRAP_CONFIDENCE,
+        bootstrap_max_bytes=settings.BOOTSTRAP_MEMORY_CAP_MB * 2 ** 20, covariates=covariates)
+
+
+async def _messages(*messages):
+    for message in messages:
+        yield message
+
+
+def _event_stream(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def _correlation_events(params: dict, cache_key: str, feature_names: list, f1_object, f2_objects: list,
+                              covariates, session, query: dict):
+    """Async version of `views.CorrelationStreamView.events`."""
+    token = None
+    try:
+        async with cancellation.aactive(session) as token:
+            async with singleflight.ahold(cache_key):
+                cached_result = await invalidation.aget_result(cache_key, feature_names)
+                if cached_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="coalesced")
+                    yield streaming.sse("result", {"correlations": cached_result})
+                    return
+
+                epoch = await invalidation.acurrent_epoch()
+                version = await archive.adata_version(params)
+                archived_result = await archive.aload(cache_key, version)
+                if archived_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="archived")
+                    await invalidation.aset_result(cache_key, archived_result, epoch, timeout=CACHE_DURATION)
+                    yield streaming.sse("result", {"correlations": archived_result})
+                    return
+                metrics.CACHE_REQUESTS.inc(cache="correlations", result="miss")
+
+                f2_read = [f for f in f2_objects if f.category in params["database2"]]
+                cost = admission.estimate_cost(
+                    f1_object.data_type, [f.data_type for f in f2_read], len(params["cell_lines"] or CELL_LINES),
+                    params["permutations"], params["bootstrap"])
+                async with admission.aadmit(cost):
+                    await cancellation.acheck()
+
+                    f1_rows = await planner.afetch_features([f1_object], params["database1"], params["cell_lines"])
+                    f2_rows = {}
+                    if any(len(rows) for rows in f1_rows.values()):
+                        f2_rows = await planner.afetch_features(f2_objects, params["database2"], params["cell_lines"])
+
+                    feature_to_subcategory = {f.name: f.sub_category for f in [f1_object, *f2_objects]}
+                    feature_to_datatype = {f.name: f.data_type for f in [f1_object, *f2_objects]}
+                    stream = await run_cpu_bound(
+                        _correlation_stream, f1_rows, f2_rows, feature_to_subcategory, feature_to_datatype,
+                        params["permutations"], params["bootstrap"], params["cell_lines"], covariates)
+
+                    for start, stop in stream.chunks():
+                        yield streaming.sse("batch", await run_cpu_bound(stream.run_chunk, start, stop))
+                    results_json = stream.results()
+
+                # Not when the permutation budget ran out mid-stream, see `utils.streaming`
+                if stream.complete:
+                    await invalidation.aset_result(cache_key, results_json, epoch, timeout=CACHE_DURATION)
+                    await archive.asave(cache_key, version, query, results_json)
+                yield streaming.sse("result", {"correlations": results_json})
+
+    except asyncio.CancelledError:
+        # The client disconnected: stop the chunk still running in the pool
+        if token is not None:
+            token.cancel("disconnect")
+        raise
+    except admission.Rejected as e:
+        yield streaming.sse("error", {"error": str(e), "status": e.status_code, "retry_after": e.retry_after})
+    except cancellation.Cancelled as e:
+        yield streaming.sse("error", {"error": str(e), "status": cancellation.CANCELLED_STATUS})
+    except Exception as e:
+        print("Error:", traceback.format_exc())
+        yield streaming.sse("error", {"Error": str(e), "status": 500})
+
+
+@csrf_exempt
+@require_POST
+@routers.read_only("scan")
+async def correlations_stream(request):
+    """Async version of /api/correlations/stream/."""
+    try:
+        try:
+            data = _parse_body(request)
+            params = parse_correlation_request(data)
+        except ValueError as e:
+            return _error(str(e), 400)
+
+        cache_key = correlation_cache_key(params)
+        feature_names = [params["feature1"], *params["feature2"], *params["covariates"]]
+
+        # Cached results are sent at once
+        with timing.stage("cache"):
+            cached_result = await invalidation.aget_result(cache_key, feature_names)
+        if cached_result is not None:
+            metrics.CACHE_REQUESTS.inc(cache="correlations", result="hit")
+            return _event_stream(_messages(streaming.sse("result", {"correlations": cached_result})))
+
+        with timing.stage("lookup"):
+            try:
+                f1_object = await Feature.objects.aget(name=params["feature1"])
+            except Feature.DoesNotExist:
+                return _error(f"Feature '{params['feature1']}' not found.", 404)
+            f2_objects = [f async for f in Feature.objects.filter(name__in=params["feature2"])]
+        if not f2_objects:
+            return _error(f"None of the provided features in Feature 2 were found: {params['feature2']}.", 404)
+
+        covariates = None
+        if params["covariates"]:
+            try:
+                covariates = await planner.afetch_covariates(params["covariates"], params["cell_lines"])
+            except ValueError as e:
+                return _error(str(e), 400)
+
+        return _event_stream(_correlation_events(
+            params, cache_key, feature_names, f1_object, f2_objects, covariates,
+            request.GET.get("session"), archive.history_query(data, params)))
+
+    except Exception as e:
+        print("Error:", traceback.format_exc())
+        return JsonResponse({"Error": str(e)}, status=500)
@@ -0,0 +1,405 @@
+"""
+Export and import of the whole dataset (features, value tables and precomputed
+correlations) as Parquet files, to bootstrap a new environment without replaying
+`loadfile`, and for offline analysis with pandas or DuckDB.
+
+Layout of a dataset directory (partitions use the Hive `key=value` convention, so
+`pd.read_parquet("<dir>/values")` or DuckDB's `read_parquet('<dir>/values/*/*.parquet',
+hive_partitioning=true)` read a whole table with the partition as a column):
+    manifest.json                               format, cell lines and the files and row count of each table
+    features/category=<category>/part-N.parquet name, data_type, sub_category
+    values/category=<category>/part-N.parquet   feature, *CELL_LINES (null = missing)
+    correlations/part-N.parquet                 id, feature1, feature2, count, spearman_corr, spearman_pvalue
+
+Rows are written in primary key order, one row group per `EXPORT_CHUNK_ROWS` rows,
+with min/max statistics on every column, so readers can skip row groups by feature name.
+
+`stream_values` also streams the values of one category (optionally restricted to some
+sub_categories, features and cell lines) as CSV or Parquet, for the export endpoint, and
+`astream_values` does the same for the async export endpoint.
+"""
+import csv
+import io
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from asgiref.sync import sync_to_async
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from .feature_stats import refresh_feature_stats
+from .models import CATEGORY_MODELS, Correlation, Feature, FeatureNeighbor, FeatureStats
+from .utils import invalidation, metrics
+from .utils.constants import CELL_LINES
+from .utils.ingest import METADATA_COLUMNS
+
+FORMAT_VERSION = 1
+
+# Rows fetched per query on export (and per row group), and per batch on import
+EXPORT_CHUNK_ROWS = 50000
+# Row groups written to a file before starting the next part
+ROW_GROUPS_PER_FILE = 20
+# Rows fetched per query when streaming, small enough for the first bytes to go out quickly
+STREAM_CHUNK_ROWS = 5000
+
+STREAM_FORMATS = ("csv", "parquet")
+
+ARROW_TYPES = {
+    "CharField": pa.string(),
+    "FloatField": pa.float64(),
+    "IntegerField": pa.int32(),
+    "AutoField": pa.int32(),
+    "BigAutoField": pa.int64(),
+}
+
+
+def _fields(model, exclude=()) -> list:
+    """Concrete fields of `model` stored in its table, in column order."""
+    return [f for f in model._meta.concrete_fields if f.name not in exclude]
+
+
+def _schema(fields) -> pa.Schema:
+    return pa.schema([
+        pa.field(f.name, ARROW_TYPES[(f.target_field if f.is_relation else f).get_internal_type()], nullable=f.null)
+        for f in fields
+    ])
+
+
+def _partition_dir(name: str, category=None) -> str:
+    return name if category is None else f"{name}/category={category}"
+
+
+def _partition_value(file: str):
+    """Value of the `category=` partition of a manifest file path, or None."""
+    for part in Path(file).parts:
+        if part.startswith("category="):
+            return part[len("category="):]
+    return None
+
+
+def _keyset_chunks(queryset, names, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    Yield the rows of `queryset` as lists of `values_list(*names)` tuples, in primary key
+    order. The first of `names` must be the primary key.
+
+    Rows are read by keyset pagination on the primary key rather than with a server-side
+    cursor, which a transaction pooler may not support (and DISABLE_SERVER_SIDE_CURSORS
+    turns off): each chunk is a separate short query, so no connection or transaction is
+    held between chunks.
+    """
+    queryset = queryset.order_by("pk")
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk.values_list(*names)[:chunk_rows])
+        if not chunk:
+            return
+        last = chunk[-1][0]
+        yield chunk
+
+
+def _write_table(queryset, fields, directory: Path) -> tuple:
+    """
+    Write the rows of `queryset` to `directory` as Parquet parts. The first of `fields`
+    must be the primary key.
+
+    :returns: (number of rows, list of files written)
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    schema = _schema(fields)
+
+    rows, files, writer, groups = 0, [], None, 0
+    try:
+        for chunk in _keyset_chunks(queryset, [f.name for f in fields]):
+            if writer is None or groups == ROW_GROUPS_PER_FILE:
+                if writer is not None:
+                    writer.close()
+                path = directory / f"part-{len(files)}.parquet"
+                writer = pq.ParquetWriter(path, schema, compression="zstd", write_statistics=True)
+                files.append(path)
+                groups = 0
+
+            columns = list(zip(*chunk))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            rows += len(chunk)
+            groups += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if not files:
+        # Keep empty tables readable
+        path = directory / "part-0.parquet"
+        pq.write_table(schema.empty_table(), path)
+        files.append(path)
+    return rows, files
+
+
+def _use_one_snapshot():
+    """
+    Make the rest of the current transaction read from a single snapshot of the database.
+    PostgreSQL's default READ COMMITTED level takes a new one for each statement, so a write
+    committed between two reads would be seen by the second only. SQLite transactions
+    already read from one snapshot.
+    """
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            # On the driver's cursor: it must be the first statement of the transaction, so it
+            # can't come after the statement timeout that `routers` may set before a query
+            cursor.cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+
+
+def export_dataset(path, log=print) -> dict:
+    """
+    Export the dataset to the directory `path`, replacing it if it exists.
+    The files are written to a temporary directory first, so an interrupted export
+    never leaves a partial dataset at `path`.
+
+    :param log: function called with a progress message for each partition
+    :returns: the manifest written
+    """
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.partial")
+    tmp.mkdir(parents=True)
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "cell_lines": CELL_LINES,
+        "tables": {name: {"rows": 0, "files": []} for name in ("features", "values", "correlations")},
+    }
+
+    def write(name, queryset, fields, category=None):
+        directory = _partition_dir(name, category)
+        rows, files = _write_table(queryset, fields, tmp / directory)
+        manifest["tables"][name]["rows"] += rows
+        manifest["tables"][name]["files"] += [str(f.relative_to(tmp)) for f in files]
+        log(f"{directory}: {rows} rows")
+
+    try:
+        # Read every table from one snapshot of the database, so they are consistent with each other
+        with transaction.atomic():
+            _use_one_snapshot()
+            feature_fields = _fields(Feature, exclude=["category"])
+            for category in Feature.objects.order_by("category").values_list("category", flat=True).distinct():
+                write("features", Feature.objects.filter(category=category), feature_fields, category)
+            for category, model in CATEGORY_MODELS.items():
+                write("values", model.objects.all(), _fields(model), category)
+            write("correlations", Correlation.objects.all(), _fields(Correlation))
+
+        with open(tmp / "manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return manifest
+
+
+def read_manifest(path) -> dict:
+    """Manifest of the dataset at `path`, checked against this version of the schema."""
+    with open(Path(path) / "manifest.json") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported dataset format {manifest.get('format')} (expected {FORMAT_VERSION}).")
+    if manifest["cell_lines"] != CELL_LINES:
+        raise ValueError("The dataset was exported with different cell lines than this version of the schema.")
+    return manifest
+
+
+def _copy_batches(model, fields, batches, extra: dict):
+    """
+    Insert Arrow record batches into the table of `model` with COPY (PostgreSQL),
+    or with bulk_create on other databases.
+
+    :param extra: constant values for fields not stored in the files (the partition)
+    """
+    if connection.vendor == "postgresql":
+        columns = [f.column for f in fields] + [model._meta.get_field(k).column for k in extra]
+        sql = f"COPY {connection.ops.quote_name(model._meta.db_table)} " \
+              f"({', '.join(connection.ops.quote_name(c) for c in columns)}) FROM STDIN WITH (FORMAT csv)"
+        with connection.cursor() as cursor, cursor.copy(sql) as copy:
+            for batch in batches:
+                for key, value in extra.items():
+                    batch = batch.append_column(key, pa.array([value] * batch.num_rows, type=pa.string()))
+                buffer = io.BytesIO()
+                # Nulls are written unquoted and empty, which COPY reads as NULL, and strings quoted
+                pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+                copy.write(buffer.getvalue())
+        return
+
+    attnames = {f.name: f.attname for f in fields}
+    for batch in batches:
+        model.objects.bulk_create([
+            model(**{attnames[k]: v for k, v in row.items()}, **extra) for row in batch.to_pylist()
+        ], batch_size=1000)
+
+
+def import_dataset(path, replace: bool = False, log=print) -> dict:
+    """
+    Load the dataset at `path` (written by `export_dataset`) into the database,
+    in a single transaction, and recompute the feature statistics.
+
+    :param replace: delete the existing data first; otherwise the database must be empty
+    :param log: function called with a progress message for each file
+    :returns: the manifest of the dataset
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+
+    with transaction.atomic():
+        models = [Feature, *CATEGORY_MODELS.values(), Correlation, FeatureStats, FeatureNeighbor]
+        if not replace and Feature.objects.exists():
+            raise ValueError("The database already holds features.")
+        connection.ops.execute_sql_flush(connection.ops.sql_flush(
+            no_style(), [m._meta.db_table for m in models], reset_sequences=True, allow_cascade=True))
+
+        for name in ("features", "values", "correlations"):
+            for file in manifest["tables"][name]["files"]:
+                category = _partition_value(file)
+                if name == "features":
+                    model, fields, extra = Feature, _fields(Feature, exclude=["category"]), {"category": category}
+                elif name == "values":
+                    model, extra = CATEGORY_MODELS[category], {}
+                    fields = _fields(model)
+                else:
+                    model, fields, extra = Correlation, _fields(Correlation), {}
+
+                parquet = pq.ParquetFile(path / file)
+                _copy_batches(model, fields, parquet.iter_batches(batch_size=EXPORT_CHUNK_ROWS), extra)
+                log(f"{file}: {parquet.metadata.num_rows} rows")
+
+        # Explicit ids were inserted, so move the id sequences past them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Correlation]):
+                cursor.execute(sql)
+
+        for category in CATEGORY_MODELS:
+            refresh_feature_stats(category)
+
+    # Every cached result may be stale now
+    invalidation.invalidate_all()
+    return manifest
+
+
+class _Drain:
+    """Write-only file object that keeps what is written until `drain` is called."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _stream_csv(chunks, header: list, category: str):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(header)
+    yield buffer.getvalue().encode()
+
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        # Category isn't stored, so it is inserted before Sub_Category. Missing values (None) are written as empty fields
+        writer.writerows((name, data_type, category, *rest) for name, data_type, *rest in chunk)
+        yield buffer.getvalue().encode()
+
+
+def _stream_parquet(chunks, header: list, category: str):
+    schema = pa.schema([pa.field(name, pa.string()) for name in METADATA_COLUMNS]
+                       + [pa.field(name, pa.float64()) for name in header[len(METADATA_COLUMNS):]])
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd", write_statistics=True)
+    try:
+        for chunk in chunks:
+            names, data_types, sub_categories, *values = zip(*chunk)
+            columns = [names, data_types, [category] * len(chunk), sub_categories, *values]
+            # One row group per chunk, sent as soon as it is written
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def stream_values(category: str, sub_categories=None, features=None, cell_lines=None, file_format: str = "csv"):
+    """
+    Stream the values of category `category` as CSV or Parquet, in the layout `loadfile`
+    reads (Feature, Data_Type, Category, Sub_Category, then one column per cell line),
+    without holding more than `STREAM_CHUNK_ROWS` rows in memory.
+
+    Chunks are read with separate queries (see `_keyset_chunks`), so a feature changed
+    while the export runs may appear with its old or new values.
+
+    :param sub_categories: only export features in these sub_categories
+    :param features: only export these features
+    :param cell_lines: only export these cell lines, in CELL_LINES order
+    :param file_format: one of STREAM_FORMATS
+    :returns: generator of bytes
+    """
+    columns = list(cell_lines) if cell_lines is not None else CELL_LINES
+    queryset = CATEGORY_MODELS[category].objects.all()
+    if sub_categories:
+        queryset = queryset.filter(feature__sub_category__in=sub_categories)
+    if features:
+        queryset = queryset.filter(feature__in=features)
+
+    def chunks():
+        for chunk in _keyset_chunks(queryset, ["feature", "feature__data_type", "feature__sub_category", *columns],
+                                    STREAM_CHUNK_ROWS):
+            metrics.ROWS_SCANNED.inc(len(chunk), table=category, source="export")
+            yield chunk
+
+    header = [*METADATA_COLUMNS, *columns]
+    if file_format == "parquet":
+        return _stream_parquet(chunks(), header, category)
+    return _stream_csv(chunks(), header, category)
+
+
+async def astream_values(*args, **kwargs):
+    """
+    Async version of `stream_values`, with the same arguments. Each chunk of rows is read
+    and encoded in one `sync_to_async` call, and sent before the next one is read: under
+    ASGI, Django collects the parts of a synchronous stream in a list before sending any.
+
+    :returns: async generator of bytes
+    """
+    parts = stream_values(*args, **kwargs)
+    next_part = sync_to_async(next)
+    try:
+        while (part := await next_part(parts, None)) is not None:
+            yield part
+    finally:
+        # Closes the Parquet writer of an export stopped early
+        await sync_to_async(parts.close)()
@@ -0,0 +1,78 @@
+"""
+Maintenance and lookup of the per-feature statistics table (`FeatureStats`).
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+
+from .models import CATEGORY_MODELS, FeatureStats
+from .utils import metrics, timing
+from .utils.constants import CELL_LINES
+from .utils.matrix import MIN_COUNT
+from .utils.ingest import value_hashes
+from .utils.stats import compute_feature_stats
+
+
+def refresh_feature_stats(db_name: str, names=None) -> int:
+    """
+    Recompute the statistics (and value hashes) of the features stored in category `db_name`.
+
+    :param names: only refresh these features (e.g. the ones just loaded); all if None
+    :returns: number of features refreshed
+    """
+    queryset = CATEGORY_MODELS[db_name].objects.all()
+    if names is not None:
+        queryset = queryset.filter(feature__in=names)
+    rows = list(queryset.values_list("feature", "feature__data_type", *CELL_LINES))
+
+    values = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, len(CELL_LINES))
+    stats = compute_feature_stats(values, [row[1] for row in rows])
+
+    with transaction.atomic():
+        existing = FeatureStats.objects.filter(database=db_name)
+        if names is not None:
+            existing = existing.filter(feature__in=names)
+        existing.delete()
+        FeatureStats.objects.bulk_create([
+            FeatureStats(feature_id=row[0], database=db_name, value_hash=value_hash, **row_stats)
+            for row, row_stats, value_hash in zip(rows, stats, value_hashes(values))
+        ])
+    return len(rows)
+
+
+def _degenerate_query(db_name: str):
+    # Same conditions as `utils.stats.is_degenerate`. Degenerate features are rare, so
+    # fetching all of them is cheaper than sending the requested names as an IN list
+    return FeatureStats.objects.filter(database=db_name) \
+        .filter(Q(count__lt=MIN_COUNT) | Q(distinct__lt=2)) \
+        .values_list("feature", flat=True)
+
+
+def _record(db_name: str, pruned: set):
+    metrics.FEATURES_PRUNED.inc(len(pruned), table=db_name)
+    timing.count("features_pruned", len(pruned))
+
+
+def prune_degenerate(db_name: str, names) -> list:
+    """
+    `names` without the features whose statistics show they can't have any correlation
+    in category `db_name`. Features without statistics are kept.
+    """
+    with timing.stage("plan"):
+        pruned = set(_degenerate_query(db_name)).intersection(names)
+    _record(db_name, pruned)
+    return [n for n in names if n not in pruned]
+
+
+async def aprune_degenerate(db_name: str, names) -> list:
+    """Async version of `prune_degenerate`."""
+    with timing.stage("plan"):
+        pruned = {n async for n in _degenerate_query(db_name)}.intersection(names)
+    _record(db_name, pruned)
+    return [n for n in names if n not in pruned]
+
+
+def stored_hashes(db_name: str, names) -> dict:
+    """Value hash of each of the features `names` in category `db_name` that has statistics."""
+    return dict(FeatureStats.objects.filter(database=db_name, feature__in=names)
+                .values_list("feature", "value_hash"))
@@ -0,0 +1,82 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management import BaseCommand
+
+from database.models import CATEGORY_MODELS
+from database.utils import compact, correlations, matrix
+from database.utils.constants import CELL_LINES
+from database.utils.snapshot import rank_rows
+
+
+class Command(BaseCommand):
+    help = "Compares memory use and Spearman throughput of compact (float32) and float64 feature values"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=50,
+                            help="Number of numerical features to correlate against all others")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Number of timed runs of each kernel (the best is reported)")
+
+    def best_time(self, func, repeat):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+        return best, result
+
+    def handle(self, *args, **kwargs):
+        rows = []
+        for category, model_class in CATEGORY_MODELS.items():
+            rows += [(category, *row) for row in model_class.objects.order_by("feature").values_list(
+                "feature", "feature__sub_category", "feature__data_type", *CELL_LINES)]
+        if not rows:
+            self.stderr.write(self.style.ERROR("No feature values loaded."))
+            return
+
+        values = np.array([row[4:] for row in rows], dtype=np.float64).reshape(-1, len(CELL_LINES))
+        data_types = [row[3] for row in rows]
+
+        # Memory: the DataFrame the correlation views build vs the compact arrays
+        df = pd.DataFrame([row[1:2] + row[4:] for row in rows], columns=["feature", *CELL_LINES])
+        df.insert(0, "database", [row[0] for row in rows])
+        df["subcategory"] = [row[2] for row in rows]
+        df["datatype"] = data_types
+        numeric = compact.compact_values(values)
+
+        frame_bytes = df.memory_usage(deep=True).sum()
+        compact_bytes = numeric.nbytes
+        self.stdout.write(f"{len(rows)} features x {len(CELL_LINES)} cell lines")
+        self.stdout.write(f"  DataFrame (float64/object): {frame_bytes / 2 ** 20:.2f} MB")
+        self.stdout.write(f"  float64 matrix:             {values.nbytes / 2 ** 20:.2f} MB")
+        self.stdout.write(f"  compact (float32):          {compact_bytes / 2 ** 20:.2f} MB")
+
+        # Throughput: Spearman correlations of `rows` numerical features against all numerical features
+        num = np.array([t == "num" for t in data_types])
+        y64 = values[num]
+        # The compact kernels read the float32 ranks of the float64 values, as stored in the snapshot
+        y32 = rank_rows(y64).astype(np.float32)
+        n = min(kwargs["rows"], len(y64))
+        pairs = n * len(y64)
+
+        def per_pair():
+            frame = df[num]
+            return correlations.calculate_correlations(frame.iloc[:1], frame)
+
+        t_pair, _ = self.best_time(per_pair, 1)
+        t64, (rho64, _) = self.best_time(lambda: matrix.spearman_matrix(y64[:n], y64), kwargs["repeat"])
+        t32, (rho32, _) = self.best_time(lambda: matrix.spearman_matrix(y32[:n], y32), kwargs["repeat"])
+
+        self.stdout.write(f"Spearman throughput ({n} x {len(y64)} numerical features)")
+        self.stdout.write(f"  per-pair DataFrame path:  {len(y64) / t_pair:,.0f} pairs/s")
+        self.stdout.write(f"  float64 kernel:           {pairs / t64:,.0f} pairs/s")
+        self.stdout.write(f"  compact kernel:           {pairs / t32:,.0f} pairs/s")
+
+        diff = np.nanmax(np.abs(rho64 - rho32)) if pairs else 0.0
+        undefined = np.sum(np.isnan(rho64) != np.isnan(rho32))
+        ok = diff <= compact.SPEARMAN_TOLERANCE and undefined == 0
+        message = (f"Largest Spearman difference: {diff:.2e} (tolerance {compact.SPEARMAN_TOLERANCE:.0e}), "
+                   f"{undefined} pairs defined in only one")
+        self.stdout.write(self.style.SUCCESS(message) if ok else self.style.ERROR(message))
@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from database.feature_stats import refresh_feature_stats
+from database.models import CATEGORY_MODELS
+
+
+class Command(BaseCommand):
+    help = "Recomputes the per-feature statistics table from the value tables"
+
+    def handle(self, *args, **kwargs):
+        for category in CATEGORY_MODELS:
+            count = refresh_feature_stats(category)
+            self.stdout.write(f"{category}: {count} features")
+
+        self.stdout.write(self.style.SUCCESS("Feature statistics updated"))
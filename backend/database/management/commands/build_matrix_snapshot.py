@@ -0,0 +1,54 @@
+import numpy as np
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from database.models import CATEGORY_MODELS
+from database.utils.constants import CELL_LINES
+from database.utils.snapshot import FORMAT_VERSION, write_snapshot, read_manifest
+
+
+class Command(BaseCommand):
+    help = "Writes the feature value tables to a memory-mapped matrix snapshot (run after ingest)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", type=str, default=None,
+                            help="Snapshot directory (defaults to MATRIX_SNAPSHOT_DIR)")
+        parser.add_argument("--compact", action="store_true",
+                            help="Store float32 values and ranks "
+                                 "(defaults to MATRIX_SNAPSHOT_COMPACT)")
+        parser.add_argument("--categories", nargs="+", choices=list(CATEGORY_MODELS), default=None,
+                            help="Only rebuild these categories and reuse the others from the current snapshot")
+
+    def handle(self, *args, **kwargs):
+        output = kwargs["output"] or settings.MATRIX_SNAPSHOT_DIR
+        compact_dtypes = kwargs["compact"] or settings.MATRIX_SNAPSHOT_COMPACT
+
+        # Categories can only be reused from a complete snapshot in the same layout
+        categories = list(CATEGORY_MODELS)
+        manifest = read_manifest(output)
+        if kwargs["categories"] and manifest is not None and manifest.get("format") == FORMAT_VERSION \
+                and manifest.get("compact", False) == compact_dtypes \
+                and set(manifest["categories"]) >= set(CATEGORY_MODELS):
+            categories = kwargs["categories"]
+        reuse = [c for c in CATEGORY_MODELS if c not in categories]
+
+        tables = {}
+        for category in categories:
+            model_class = CATEGORY_MODELS[category]
+            rows = list(model_class.objects.order_by("feature")
+                        .values_list("feature", "feature__sub_category", "feature__data_type", *CELL_LINES))
+
+            values = np.array([row[3:] for row in rows], dtype=np.float64).reshape(-1, len(CELL_LINES))
+            tables[category] = {
+                "names": [row[0] for row in rows],
+                "sub_categories": [row[1] for row in rows],
+                "data_types": [row[2] for row in rows],
+                "values": values,
+            }
+            self.stdout.write(f"{category}: {len(rows)} features")
+
+        for category in reuse:
+            self.stdout.write(f"{category}: unchanged")
+
+        version = write_snapshot(output, tables, compact_dtypes=compact_dtypes, reuse=reuse)
+        self.stdout.write(self.style.SUCCESS(f"Snapshot {version} written to {output}"))
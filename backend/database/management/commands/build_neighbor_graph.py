@@ -0,0 +1,17 @@
+from django.core.management import BaseCommand
+
+from database.neighbors import NEIGHBOR_MIN_COUNT, NEIGHBORS_K, build_neighbor_graph
+
+
+class Command(BaseCommand):
+    help = "Recomputes the nearest neighbours of every numerical feature (run after ingest)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=int, default=NEIGHBORS_K,
+                            help="Neighbours stored per feature")
+        parser.add_argument("--min-count", type=int, default=NEIGHBOR_MIN_COUNT,
+                            help="Fewest shared cell lines for two features to be neighbours")
+
+    def handle(self, *args, **kwargs):
+        edges = build_neighbor_graph(kwargs["k"], kwargs["min_count"], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f"Stored {edges} neighbour edges"))
@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+
+from database.dataset import export_dataset
+
+
+class Command(BaseCommand):
+    help = "Exports the features, value tables and precomputed correlations to a directory of Parquet files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", type=str,
+                            help="Directory to write the dataset to (replaced if it exists)")
+
+    def handle(self, *args, **kwargs):
+        manifest = export_dataset(kwargs["output"], log=self.stdout.write)
+        rows = ", ".join(f"{table['rows']} {name}" for name, table in manifest["tables"].items())
+        self.stdout.write(self.style.SUCCESS(f"Exported {rows} to {kwargs['output']}"))
@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError, call_command
+
+from database.dataset import import_dataset
+from database.models import Feature
+from database.utils.snapshot import current_version
+
+
+class Command(BaseCommand):
+    help = "Loads a dataset written by export_snapshot into the database (with COPY on PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", type=str,
+                            help="Directory of the dataset")
+        parser.add_argument("--replace", action="store_true",
+                            help="Delete the features, values and correlations already in the database")
+        parser.add_argument("--snapshot", action="store_true",
+                            help="Build the matrix snapshot after loading (an existing snapshot is always "
+                                 "rebuilt, so it never serves values older than the database)")
+
+    def handle(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            manifest = import_dataset(kwargs["input"], replace=kwargs["replace"], log=self.stdout.write)
+        except (ValueError, FileNotFoundError) as e:
+            raise CommandError(f"{e} Use --replace to overwrite the existing data." if Feature.objects.exists() and
+                               not kwargs["replace"] else str(e))
+
+        rows = ", ".join(f"{table['rows']} {name}" for name, table in manifest["tables"].items())
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {rows} from {kwargs['input']} in {time.perf_counter() - start:.1f}s"))
+
+        # Requests read values from the snapshot while there is one, so it must follow the database
+        if kwargs["snapshot"] or current_version(settings.MATRIX_SNAPSHOT_DIR) is not None:
+            call_command("build_matrix_snapshot", stdout=self.stdout)
@@ -1,21 +1,68 @@
+from pathlib import Path
+
+import numpy as np
+import openpyxl
 import pandas as pd
-from django.core.management import BaseCommand
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import reset_queries, transaction
+from django.db.models import Q
 
-from database.models import Feature, Nuclear, Molecular, DrugScreen
+from database.feature_stats import refresh_feature_stats, stored_hashes
+from database.models import Feature, FeatureNeighbor, Nuclear, Molecular, DrugScreen, Correlation, CATEGORY_MODELS
+from database.utils import invalidation
 from database.utils.constants import CELL_LINES
+from database.utils.snapshot import current_version
+from database.utils.ingest import (SHEET_CHUNK_ROWS, parse_sheet_mapping, sheet_chunks, sheet_layout,
+                                   validate_frame, value_hashes, write_rejects)
 
 
 class Command(BaseCommand):
-    help = "Reads in a CSV file and stores data to database"
+    help = "Reads in CSV files or Excel workbooks and stores data to database"
 
     def add_arguments(self, parser):
         parser.add_argument("filepaths", nargs="+", type=str,
-                            help="Paths to the CSV files")
+                            help="Paths to the CSV files (named after their model, e.g. Molecular_Ploidy.csv) "
+                                 "or .xlsx workbooks")
+        parser.add_argument("--sheet", action="append", default=[], metavar="SHEET=CATEGORY[:SUB_CATEGORY]",
+                            help="Category and sub_category of the features of a workbook sheet without "
+                                 "Category and Sub_Category columns (can be repeated)")
+        parser.add_argument("--data-type", choices=["num", "cat"], default="num",
+                            help="Data type of the features of workbook sheets without a Data_Type column")
+        parser.add_argument("--rejects", type=str, default=None,
+                            help="Directory to write the rows that fail validation to, as <file>.rejects.csv "
+                                 "(defaults to the directory of each file)")
+        parser.add_argument("--snapshot", action="store_true",
+                            help="Build the matrix snapshot after loading (an existing snapshot is always "
+                                 "rebuilt, so it never serves values older than the database)")
+        parser.add_argument("--incremental", action="store_true",
+                            help="Only write features whose values or metadata changed, and only "
+                                 "invalidate cached results and snapshots that involve them")
 
     def handle(self, *args, **kwargs):
         filepaths = kwargs["filepaths"]
+        # Requests read values from the snapshot while there is one, so it must follow the database
+        snapshot = kwargs["snapshot"] or current_version(settings.MATRIX_SNAPSHOT_DIR) is not None
+        changed = {}
+        # Whether any file was loaded through the (incremental) upsert path, or row by row
+        upserted = kwargs["incremental"]
+        replaced = False
+
+        try:
+            sheets = {sheet: (category, sub_category) for sheet, category, sub_category
+                      in map(parse_sheet_mapping, kwargs["sheet"])}
+        except ValueError as e:
+            raise CommandError(str(e))
+        for sheet, (category, _) in sheets.items():
+            if category not in CATEGORY_MODELS:
+                raise CommandError(f"Unknown category '{category}' for sheet {sheet}.")
 
         for filepath in filepaths:
+            if filepath.lower().endswith(".xlsx"):
+                self.load_workbook(filepath, sheets, kwargs["data_type"], changed, kwargs["rejects"])
+                upserted = True
+                continue
+
             try:
                 df = pd.read_csv(filepath)
             except Exception as e:
@@ -34,30 +81,199 @@ class Command(BaseCommand):
                     f"Model class {model_name} not found. Skipping file {filepath}."))
                 continue
 
-            for idx, row in df.iterrows():
+            db_name = next(c for c, m in CATEGORY_MODELS.items() if m is model_class)
+
+            try:
+                df = self.validate(df, db_name, self.rejects_path(filepath, kwargs["rejects"]), set())
+            except ValueError as e:
+                self.stderr.write(self.style.ERROR(f"Skipping file {filepath}: {e}"))
+                continue
+
+            if kwargs["incremental"]:
+                changed.setdefault(db_name, set()).update(self.load_incremental(df, model_class, db_name))
+                continue
+
+            # Load each file in a single transaction so rows are not committed one round trip at a time
+            replaced = True
+            with transaction.atomic():
+                for idx, row in df.iterrows():
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Processing row {idx + 1} of {total_rows} in {filepath}"))
+
+                    feature_name = row.iloc[0]
+                    data_type = row.iloc[1]
+                    category = row.iloc[2]
+                    sub_category = row.iloc[3]
+                    cellline_values = row.iloc[4:]
+
+                    cellline_values = cellline_values.where(pd.notna(cellline_values), None)
+
+                    feature_obj, created = Feature.objects.get_or_create(
+                        name=feature_name, category=category,
+                        sub_category=sub_category, defaults={"data_type": data_type})
+
+                    if not created:
+                        feature_obj.data_type = data_type
+                        feature_obj.save()
+
+                    cellline_data = {cellline_name: value for cellline_name,
+                                     value in cellline_values.items()}
+
+                    self.update_or_create_model(model_class, feature_obj, cellline_data)
+
+            # Keep the statistics of the loaded features in sync with their values
+            refresh_feature_stats(db_name, df.iloc[:, 0].tolist())
+
+        if upserted:
+            self.invalidate(changed, snapshot and not replaced)
+        if snapshot and replaced:
+            call_command("build_matrix_snapshot", stdout=self.stdout)
+
+    def rejects_path(self, filepath, directory=None, sheet=None) -> Path:
+        """Path of the rejects file of `filepath` (or of one of its sheets), removing the one of a previous run."""
+        filepath = Path(filepath)
+        name = f"{filepath.stem}.{sheet}.rejects.csv" if sheet else f"{filepath.stem}.rejects.csv"
+        path = Path(directory or filepath.parent) / name
+        path.unlink(missing_ok=True)
+        return path
+
+    def validate(self, df, db_name, rejects_path, reported: set):
+        """
+        Validate the rows of `df` (see `validate_frame`), writing the rejected ones to `rejects_path`.
+
+        :param reported: warnings already shown for this file, updated in place
+        :returns: the valid rows
+        """
+        valid, rejects, warnings = validate_frame(df, db_name, CELL_LINES)
+        for warning in warnings:
+            if warning not in reported:
+                reported.add(warning)
+                self.stderr.write(self.style.WARNING(warning))
+        if len(rejects):
+            write_rejects(rejects, rejects_path)
+            self.stderr.write(self.style.WARNING(
+                f"Rejected {len(rejects)} of {len(df)} rows, written to {rejects_path}."))
+        return valid
+
+    def load_workbook(self, filepath, sheets: dict, data_type: str, changed: dict, rejects_dir=None):
+        """
+        Load the sheets of an Excel workbook through `load_incremental`, streaming their rows
+        in chunks (openpyxl read-only mode) so memory use doesn't grow with the size of the workbook.
+
+        :param sheets: dictionary mapping sheet names to the (category, sub_category) of their features,
+        for sheets without Category and Sub_Category columns
+        :param changed: dictionary mapping categories to the names of changed features, updated in place
+        :param rejects_dir: directory of the rejects files (defaults to the directory of the workbook)
+        """
+        try:
+            workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Error reading file {filepath}: {e}"))
+            return
+
+        try:
+            for worksheet in workbook.worksheets:
+                rows = worksheet.iter_rows(values_only=True)
+                defaults = {"Data_Type": data_type}
+                if worksheet.title in sheets:
+                    defaults["Category"], defaults["Sub_Category"] = sheets[worksheet.title]
+                try:
+                    layout = sheet_layout(next(rows, None), CELL_LINES, defaults)
+                except ValueError as e:
+                    self.stderr.write(self.style.ERROR(f"Skipping sheet {worksheet.title} of {filepath}: {e}"))
+                    continue
+
+                rejects_path = self.rejects_path(filepath, rejects_dir, worksheet.title)
+                reported = set()
+                total_rows = 0
+                for chunk in sheet_chunks(rows, layout, SHEET_CHUNK_ROWS):
+                    total_rows += len(chunk)
+                    for category, df in chunk.groupby("Category", sort=False, dropna=False):
+                        if category not in CATEGORY_MODELS:
+                            write_rejects(df.assign(reason=f"unknown category {category}"), rejects_path)
+                            self.stderr.write(self.style.WARNING(
+                                f"Rejected {len(df)} rows with unknown category '{category}', written to {rejects_path}."))
+                            continue
+                        df = self.validate(df, category, rejects_path, reported)
+                        changed.setdefault(category, set()).update(
+                            self.load_incremental(df, CATEGORY_MODELS[category], category))
+                    # With DEBUG on, Django keeps the SQL of every query, bulk inserts included
+                    reset_queries()
+
                 self.stdout.write(self.style.SUCCESS(
-                    f"Processing row {idx + 1} of {total_rows} in {filepath}"))
+                    f"Successfully loaded sheet {worksheet.title} of {filepath}. {total_rows} rows received, "
+                    f"{len(layout['cell_lines'])} cell line columns."))
+        finally:
+            # Read-only workbooks keep the file open until closed
+            workbook.close()
+
+    def load_incremental(self, df, model_class, db_name) -> set:
+        """
+        Write only the features of `df` that are new or whose values or metadata changed,
+        comparing the hash of each value vector with the stored one.
+
+        :returns: names of the features written
+        """
+        df = df.drop_duplicates(subset=df.columns[0])
+        names = df.iloc[:, 0].tolist()
+        metadata = {name: (data_type, category, sub_category) for name, data_type, category, sub_category
+                    in df.iloc[:, :4].itertuples(index=False)}
+        values = df.reindex(columns=CELL_LINES).to_numpy(dtype=np.float64)
+
+        hashes = dict(zip(names, value_hashes(values)))
+        stored = stored_hashes(db_name, names)
+        existing = Feature.objects.in_bulk(names)
+
+        new_features = [Feature(name=name, data_type=metadata[name][0], category=metadata[name][1],
+                                sub_category=metadata[name][2]) for name in names if name not in existing]
+        updated_features = [f for f in existing.values()
+                            if (f.data_type, f.category, f.sub_category) != metadata[f.name]]
+        for f in updated_features:
+            f.data_type, f.category, f.sub_category = metadata[f.name]
+        changed_values = [i for i, name in enumerate(names) if stored.get(name) != hashes[name]]
+
+        with transaction.atomic():
+            Feature.objects.bulk_create(new_features)
+            Feature.objects.bulk_update(updated_features, ["data_type", "category", "sub_category"])
 
-                feature_name = row.iloc[0]
-                data_type = row.iloc[1]
-                category = row.iloc[2]
-                sub_category = row.iloc[3]
-                cellline_values = row.iloc[4:]
+            changed_names = [names[i] for i in changed_values]
+            model_class.objects.filter(feature__in=changed_names).delete()
+            model_class.objects.bulk_create([
+                model_class(feature_id=names[i], **{
+                    cell_line: (None if np.isnan(value) else float(value))
+                    for cell_line, value in zip(CELL_LINES, values[i])
+                })
+                for i in changed_values
+            ], batch_size=500)
 
-                cellline_values = cellline_values.where(pd.notna(cellline_values), None)
+            written = set(changed_names) | {f.name for f in updated_features}
+            refresh_feature_stats(db_name, sorted(written))
 
-                feature_obj, created = Feature.objects.get_or_create(
-                    name=feature_name, category=category,
-                    sub_category=sub_category, defaults={"data_type": data_type})
+        self.stdout.write(self.style.SUCCESS(
+            f"{db_name}: {len(new_features)} new features, {len(written) - len(new_features)} changed, "
+            f"{len(names) - len(written)} unchanged."))
+        return written
 
-                if not created:
-                    feature_obj.data_type = data_type
-                    feature_obj.save()
+    def invalidate(self, changed: dict, snapshot: bool):
+        """
+        Discard the cached results, precomputed correlations, neighbour edges and snapshot
+        categories that involve changed features.
+        """
+        names = set().union(*changed.values())
+        if not names:
+            self.stdout.write(self.style.SUCCESS("No features changed."))
+            return
 
-                cellline_data = {cellline_name: value for cellline_name,
-                                 value in cellline_values.items()}
+        epoch = invalidation.record_changes(names)
+        deleted, _ = Correlation.objects.filter(Q(feature1__in=names) | Q(feature2__in=names)).delete()
+        edges, _ = FeatureNeighbor.objects.filter(Q(feature__in=names) | Q(neighbor__in=names)).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"Invalidated cached results for {len(names)} features (data epoch {epoch}), "
+            f"deleted {deleted} precomputed correlations and {edges} neighbour edges."))
 
-                self.update_or_create_model(model_class, feature_obj, cellline_data)
+        if snapshot:
+            categories = [category for category, category_names in changed.items() if category_names]
+            call_command("build_matrix_snapshot", "--categories", *categories, stdout=self.stdout)
 
     def update_or_create_model(self, model_class, feature_obj, cellline_data):
         valid_cellline_data = {k: v for k, v in cellline_data.items() if k in CELL_LINES}
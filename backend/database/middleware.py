@@ -0,0 +1,102 @@
+import json
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import routers
+from .utils import metrics, timing
+
+logger = logging.getLogger(__name__)
+
+
+class TimingMiddleware:
+    """
+    Times every request, counts its database queries and reports the results as
+    a `Server-Timing` header, a structured log line and Prometheus metrics.
+    Works under both WSGI and ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timer = timing.RequestTimer()
+        token = timing.activate(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.deactivate(token)
+
+        self.report(request, response, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = timing.RequestTimer()
+        token = timing.activate(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            timing.deactivate(token)
+
+        self.report(request, response, timer)
+        return response
+
+    def report(self, request, response, timer):
+        match = getattr(request, "resolver_match", None)
+        # The URL name, or the view's dotted path: routes can be regexes with many distinct paths
+        view = match.view_name if match is not None else "unmatched"
+
+        # Don't let scrapes of the metrics endpoint skew the metrics
+        if view == "metrics":
+            return
+
+        response["Server-Timing"] = timer.server_timing()
+
+        metrics.REQUEST_DURATION.observe(timer.elapsed(), view=view)
+        for name, seconds in timer.stages.items():
+            metrics.STAGE_DURATION.observe(seconds, view=view, stage=name)
+        metrics.DB_QUERIES.inc(timer.query_count, view=view)
+        metrics.DB_QUERY_DURATION.observe(timer.query_time, view=view)
+
+        logger.info(json.dumps({
+            "event": "request",
+            "method": request.method,
+            "path": request.path,
+            "view": view,
+            "status": response.status_code,
+            **timer.as_dict(),
+        }))
+
+
+class DatabaseRoutingMiddleware:
+    """
+    Sends the reads of read-only API requests to a replica and sets the statement timeout
+    of their queries (see `routers`). Works under both WSGI and ASGI.
+
+    The routing is not undone after the response, so the generators of streamed responses,
+    which run after it, still use it. Each request sets its own.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routers.route_request(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        routers.route_request(request)
+        return await self.get_response(request)
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-19 16:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0015_alter_feature_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('zero_fraction', models.FloatField(blank=True, null=True)),
+                ('distinct', models.IntegerField(default=0)),
+                ('variance', models.FloatField(blank=True, null=True)),
+                ('minimum', models.FloatField(blank=True, null=True)),
+                ('maximum', models.FloatField(blank=True, null=True)),
+                ('q25', models.FloatField(blank=True, null=True)),
+                ('median', models.FloatField(blank=True, null=True)),
+                ('q75', models.FloatField(blank=True, null=True)),
+                ('histogram', models.JSONField(blank=True, default=dict)),
+                ('feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='database.feature')),
+            ],
+            options={
+                'unique_together': {('feature', 'database')},
+            },
+        ),
+    ]
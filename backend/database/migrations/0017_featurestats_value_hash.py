@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-19 16:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0016_featurestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='featurestats',
+            name='value_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.2 on 2026-10-19 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0017_featurestats_value_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_key', models.CharField(max_length=64)),
+                ('data_version', models.CharField(max_length=32)),
+                ('query', models.JSONField(default=dict)),
+                ('path', models.CharField(max_length=255)),
+                ('size', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed', models.DateTimeField(db_index=True)),
+                ('hits', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('request_key', 'data_version')},
+            },
+        ),
+    ]
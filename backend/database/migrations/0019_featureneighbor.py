@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-19 17:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0018_archivedresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('spearman_corr', models.FloatField(default=0)),
+                ('spearman_pvalue', models.FloatField(blank=True, null=True)),
+                ('feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='database.feature')),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='database.feature')),
+            ],
+            options={
+                'unique_together': {('feature', 'rank')},
+            },
+        ),
+    ]
@@ -46,6 +46,41 @@ Nuclear = create_model('Nuclear')
 Molecular = create_model('Molecular')
 DrugScreen = create_model("DrugScreen")
 
+# Map each Feature.category to the model holding its values
+CATEGORY_MODELS = {
+    "Nuclear": Nuclear,
+    "Molecular": Molecular,
+    "Drug Screen": DrugScreen,
+}
+
+
+class FeatureStats(models.Model):
+    """
+    Summary statistics of a feature's values in one value table, computed at ingest.
+    Used to skip degenerate features before fetching their values, and to show
+    summaries in the UI without reading the value tables.
+    """
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE, related_name="stats")
+    database = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+    zero_fraction = models.FloatField(null=True, blank=True)
+    distinct = models.IntegerField(default=0)
+    variance = models.FloatField(null=True, blank=True)
+    minimum = models.FloatField(null=True, blank=True)
+    maximum = models.FloatField(null=True, blank=True)
+    q25 = models.FloatField(null=True, blank=True)
+    median = models.FloatField(null=True, blank=True)
+    q75 = models.FloatField(null=True, blank=True)
+    histogram = models.JSONField(default=dict, blank=True)
+    # Hash of the values these statistics were computed from, to detect changes on re-import
+    value_hash = models.CharField(max_length=32, blank=True, default="")
+
+    class Meta:
+        unique_together = ("feature", "database")
+
+    def __str__(self):
+        return f"Statistics of {self.feature_id} in {self.database}"
+
 
 class Correlation(models.Model):
     """
@@ -64,3 +99,47 @@ class Correlation(models.Model):
 
     def __str__(self):
         return f"Correlation between {self.feature1.name} and {self.feature2.name}"
+
+
+class ArchivedResult(models.Model):
+    """
+    Index of the correlation results archived on disk (see `database/archive.py`).
+    Each entry is the result of one normalized request, computed from the feature
+    values identified by `data_version`.
+    """
+    request_key = models.CharField(max_length=64)
+    data_version = models.CharField(max_length=32)
+    # Request as sent by the client, to list the query history
+    query = models.JSONField(default=dict)
+    path = models.CharField(max_length=255)
+    size = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    last_accessed = models.DateTimeField(db_index=True)
+    hits = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("request_key", "data_version")
+
+    def __str__(self):
+        return f"Archived result {self.request_key} ({self.data_version})"
+
+
+class FeatureNeighbor(models.Model):
+    """
+    Precomputed nearest neighbours of each numerical feature: the features, from any value
+    table, with the highest absolute Spearman correlation with it (see `database/neighbors.py`).
+    """
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE, related_name="neighbors")
+    neighbor = models.ForeignKey(Feature, on_delete=models.CASCADE, related_name="+")
+    # 1 for the most correlated neighbour
+    rank = models.IntegerField()
+    count = models.IntegerField(default=0)
+    spearman_corr = models.FloatField(default=0)
+    spearman_pvalue = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        # Also the index that serves the neighbours of a feature in rank order
+        unique_together = ("feature", "rank")
+
+    def __str__(self):
+        return f"Neighbour {self.rank} of {self.feature_id}: {self.neighbor_id}"
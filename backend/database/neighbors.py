@@ -0,0 +1,90 @@
+"""
+Precomputed k-nearest-neighbour graph of the numerical features (`FeatureNeighbor`), to
+answer "which features behave most like X across cell lines?" with one indexed read
+instead of correlating X against every sub_category.
+
+The graph is built offline (`manage.py build_neighbor_graph`) over the features of all
+value tables at once with `utils.matrix.nearest_neighbors`. Re-importing a feature deletes
+the edges that involve it (see `loadfile --incremental`), so rebuild the graph after
+loading new data.
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+
+from . import store
+from .models import CATEGORY_MODELS, Feature, FeatureNeighbor
+from .utils import matrix
+from .utils.constants import CELL_LINES
+
+# Neighbours stored per feature
+NEIGHBORS_K = 20
+# Fewer shared cell lines than this and a pair can't be neighbours
+NEIGHBOR_MIN_COUNT = 10
+
+# Default and largest number of neighbours returned by the endpoint
+NEIGHBORS_LIMIT = 10
+
+INSERT_BATCH = 5000
+
+
+def _numerical_values():
+    """
+    Names and values (one row per feature, in CELL_LINES order) of the numerical features of all tables.
+    Tables in the matrix snapshot give the precomputed ranks of the values instead, which have the
+    same Spearman correlations.
+    """
+    names, blocks = [], []
+    for category, model in CATEGORY_MODELS.items():
+        snapshot = store.get_matrix(category)
+        if snapshot is not None:
+            idx = np.array([i for i, t in enumerate(snapshot.data_types) if t == "num"], dtype=np.intp)
+            columns = [snapshot.cell_lines.index(c) for c in CELL_LINES]
+            names += [snapshot.names[i] for i in idx]
+            blocks.append(snapshot.rank_array(idx)[:, columns].astype(np.float64).reshape(-1, len(CELL_LINES)))
+            continue
+
+        rows = list(model.objects.filter(feature__data_type="num").order_by("feature")
+                    .values_list("feature", *CELL_LINES))
+        names += [row[0] for row in rows]
+        blocks.append(np.array([row[1:] for row in rows], dtype=np.float64).reshape(-1, len(CELL_LINES)))
+    return names, np.concatenate(blocks)
+
+
+def build_neighbor_graph(k: int = NEIGHBORS_K, min_count: int = NEIGHBOR_MIN_COUNT, log=print) -> int:
+    """
+    Recompute the `k` nearest neighbours of every numerical feature and replace the stored graph.
+
+    :param min_count: fewest shared cell lines for a pair to be considered
+    :param log: function called with progress messages
+    :returns: number of edges stored
+    """
+    names, values = _numerical_values()
+    log(f"Computing the {k} nearest neighbours of {len(names)} features")
+    neighbors, rho, count = matrix.nearest_neighbors(values, k, min_count)
+    pvalue = matrix.spearman_pvalues(rho, count)
+
+    edges = [
+        FeatureNeighbor(feature_id=names[i], neighbor_id=names[neighbors[i, rank]], rank=rank + 1,
+                        count=int(count[i, rank]), spearman_corr=float(rho[i, rank]),
+                        spearman_pvalue=float(pvalue[i, rank]))
+        for i, rank in zip(*np.nonzero(neighbors >= 0))
+    ]
+    with transaction.atomic():
+        FeatureNeighbor.objects.all().delete()
+        FeatureNeighbor.objects.bulk_create(edges, batch_size=INSERT_BATCH)
+    return len(edges)
+
+
+def feature_neighbors(name: str, limit: int = NEIGHBORS_LIMIT):
+    """
+    The `limit` nearest neighbours of feature `name`, most correlated first, or None if
+    the feature doesn't exist.
+    """
+    rows = list(FeatureNeighbor.objects.filter(feature=name).order_by("rank").values(
+        "rank", "count", "spearman_corr", "spearman_pvalue",
+        name=F("neighbor__name"), category=F("neighbor__category"),
+        sub_category=F("neighbor__sub_category"))[:limit])
+    if not rows and not Feature.objects.filter(name=name).exists():
+        return None
+    return rows
@@ -0,0 +1,74 @@
+"""
+Planning of feature value reads. Each feature's values live in the table of its
+`Feature.category`, so requested features are grouped by category and each table that
+holds any of them is read once, instead of querying every requested table for every feature.
+"""
+from asgiref.sync import sync_to_async
+
+from . import feature_stats, store
+from .models import CATEGORY_MODELS, Feature
+
+
+def plan_tables(features, databases=None) -> dict:
+    """
+    Group `features` (already loaded Feature objects) by the table holding their values.
+
+    :param databases: only include features of these categories (all if None)
+    :returns: dictionary mapping each category to the names of its requested features
+    """
+    plan = {}
+    for f in features:
+        if f.category in CATEGORY_MODELS and (databases is None or f.category in databases):
+            plan.setdefault(f.category, []).append(f.name)
+    return plan
+
+
+def fetch_features(features, databases=None, cell_lines=None, prune=True) -> dict:
+    """
+    Values of `features`, reading each table that holds any of them exactly once.
+
+    :param cell_lines: only read these cell lines (see `store.fetch_values`)
+    :param prune: skip features that can't have any correlation (see `feature_stats.prune_degenerate`)
+    :returns: dictionary mapping each category to a DataFrame with columns "feature", *CELL_LINES
+    """
+    data = {}
+    for db_name, names in plan_tables(features, databases).items():
+        if prune:
+            names = feature_stats.prune_degenerate(db_name, names)
+        if names:
+            data[db_name] = store.fetch_values(db_name, names, cell_lines)
+    return data
+
+
+async def afetch_features(features, databases=None, cell_lines=None, prune=True) -> dict:
+    """Async version of `fetch_features`."""
+    data = {}
+    for db_name, names in plan_tables(features, databases).items():
+        if prune:
+            names = await feature_stats.aprune_degenerate(db_name, names)
+        if names:
+            data[db_name] = await store.afetch_values(db_name, names, cell_lines)
+    return data
+
+
+def fetch_covariates(names, cell_lines=None):
+    """
+    Values of the covariates `names` of a partial correlation request, each read from the
+    table of its category, as a float matrix with one row per covariate and one column per
+    cell line (see `store.fetch_matrix`).
+
+    :raises ValueError: with a user-facing message if a covariate doesn't exist or isn't numerical
+    """
+    found = {f.name: f for f in Feature.objects.filter(name__in=names)}
+    missing = [name for name in names if name not in found]
+    if missing:
+        raise ValueError(f"Covariates not found: {missing}.")
+    categorical = [name for name in names if found[name].data_type != "num"]
+    if categorical:
+        raise ValueError(f"Covariates must be numerical features: {categorical}.")
+    return store.fetch_matrix([found[name] for name in names], cell_lines)
+
+
+async def afetch_covariates(names, cell_lines=None):
+    """Async version of `fetch_covariates`."""
+    return await sync_to_async(fetch_covariates)(names, cell_lines)
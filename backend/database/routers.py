@@ -0,0 +1,126 @@
+"""
+Routing of database queries between the primary and its read replicas, and statement timeouts.
+
+Read-only API requests read from one of the replicas in settings.DATABASE_REPLICAS (picked at
+random per request). These are GET requests under /api/, and the POST endpoints marked with
+`read_only` that only compute from the data (correlations, scatter plots, ...). Everything
+else, including all writes and every query of the management commands (which don't go
+through the middleware), uses the primary (`default`). Use `use_primary()` for reads that
+must see a write made earlier in the same request, since replicas may lag behind.
+
+API requests also bound their queries with a Postgres `statement_timeout`, so a runaway
+scan is cancelled instead of holding a connection: DB_SCAN_STATEMENT_TIMEOUT for endpoints
+that scan the value tables, DB_STATEMENT_TIMEOUT for the others. The timeout is set on the
+connection before a query only when it differs from the one already set (see
+`apply_statement_timeout` for queries in transactions).
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+# Setting holding the statement timeout (in seconds) of each kind of endpoint
+STATEMENT_TIMEOUTS = {
+    "lookup": "DB_STATEMENT_TIMEOUT",
+    "scan": "DB_SCAN_STATEMENT_TIMEOUT",
+}
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Database alias reads of the current request go to (None = primary)
+_read_alias = contextvars.ContextVar("read_alias", default=None)
+# Statement timeout of the current request in milliseconds (None = no timeout)
+_statement_timeout = contextvars.ContextVar("statement_timeout", default=None)
+
+
+def read_only(kind: str = "lookup"):
+    """
+    Mark a view (function or APIView class) as read-only for every method, so its reads go
+    to a replica, with the statement timeout of endpoints of `kind` ("lookup" or "scan").
+    On function views, apply it below the other decorators.
+    """
+    def mark(view):
+        view.read_only = kind
+        return view
+    return mark
+
+
+def route_request(request):
+    """Route the reads and set the statement timeout of the queries made for `request`."""
+    try:
+        view = resolve(request.path_info).func
+    except Resolver404:
+        view = None
+    # DRF's as_view() keeps the view class on the function
+    kind = getattr(getattr(view, "cls", view), "read_only", None)
+
+    api = request.path_info.startswith("/api/")
+    if kind is None and api and request.method in SAFE_METHODS:
+        kind = "lookup"
+
+    replicas = settings.DATABASE_REPLICAS
+    _read_alias.set(random.choice(replicas) if kind is not None and replicas else None)
+
+    timeout = getattr(settings, STATEMENT_TIMEOUTS[kind or "lookup"]) if api else 0
+    _statement_timeout.set(int(timeout * 1000) or None)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary in the block, e.g. to see writes made earlier in the request."""
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+    """Sends the reads of read-only requests to a replica, and everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get() or "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        return db == "default"
+
+
+def apply_statement_timeout(execute, sql, params, many, context):
+    """
+    Database execute wrapper that sets the current request's statement timeout (no timeout
+    outside requests) before running the query. Outside transactions it is set for the session,
+    only if it isn't set already on the connection. A rollback would undo a session-level
+    setting made in a transaction, so in transactions where the session's timeout differs it
+    is set with SET LOCAL before each query instead, and lasts until the transaction ends.
+    """
+    connection = context["connection"]
+    if connection.vendor != "postgresql":
+        return execute(sql, params, many, context)
+
+    timeout = _statement_timeout.get() or 0
+    if timeout != getattr(connection, "statement_timeout", None):
+        in_transaction = connection.in_atomic_block
+        # On the driver's cursor, so it isn't counted as one of the request's queries
+        context["cursor"].cursor.execute(
+            "SELECT set_config('statement_timeout', %s, %s)", [f"{timeout}ms", in_transaction])
+        if not in_transaction:
+            connection.statement_timeout = timeout
+    return execute(sql, params, many, context)
+
+
+def install_statement_timeout(sender, connection, **kwargs):
+    """`connection_created` receiver that installs `apply_statement_timeout` on every new connection."""
+    # Unknown: pooled connections keep the setting of their previous user
+    connection.statement_timeout = None
+    if apply_statement_timeout not in connection.execute_wrappers:
+        connection.execute_wrappers.append(apply_statement_timeout)
@@ -1,7 +1,7 @@
 import math
 from rest_framework import serializers
 
-from .models import Feature, Nuclear, Molecular, DrugScreen
+from .models import Feature, FeatureStats, Nuclear, Molecular, DrugScreen
 from .utils.constants import CELL_LINES
 
 
@@ -11,6 +11,13 @@ class FeatureSerializer(serializers.ModelSerializer):
         fields = ['name', 'data_type', 'category', 'sub_category']
 
 
+class FeatureStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FeatureStats
+        fields = ['database', 'count', 'zero_fraction', 'distinct', 'variance',
+                  'minimum', 'maximum', 'q25', 'median', 'q75', 'histogram']
+
+
 class MolecularSerializer(serializers.ModelSerializer):
     feature = FeatureSerializer()
 
@@ -0,0 +1,139 @@
+"""
+Access to feature values, from the memory-mapped matrix snapshot when one has been
+written (see `manage.py build_matrix_snapshot`), or from the database otherwise.
+"""
+import numpy as np
+import pandas as pd
+
+from .models import CATEGORY_MODELS
+from .utils import metrics, timing
+from .utils.constants import CELL_LINES
+from .utils.snapshot import get_snapshot
+
+
+def get_matrix(db_name: str):
+    """FeatureMatrix for category `db_name` from the current snapshot, or None."""
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return None
+    return snapshot.get(db_name)
+
+
+def _record(db_name: str, rows, source: str):
+    metrics.ROWS_SCANNED.inc(len(rows), table=db_name, source=source)
+    timing.count("rows_scanned", len(rows))
+
+
+def _columns(cell_lines) -> list:
+    return list(cell_lines) if cell_lines is not None else CELL_LINES
+
+
+def _to_frame(rows, columns) -> pd.DataFrame:
+    # Cell lines that weren't fetched are missing values
+    return pd.DataFrame(rows, columns=["feature", *columns]).reindex(columns=["feature", *CELL_LINES])
+
+
+def fetch_values(db_name: str, names, cell_lines=None) -> pd.DataFrame:
+    """
+    Values of the features `names` stored in category `db_name`, as a DataFrame with
+    columns "feature", *CELL_LINES. Features that are not in the category are skipped.
+
+    :param cell_lines: only read these cell lines; the other columns are NaN
+    """
+    columns = _columns(cell_lines)
+
+    matrix = get_matrix(db_name)
+    if matrix is not None:
+        with timing.stage("snapshot"):
+            df = matrix.frame(names)
+            if cell_lines is not None:
+                df = df[["feature", *columns]].reindex(columns=["feature", *CELL_LINES])
+        _record(db_name, df, "snapshot")
+        return df
+
+    with timing.stage("orm"):
+        rows = list(CATEGORY_MODELS[db_name].objects.filter(feature__in=names).values_list("feature", *columns))
+    with timing.stage("dataframe"):
+        df = _to_frame(rows, columns)
+    _record(db_name, df, "db")
+    return df
+
+
+async def afetch_values(db_name: str, names, cell_lines=None) -> pd.DataFrame:
+    """Async version of `fetch_values`. Snapshot reads don't block, so only the ORM path awaits."""
+    if get_matrix(db_name) is not None:
+        return fetch_values(db_name, names, cell_lines)
+
+    columns = _columns(cell_lines)
+    with timing.stage("orm"):
+        rows = [row async for row in CATEGORY_MODELS[db_name].objects.filter(feature__in=names).values_list("feature", *columns)]
+    with timing.stage("dataframe"):
+        df = _to_frame(rows, columns)
+    _record(db_name, df, "db")
+    return df
+
+
+def _snapshot_matrix(features, by_category: dict, matrices: dict, cell_lines=None, ranks: bool = False) -> np.ndarray:
+    """
+    `fetch_matrix` when every category is in the snapshot, without going through DataFrames.
+
+    :param ranks: read the precomputed ranks of the rows instead of their values
+    """
+    dtype = np.float32 if all(m.compact for m in matrices.values()) else np.float64
+    values = np.full((len(features), len(CELL_LINES)), np.nan, dtype=dtype)
+    position = {f.name: i for i, f in enumerate(features)}
+
+    with timing.stage("snapshot"):
+        for category, names in by_category.items():
+            matrix = matrices[category]
+            idx = matrix.rows(names)
+            columns = [matrix.cell_lines.index(c) for c in CELL_LINES]
+            rows = matrix.rank_array(idx) if ranks else matrix.array(idx)
+            values[[position[matrix.names[i]] for i in idx]] = rows[:, columns]
+            _record(category, idx, "snapshot")
+
+    if cell_lines is not None:
+        values[:, [i for i, c in enumerate(CELL_LINES) if c not in set(cell_lines)]] = np.nan
+    return values
+
+
+def _group_by_category(features):
+    """Names of `features` in each category, and the snapshot matrix of each category (or None)."""
+    by_category = {}
+    for f in features:
+        if f.category in CATEGORY_MODELS:
+            by_category.setdefault(f.category, []).append(f.name)
+    return by_category, {category: get_matrix(category) for category in by_category}
+
+
+def fetch_matrix(features, cell_lines=None) -> np.ndarray:
+    """
+    Values of `features` (Feature objects, possibly from several categories) as a float
+    matrix with one row per feature, in the given order, and one column per cell line.
+    Features with no stored values are all NaN. The matrix is float32 if it was read from
+    a compact snapshot (see `utils.compact`), float64 otherwise.
+
+    :param cell_lines: only read these cell lines; the other columns are NaN
+    """
+    by_category, matrices = _group_by_category(features)
+    if matrices and all(m is not None for m in matrices.values()):
+        return _snapshot_matrix(features, by_category, matrices, cell_lines)
+
+    frames = [fetch_values(category, names, cell_lines) for category, names in by_category.items()]
+    if not frames:
+        return np.full((len(features), len(CELL_LINES)), np.nan)
+
+    df = pd.concat(frames).drop_duplicates("feature").set_index("feature")
+    return df.reindex([f.name for f in features])[CELL_LINES].to_numpy(dtype=np.float64)
+
+
+def fetch_ranks(features, cell_lines=None) -> np.ndarray:
+    """
+    Input for the Spearman kernels of `utils.matrix`, in the layout of `fetch_matrix`: the
+    ranks of each row precomputed in the snapshot when every category is in it, or else the
+    values. Ranks are a monotone function of the values, so both give the same correlations.
+    """
+    by_category, matrices = _group_by_category(features)
+    if matrices and all(m is not None for m in matrices.values()):
+        return _snapshot_matrix(features, by_category, matrices, cell_lines, ranks=True)
+    return fetch_matrix(features, cell_lines)
@@ -0,0 +1,71 @@
+"""
+Helpers shared by the test modules.
+"""
+import shutil
+import tempfile
+
+import numpy as np
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from database.models import CATEGORY_MODELS, Feature
+from database.utils.constants import CELL_LINES
+
+
+def random_values(rng: np.random.Generator, n: int, missing: float = 0.0, ties: bool = False) -> np.ndarray:
+    """
+    (n, len(CELL_LINES)) matrix of random values, with a fraction `missing` of NaNs and,
+    with `ties`, values rounded to one decimal so that many of them are tied.
+    """
+    values = rng.normal(size=(n, len(CELL_LINES)))
+    if ties:
+        values = np.round(values, 1)
+    values[rng.random(values.shape) < missing] = np.nan
+    return values
+
+
+def create_features(category: str, sub_category: str, values: dict, data_type: str = "num") -> list:
+    """
+    Create a feature of `category` for each name in `values`, with its row in the category's
+    table (one value per cell line, NaN = missing).
+
+    :returns: the Feature objects, in the order of `values`
+    """
+    model = CATEGORY_MODELS[category]
+    features = []
+    for name, row in values.items():
+        feature = Feature.objects.create(name=name, category=category, sub_category=sub_category,
+                                         data_type=data_type)
+        model.objects.create(feature=feature, **{
+            cell_line: None if np.isnan(value) else float(value) for cell_line, value in zip(CELL_LINES, row)
+        })
+        features.append(feature)
+    return features
+
+
+class DataTestCase(TestCase):
+    """
+    Test case reading feature values from the database only: without a matrix snapshot
+    or result archive, and with an empty cache for each test.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._snapshot_dir = tempfile.mkdtemp()
+        cls._settings = override_settings(MATRIX_SNAPSHOT_DIR=cls._snapshot_dir, RESULT_ARCHIVE_MAX_MB=0)
+        cls._settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._settings.disable()
+        shutil.rmtree(cls._snapshot_dir, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        # Remove the snapshot built by an earlier test
+        shutil.rmtree(self._snapshot_dir, ignore_errors=True)
+
+    def post(self, path: str, data: dict):
+        return self.client.post(path, data, content_type="application/json")
@@ -0,0 +1,136 @@
+"""
+Tests of the cost-based admission control: cost estimates, the expensive lane and the
+responses of rejected requests.
+"""
+import asyncio
+import threading
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+
+from database.utils import admission
+from database.utils.constants import CELL_LINES
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+class EstimateCostTests(SimpleTestCase):
+    def test_cost_grows_with_the_work(self):
+        cost = admission.estimate_cost("num", ["num", "num"], 100)
+        self.assertEqual(cost, 200)
+        # Categorical tests and resamples cost more, fewer cell lines less
+        self.assertEqual(admission.estimate_cost("num", ["num", "cat"], 100), 300)
+        self.assertEqual(admission.estimate_cost("cat", ["cat"], 100), 400)
+        self.assertEqual(admission.estimate_cost("num", ["num"], 100, permutations=900, bootstrap=100), 1100)
+        self.assertEqual(admission.estimate_cost("num", ["num", "num"], 10), cost / 10)
+        # Resamples only apply to Spearman pairs
+        self.assertEqual(admission.estimate_cost("num", ["cat"], 100, permutations=900), 200)
+
+    def test_matrix_cost(self):
+        self.assertEqual(admission.estimate_matrix_cost(10, 20, 100), 10 * 20 * 100 * admission.MATRIX_WEIGHT)
+
+
+@override_settings(ADMISSION_CHEAP_COST=10, ADMISSION_MAX_COST=100, ADMISSION_QUEUE_TIMEOUT=5)
+class LaneTests(SimpleTestCase):
+    def setUp(self):
+        self.lane = admission.Lane("expensive", concurrency=1, queue_size=1)
+        patcher = mock.patch.object(admission, "_lane", self.lane)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cheap_requests_skip_the_lane(self):
+        self.lane.active = 1
+        with admission.admit(10):
+            self.assertEqual(self.lane.active, 1)
+
+    def test_too_expensive(self):
+        with self.assertRaises(admission.Rejected) as raised:
+            with admission.admit(101):
+                pass
+        self.assertEqual(raised.exception.status_code, 413)
+        self.assertEqual(raised.exception.headers, {})
+
+    def test_waits_for_a_slot(self):
+        entered = threading.Event()
+
+        def run():
+            with admission.admit(50):
+                entered.set()
+
+        with admission.admit(50):
+            self.assertEqual(self.lane.active, 1)
+            thread = threading.Thread(target=run)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+            self.assertEqual(self.lane.waiting, 1)
+        thread.join(5)
+        self.assertTrue(entered.is_set())
+        self.assertEqual((self.lane.active, self.lane.waiting), (0, 0))
+
+    def test_busy(self):
+        self.lane.active = 1
+        self.lane.waiting = 1
+        with self.assertRaises(admission.Rejected) as raised:
+            self.lane.acquire(5)
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(raised.exception.headers, {"Retry-After": "5"})
+
+        self.lane.waiting = 0
+        with self.assertRaises(admission.Rejected) as raised:
+            self.lane.acquire(0.01)
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual((self.lane.active, self.lane.waiting), (1, 0))
+
+    async def test_cancelled_async_admission_releases_its_slot(self):
+        self.lane.active = 1
+        task = asyncio.ensure_future(admission.aadmit(50).__aenter__())
+        while self.lane.waiting == 0:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        # The worker thread only gets the slot once it frees up, then gives it back
+        self.lane.release()
+        for _ in range(500):
+            if self.lane.active == 0 and self.lane.waiting == 0:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual((self.lane.active, self.lane.waiting), (0, 0))
+
+
+class RejectedResponseTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        values = random_values(np.random.default_rng(16), 3)
+        create_features("Nuclear", "Nuclear", {"n0": values[0]})
+        create_features("Molecular", "Protein Array", {"p0": values[1], "p1": values[2]})
+        self.query = {"feature1": "n0", "feature2": ["p0", "p1"], "database1": ["Nuclear"],
+                      "database2": ["Molecular"]}
+
+        # The only slot of the lane is taken, and nothing can queue
+        lane = admission.Lane("expensive", concurrency=1, queue_size=0)
+        lane.active = 1
+        patcher = mock.patch.object(admission, "_lane", lane)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_too_expensive(self):
+        with override_settings(ADMISSION_MAX_COST=len(CELL_LINES)):
+            response = self.post("/api/correlations/", self.query)
+        self.assertEqual(response.status_code, 413)
+        self.assertNotIn("Retry-After", response)
+
+    @override_settings(ADMISSION_CHEAP_COST=0, ADMISSION_QUEUE_TIMEOUT=2.5)
+    def test_busy(self):
+        response = self.post("/api/correlations/", self.query)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "3")
+
+    @override_settings(ADMISSION_CHEAP_COST=0, ADMISSION_QUEUE_TIMEOUT=2.5)
+    async def test_async_busy(self):
+        response = await self.async_client.post("/api/async/correlations/", self.query,
+                                                 content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "3")
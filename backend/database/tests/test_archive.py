@@ -0,0 +1,60 @@
+"""
+Tests of the result archive's data versions.
+"""
+import numpy as np
+from django.test import override_settings
+
+from database import archive
+from database.feature_stats import refresh_feature_stats
+from database.models import Molecular, Nuclear
+from database.utils.constants import CELL_LINES
+from database.utils.params import parse_correlation_request
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+@override_settings(RESULT_ARCHIVE_MAX_MB=1)
+class DataVersionTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        values = random_values(np.random.default_rng(19), 4)
+        create_features("Nuclear", "Nuclear", {"n0": values[0], "n1": values[1]})
+        create_features("Molecular", "Protein Array", {"p0": values[2], "p1": values[3]})
+        self.params = parse_correlation_request({"feature1": "n0", "feature2": ["p0", "p1"],
+                                                 "database1": ["Nuclear"], "database2": ["Molecular"]})
+
+    def version(self, **params):
+        return archive.data_version({**self.params, **params})
+
+    def set_value(self, model, name, value):
+        model.objects.filter(feature=name).update(**{CELL_LINES[0]: value})
+
+    def test_features_without_statistics(self):
+        version = self.version()
+        self.set_value(Molecular, "p1", 123.0)
+        changed = self.version()
+        self.assertNotEqual(changed, version)
+
+        # Computing the statistics doesn't change the version of the same values
+        refresh_feature_stats("Nuclear")
+        refresh_feature_stats("Molecular")
+        self.assertEqual(self.version(), changed)
+        self.set_value(Molecular, "p1", 124.0)
+        refresh_feature_stats("Molecular", ["p1"])
+        self.assertNotEqual(self.version(), changed)
+
+    def test_features_without_values(self):
+        Molecular.objects.filter(feature="p1").delete()
+        version = self.version()
+        Molecular.objects.create(feature_id="p1", **{CELL_LINES[0]: 1.0})
+        self.assertNotEqual(self.version(), version)
+
+    def test_covariates(self):
+        version = self.version(covariates=["n1"])
+        self.assertNotEqual(version, self.version())
+        self.set_value(Nuclear, "n1", 123.0)
+        self.assertNotEqual(self.version(covariates=["n1"]), version)
+
+    @override_settings(RESULT_ARCHIVE_MAX_MB=0)
+    def test_disabled(self):
+        self.assertIsNone(self.version())
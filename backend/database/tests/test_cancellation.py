@@ -0,0 +1,76 @@
+"""
+Tests of the cooperative cancellation of correlation requests.
+"""
+from unittest import mock
+
+import numpy as np
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from database.utils import cancellation
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+class AsyncOnlyCache:
+    """The cache, with its blocking methods disabled, as they must not run on the event loop."""
+
+    def __getattr__(self, name):
+        if name in ("get", "set", "get_many", "set_many"):
+            raise AssertionError(f"cache.{name} called on the event loop")
+        return getattr(cache, name)
+
+
+class CancellationTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_a_new_query_supersedes_the_running_one(self):
+        with cancellation.active("tab") as first:
+            with cancellation.active("tab"):
+                cancellation.check()
+            with self.assertRaises(cancellation.Cancelled):
+                first.check()
+        self.assertEqual(first.reason, "superseded")
+
+    def test_cancelled_in_another_process(self):
+        with cancellation.active("tab") as token:
+            cancellation.check()
+            cancellation.cancel_session("other-tab")
+            token._next_poll = 0.0
+            cancellation.check()
+            # A cancellation from another process only shows up in the cache, at the next poll
+            cache.set(cancellation._session_key("tab"), "disconnect:123")
+            token._next_poll = 0.0
+            with self.assertRaises(cancellation.Cancelled):
+                cancellation.check()
+
+    @mock.patch.object(cancellation, "cache", AsyncOnlyCache())
+    async def test_async(self):
+        async with cancellation.aactive("tab") as token:
+            self.assertIs(cancellation.current(), token)
+            await cancellation.acheck()
+            self.assertEqual(await cache.aget(cancellation._session_key("tab")), token.id)
+
+            await cache.aset(cancellation._session_key("tab"), "disconnect:123")
+            token._next_poll = 0.0
+            with self.assertRaises(cancellation.Cancelled):
+                await cancellation.acheck()
+        self.assertIsNone(cancellation.current())
+        self.assertEqual(token.reason, "disconnect")
+
+
+class AsyncCorrelationViewTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        values = random_values(np.random.default_rng(20), 3)
+        create_features("Nuclear", "Nuclear", {"n0": values[0]})
+        create_features("Molecular", "Protein Array", {"p0": values[1], "p1": values[2]})
+
+    @mock.patch.object(cancellation, "cache", AsyncOnlyCache())
+    async def test_session_is_tracked_without_blocking_the_event_loop(self):
+        query = {"feature1": "n0", "feature2": ["p0", "p1"], "database1": ["Nuclear"], "database2": ["Molecular"]}
+        response = await self.async_client.post("/api/async/correlations/?session=tab", query,
+                                                 content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["correlations"]["spearman"]), 2)
@@ -0,0 +1,101 @@
+"""
+Tests of the dataset exports: the Parquet export and import, and the streaming export endpoints.
+"""
+import csv
+import io
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+from database import dataset
+from database.models import CATEGORY_MODELS, Correlation, Feature, FeatureStats
+from database.utils import metrics
+from database.utils.constants import CELL_LINES
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+class StreamValuesTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.values = random_values(np.random.default_rng(14), 5, missing=0.1)
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.values)})
+
+    def scanned(self) -> float:
+        return metrics.ROWS_SCANNED.get(table="Molecular", source="export")
+
+    def test_csv(self):
+        response = self.client.get("/api/export/", {"category": "Molecular", "features": ["p1", "p3"],
+                                                    "cell_lines": CELL_LINES[:3]})
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+
+        self.assertEqual(rows[0], ["Feature", "Data_Type", "Category", "Sub_Category", *CELL_LINES[:3]])
+        self.assertEqual([row[0] for row in rows[1:]], ["p1", "p3"])
+        for row, values in zip(rows[1:], self.values[[1, 3], :3]):
+            self.assertEqual(row[1:4], ["num", "Molecular", "Protein Array"])
+            np.testing.assert_array_equal([float(v) if v else np.nan for v in row[4:]], values)
+
+    async def test_async_export_is_sent_one_chunk_at_a_time(self):
+        with mock.patch.object(dataset, "STREAM_CHUNK_ROWS", 2):
+            response = await self.async_client.get("/api/async/export/", {"category": "Molecular"})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+
+            scanned = self.scanned()
+            parts = aiter(response.streaming_content)
+            header = await anext(parts)
+            self.assertTrue(header.startswith(b"Feature,Data_Type,Category,Sub_Category,"))
+            # Only the rows of the chunk being sent have been read
+            await anext(parts)
+            self.assertEqual(self.scanned() - scanned, 2)
+
+            rest = [part async for part in parts]
+        self.assertEqual(self.scanned() - scanned, 5)
+        self.assertEqual(len(rest), 2)
+
+    async def test_async_export_rejects(self):
+        response = await self.async_client.get("/api/async/export/", {"category": "Unknown"})
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get("/api/async/export/", {"category": "Molecular", "file_format": "xlsx"})
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportDatasetTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(15)
+        molecular = create_features("Molecular", "Protein Array",
+                                    {f"p{i}": row for i, row in enumerate(random_values(rng, 3, missing=0.1))})
+        nuclear = create_features("Nuclear", "Nuclear", {"n0": random_values(rng, 1)[0]})
+        create_features("Molecular", "Arm Level CNA", {"1p": np.sign(random_values(rng, 1)[0])}, data_type="cat")
+        for feature in molecular:
+            Correlation.objects.create(feature1=nuclear[0], feature2=feature, count=len(CELL_LINES),
+                                       spearman_corr=rng.uniform(-1, 1), spearman_pvalue=rng.uniform())
+
+        self.path = Path(tempfile.mkdtemp()) / "dataset"
+        self.addCleanup(shutil.rmtree, self.path.parent, ignore_errors=True)
+
+    def contents(self) -> dict:
+        tables = {"features": list(Feature.objects.order_by("name").values_list()),
+                  "correlations": list(Correlation.objects.order_by("id").values_list())}
+        for category, model in CATEGORY_MODELS.items():
+            tables[category] = list(model.objects.order_by("feature").values_list())
+        return tables
+
+    def test_round_trip(self):
+        expected = self.contents()
+        manifest = dataset.export_dataset(self.path, log=lambda message: None)
+        self.assertEqual(manifest["tables"]["features"]["rows"], 5)
+        self.assertEqual(manifest["tables"]["values"]["rows"], 5)
+        self.assertEqual(manifest["tables"]["correlations"]["rows"], 3)
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+        with self.assertRaises(ValueError):
+            dataset.import_dataset(self.path, log=lambda message: None)
+        dataset.import_dataset(self.path, replace=True, log=lambda message: None)
+        self.assertEqual(self.contents(), expected)
+        self.assertEqual(FeatureStats.objects.count(), 5)
@@ -0,0 +1,140 @@
+"""
+Tests of the validation of ingested rows, and of loading CSV files with `manage.py loadfile`.
+"""
+import io
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from database import store
+from database.models import Feature, FeatureStats, Molecular
+from database.utils import invalidation
+from database.utils.constants import CELL_LINES
+from database.utils.ingest import METADATA_COLUMNS, validate_frame
+
+from .helpers import DataTestCase, random_values
+
+
+class ValidateFrameTests(SimpleTestCase):
+    cell_lines = ["A", "B", "C"]
+
+    def validate(self, rows, extra_columns=("A", "B")):
+        df = pd.DataFrame(rows, columns=METADATA_COLUMNS + list(extra_columns))
+        return validate_frame(df, "Molecular", self.cell_lines)
+
+    def test_rejects(self):
+        valid, rejects, _ = self.validate([
+            ["ok", "num", "Molecular", "Protein Array", 1.5, "2.5"],
+            ["", "num", "Molecular", "Protein Array", 1.0, "2"],
+            ["ok", "num", "Molecular", "Protein Array", 1.0, "2"],
+            ["nuclear", "num", "Nuclear", "Nuclear", 1.0, "2"],
+            ["text", "num", "Molecular", "Protein Array", 1.0, "abc"],
+            ["infinite", "num", "Molecular", "Protein Array", 1.0, "inf"],
+            ["fraction", "cat", "Molecular", "Arm Level CNA", 0.5, "1"],
+            ["missing", "num", "Molecular", "Protein Array", np.nan, "NA"],
+        ])
+
+        self.assertEqual(valid["Feature"].tolist(), ["ok", "missing"])
+        self.assertEqual(dict(zip(rejects.index, rejects["reason"])), {
+            1: "missing feature name",
+            2: "duplicate feature",
+            3: "category is not Molecular",
+            4: "values that aren't finite numbers",
+            5: "values that aren't finite numbers",
+            6: "declared cat but not integer codes with at most 10 levels",
+        })
+        # Rejected rows are kept as given
+        self.assertEqual(rejects.loc[4, "B"], "abc")
+
+    def test_values_and_data_types(self):
+        valid, rejects, warnings = self.validate([
+            ["num", "num", "Molecular", None, 1.5, "2.5", 7],
+            ["codes", "", "Molecular", "Arm Level CNA", -1, "1", 7],
+            ["real", "?", "Molecular", "Protein Array", 0.25, "1", 7],
+        ], extra_columns=("A", "B", "Z"))
+
+        self.assertTrue(rejects.empty)
+        self.assertEqual(list(valid.columns), METADATA_COLUMNS + self.cell_lines)
+        self.assertEqual(valid["Data_Type"].tolist(), ["num", "cat", "num"])
+        self.assertEqual(valid["Sub_Category"].iloc[0], "NA")
+        np.testing.assert_array_equal(valid.loc[0, self.cell_lines].to_numpy(dtype=float), [1.5, 2.5, np.nan])
+        self.assertEqual(len(warnings), 3)
+
+    def test_missing_metadata_columns(self):
+        with self.assertRaises(ValueError):
+            validate_frame(pd.DataFrame([["a", "num"]]), "Molecular", self.cell_lines)
+
+
+class IncrementalLoadTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+        values = random_values(np.random.default_rng(6), 3, missing=0.1)
+        self.df = pd.DataFrame(values, columns=CELL_LINES)
+        self.df.insert(0, "Feature", ["a", "b", "c"])
+        self.df.insert(1, "Data_Type", "num")
+        self.df.insert(2, "Category", "Molecular")
+        self.df.insert(3, "Sub_Category", "Protein Array")
+
+    def load(self, *options) -> str:
+        path = self.directory / "Molecular.csv"
+        self.df.to_csv(path, index=False)
+        out = io.StringIO()
+        call_command("loadfile", str(path), "--incremental", *options, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def hashes(self) -> dict:
+        return dict(FeatureStats.objects.filter(database="Molecular").values_list("feature", "value_hash"))
+
+    def test_only_changed_features_are_written(self):
+        self.assertIn("3 new features, 0 changed, 0 unchanged", self.load())
+        self.assertEqual(Molecular.objects.count(), 3)
+        hashes = self.hashes()
+        self.assertEqual(set(hashes), {"a", "b", "c"})
+        self.assertNotIn("", hashes.values())
+
+        output = self.load()
+        self.assertIn("0 new features, 0 changed, 3 unchanged", output)
+        self.assertIn("No features changed.", output)
+        self.assertEqual(self.hashes(), hashes)
+
+        self.df.loc[0, CELL_LINES[0]] = 9.99
+        self.df.loc[1, "Sub_Category"] = "Global Chromatin"
+        self.assertIn("0 new features, 2 changed, 1 unchanged", self.load())
+
+        self.assertEqual(getattr(Molecular.objects.get(feature="a"), CELL_LINES[0]), 9.99)
+        self.assertEqual(Feature.objects.get(name="b").sub_category, "Global Chromatin")
+        new_hashes = self.hashes()
+        self.assertNotEqual(new_hashes["a"], hashes["a"])
+        self.assertEqual(new_hashes["b"], hashes["b"])
+        self.assertEqual(new_hashes["c"], hashes["c"])
+
+    def test_cached_results_of_changed_features_are_invalidated(self):
+        self.load()
+        epoch = invalidation.current_epoch()
+        invalidation.set_result("with-a", "result", epoch, timeout=60)
+        invalidation.set_result("without-a", "result", epoch, timeout=60)
+
+        self.df.loc[0, CELL_LINES[0]] = 9.99
+        self.load()
+
+        self.assertIsNone(invalidation.get_result("with-a", ["a", "b"]))
+        self.assertEqual(invalidation.get_result("without-a", ["b", "c"]), "result")
+
+    def test_existing_snapshot_is_rebuilt(self):
+        self.load()
+        call_command("build_matrix_snapshot", stdout=io.StringIO())
+
+        # Without --snapshot
+        self.df.loc[0, CELL_LINES[0]] = 9.99
+        self.load()
+
+        frame = store.get_matrix("Molecular").frame(["a"])
+        self.assertEqual(frame[CELL_LINES[0]].iloc[0], 9.99)
@@ -0,0 +1,306 @@
+"""
+Tests of the correlation kernels in `utils.matrix` against scipy.
+"""
+import numpy as np
+from django.test import SimpleTestCase
+from scipy.stats import pearsonr, spearmanr, t as t_dist
+
+from database.utils import compact, matrix, snapshot
+
+
+def scipy_spearman(a: np.ndarray, b: np.ndarray, min_count: int = matrix.MIN_COUNT):
+    """(rho, pvalue, count) of scipy's Spearman correlation over the positions where both have a value."""
+    shared = ~np.isnan(a) & ~np.isnan(b)
+    count = int(shared.sum())
+    if count < min_count or np.ptp(a[shared]) == 0 or np.ptp(b[shared]) == 0:
+        return np.nan, np.nan, count
+    result = spearmanr(a[shared], b[shared])
+    return result.statistic, result.pvalue, count
+
+
+class SpearmanMatrixTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = np.round(rng.normal(size=(6, 40)), 1)
+        self.y = np.round(rng.normal(size=(7, 40)), 1)
+        # Missing values in a few patterns, so rows are grouped by mask
+        self.x[1, :5] = np.nan
+        self.x[2, ::3] = np.nan
+        self.y[0, 10:20] = np.nan
+        self.y[3, ::2] = np.nan
+        self.y[4, :] = np.nan
+        self.y[4, :2] = 1.0
+        self.y[5, :] = 2.0
+
+    def test_matches_scipy(self):
+        rho, count = matrix.spearman_matrix(self.x, self.y)
+        pvalue = matrix.spearman_pvalues(rho, count)
+
+        for i in range(len(self.x)):
+            for j in range(len(self.y)):
+                expected_rho, expected_p, expected_count = scipy_spearman(self.x[i], self.y[j])
+                self.assertEqual(count[i, j], expected_count)
+                np.testing.assert_allclose(rho[i, j], expected_rho, atol=1e-12, err_msg=f"pair {i}, {j}")
+                np.testing.assert_allclose(pvalue[i, j], expected_p, rtol=1e-9, err_msg=f"pair {i}, {j}")
+
+    def test_too_few_or_constant_values_are_nan(self):
+        rho, count = matrix.spearman_matrix(self.x, self.y)
+
+        # Row 4 has 2 values, row 5 is constant
+        self.assertTrue(np.isnan(rho[:, 4]).all())
+        self.assertEqual(count[0, 4], 2)
+        self.assertTrue(np.isnan(rho[:, 5]).all())
+
+    def test_float32(self):
+        rho, count = matrix.spearman_matrix(self.x, self.y)
+        rho32, count32 = matrix.spearman_matrix(self.x.astype(np.float32), self.y.astype(np.float32))
+
+        self.assertEqual(rho32.dtype, np.float32)
+        np.testing.assert_array_equal(count32, count)
+        np.testing.assert_allclose(rho32, rho, atol=compact.SPEARMAN_TOLERANCE)
+
+    def test_float32_rounding_ties(self):
+        # Distinct in float64, but rounded to the same float32 when they only differ by 1e-9
+        rng = np.random.default_rng(1)
+        x = rng.integers(10, size=(3, 40)) / 10 + [rng.permutation(40) * 1e-9 for _ in range(3)]
+        y = rng.integers(10, size=(4, 40)) / 10 + [rng.permutation(40) * 1e-9 for _ in range(4)]
+        self.assertTrue(all(len(np.unique(row)) == 40 for row in np.vstack([x, y])))
+        rho, _ = matrix.spearman_matrix(x, y)
+
+        # Ranking the rounded values turns them into ties ...
+        rounded, _ = matrix.spearman_matrix(x.astype(np.float32), y.astype(np.float32))
+        self.assertGreater(np.nanmax(np.abs(rounded - rho)), compact.SPEARMAN_TOLERANCE)
+
+        # ... ranking before rounding, as compact snapshots do, doesn't
+        rho32, _ = matrix.spearman_matrix(snapshot.rank_rows(x).astype(np.float32),
+                                          snapshot.rank_rows(y).astype(np.float32))
+        np.testing.assert_allclose(rho32, rho, atol=compact.SPEARMAN_TOLERANCE)
+
+
+class PermutationPvalueTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.x = np.round(rng.normal(size=30), 1)
+        self.y = np.vstack([
+            self.x + rng.normal(scale=0.5, size=30),
+            np.round(rng.normal(size=30), 1),
+            rng.normal(size=30),
+            np.full(30, 1.0),
+        ])
+        self.x[:3] = np.nan
+        self.y[1, 10:15] = np.nan
+
+    def test_matches_permuting_each_pair(self):
+        n_permutations = 300
+        pvalues, completed = matrix.spearman_permutation_pvalues(self.x, self.y, n_permutations, seed=7)
+        self.assertEqual(completed, n_permutations)
+
+        # The same permutations, drawn from the same keys, one pair and one permutation at a time
+        keys = np.random.default_rng(7).random((n_permutations, len(self.x)))
+        for j, row in enumerate(self.y[:3]):
+            shared = ~np.isnan(self.x) & ~np.isnan(row)
+            observed = abs(spearmanr(self.x[shared], row[shared]).statistic)
+            exceed = sum(
+                abs(spearmanr(self.x[shared][np.argsort(k[shared])], row[shared]).statistic) >= observed - 1e-12
+                for k in keys)
+            self.assertAlmostEqual(pvalues[j], (exceed + 1) / (n_permutations + 1), msg=f"row {j}")
+
+        self.assertTrue(np.isnan(pvalues[3]))
+
+    def test_reproducible_and_close_to_the_asymptotic_pvalue(self):
+        pvalues, _ = matrix.spearman_permutation_pvalues(self.x, self.y, 2000, seed=3)
+        again, _ = matrix.spearman_permutation_pvalues(self.x, self.y, 2000, seed=3)
+        np.testing.assert_array_equal(pvalues, again)
+
+        self.assertAlmostEqual(pvalues[0], 1 / 2001)
+        for j in (1, 2):
+            _, expected, _ = scipy_spearman(self.x, self.y[j])
+            self.assertAlmostEqual(pvalues[j], expected, delta=0.05)
+
+    def test_deadline(self):
+        pvalues, completed = matrix.spearman_permutation_pvalues(self.x, self.y, 1000, deadline=0)
+        self.assertEqual(completed, 0)
+        self.assertTrue(np.isnan(pvalues).all())
+
+
+class BootstrapTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.x = np.round(rng.normal(size=25), 1)
+        self.y = np.vstack([
+            self.x + rng.normal(size=25),
+            rng.normal(size=25),
+            rng.normal(size=25),
+        ])
+        self.x[0] = np.nan
+        self.y[1, 5:9] = np.nan
+        self.y[2, 2:] = np.nan
+
+    def test_matches_resampling_each_pair(self):
+        n_resamples = 200
+        low, high = matrix.spearman_bootstrap_ci(self.x, self.y, n_resamples, seed=5, confidence=0.9)
+
+        # The same resamples: a pair with k shared cell lines uses the first k draws modulo k
+        draws = np.random.default_rng(5).integers(0, 2 ** 31, size=(n_resamples, len(self.x)))
+        for j, row in enumerate(self.y[:2]):
+            shared = ~np.isnan(self.x) & ~np.isnan(row)
+            k = int(shared.sum())
+            a, b = self.x[shared], row[shared]
+            rhos = []
+            for d in draws:
+                idx = d[:k] % k
+                rhos.append(spearmanr(a[idx], b[idx]).statistic if np.ptp(a[idx]) and np.ptp(b[idx]) else np.nan)
+            expected = np.nanpercentile(rhos, [5, 95])
+            np.testing.assert_allclose([low[j], high[j]], expected, atol=1e-12, err_msg=f"row {j}")
+
+        # Only 2 shared cell lines
+        self.assertTrue(np.isnan(low[2]) and np.isnan(high[2]))
+
+    def test_interval_contains_rho_and_chunks_agree(self):
+        low, high = matrix.spearman_bootstrap_ci(self.x, self.y, 500, seed=1)
+        rho, _ = matrix.spearman_matrix(self.x[np.newaxis, :], self.y)
+        self.assertTrue((low[:2] <= rho[0, :2]).all() and (rho[0, :2] <= high[:2]).all())
+
+        # One row per chunk
+        chunked = matrix.spearman_bootstrap_ci(self.x, self.y, 500, seed=1, max_bytes=1)
+        np.testing.assert_allclose(chunked, (low, high))
+
+
+class SpearmanPairsTests(SimpleTestCase):
+    def test_matches_scipy(self):
+        rng = np.random.default_rng(8)
+        x = np.round(rng.normal(size=(4, 30)), 1)
+        y = np.round(rng.normal(size=(4, 3, 30)), 1)
+        x[0, :4] = np.nan
+        y[1, 0, ::4] = np.nan
+        y[2, 1, 2:] = np.nan
+        y[3, 2] = 5.0
+
+        rho, count = matrix._spearman_pairs(x, y)
+        self.assertEqual(rho.shape, (4, 3))
+        for i in range(4):
+            for j in range(3):
+                expected_rho, _, expected_count = scipy_spearman(x[i], y[i, j])
+                self.assertEqual(count[i, j], expected_count)
+                np.testing.assert_allclose(rho[i, j], expected_rho, atol=1e-12, err_msg=f"pair {i}, {j}")
+
+    def test_nearest_neighbors_are_the_most_correlated_rows(self):
+        rng = np.random.default_rng(9)
+        values = rng.normal(size=(20, 30))
+        values[5:10] = values[0] + rng.normal(scale=0.3, size=(5, 30))
+        values[rng.random(values.shape) < 0.1] = np.nan
+
+        neighbors, rho, count = matrix.nearest_neighbors(values, k=3, oversample=20)
+        exact, shared = matrix.spearman_matrix(values, values)
+        for i in range(len(values)):
+            candidates = np.abs(exact[i])
+            candidates[i] = -1
+            expected = np.argsort(-candidates, kind="stable")[:3]
+            np.testing.assert_allclose(np.abs(rho[i]), candidates[expected], atol=1e-12)
+            np.testing.assert_array_equal(count[i], shared[i, neighbors[i]])
+        self.assertTrue(set(neighbors[0]) <= set(range(5, 10)))
+
+
+class ColumnCorrelationsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(10)
+        # Features in rows, with ties (copy number like levels) and missing values
+        self.values = np.vstack([np.round(rng.normal(size=(30, 6)), 1), rng.integers(-1, 2, size=(10, 6))])
+        self.values[rng.random(self.values.shape) < 0.15] = np.nan
+        self.values[:, 5] = np.nan
+        self.values[:2, 5] = [1.0, 2.0]
+
+    def assert_matches(self, method, values, reference):
+        rho, count = matrix.column_correlations(values, method)
+        n = values.shape[1]
+        self.assertEqual(rho.shape, (n, n))
+        for a in range(n):
+            for b in range(n):
+                shared = ~np.isnan(values[:, a]) & ~np.isnan(values[:, b])
+                self.assertEqual(count[a, b], shared.sum())
+                if shared.sum() < matrix.MIN_COUNT:
+                    self.assertTrue(np.isnan(rho[a, b]))
+                    continue
+                expected = reference(values[shared, a], values[shared, b]).statistic
+                np.testing.assert_allclose(rho[a, b], expected, atol=1e-12, err_msg=f"columns {a}, {b}")
+
+    def test_spearman(self):
+        self.assert_matches("spearman", self.values, spearmanr)
+
+    def test_spearman_without_missing_values(self):
+        self.assert_matches("spearman", np.nan_to_num(self.values[:, :5]), spearmanr)
+
+    def test_pearson(self):
+        self.assert_matches("pearson", self.values, pearsonr)
+
+    def test_blocks_agree(self):
+        rho, count = matrix.column_correlations(self.values)
+        original = matrix.PAIR_BLOCK_CELLS
+        matrix.PAIR_BLOCK_CELLS = 1
+        try:
+            blocked = matrix.column_correlations(self.values)
+        finally:
+            matrix.PAIR_BLOCK_CELLS = original
+        np.testing.assert_allclose(blocked[0], rho)
+        np.testing.assert_array_equal(blocked[1], count)
+
+
+def scipy_partial_spearman(x: np.ndarray, y: np.ndarray, z: np.ndarray):
+    """
+    (rho, pvalue, count) of the Spearman partial correlation of `x` and `y` given the rows of
+    `z`, from the inverse of scipy's Spearman correlation matrix over the complete cell lines.
+    """
+    shared = ~np.isnan(x) & ~np.isnan(y) & ~np.isnan(z).any(axis=0)
+    count = int(shared.sum())
+    rho = spearmanr(np.vstack([x, y, z])[:, shared], axis=1).statistic
+    precision = np.linalg.inv(rho)
+    partial = -precision[0, 1] / np.sqrt(precision[0, 0] * precision[1, 1])
+    dof = count - 2 - len(z)
+    pvalue = 2 * t_dist.sf(abs(partial) * np.sqrt(dof / (1 - partial ** 2)), dof)
+    return partial, pvalue, count
+
+
+class PartialSpearmanTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(12)
+        n = 40
+        self.z = rng.normal(size=(2, n))
+        self.x = self.z[0] + rng.normal(scale=0.5, size=n)
+        self.y = np.vstack([
+            self.z[0] + rng.normal(scale=0.5, size=n),
+            self.z[1] + self.x + rng.normal(size=n),
+            np.round(rng.normal(size=n), 1),
+            self.z[0] * 2,
+        ])
+        self.x[:3] = np.nan
+        self.z[1, 5] = np.nan
+        self.y[0, 10:14] = np.nan
+        self.y[2, ::5] = np.nan
+
+    def test_matches_scipy(self):
+        for z in (self.z[:1], self.z):
+            rho, pvalue, count = matrix.partial_spearman(self.x, self.y[:3], z)
+            for j in range(3):
+                expected_rho, expected_p, expected_count = scipy_partial_spearman(self.x, self.y[j], z)
+                self.assertEqual(count[j], expected_count)
+                np.testing.assert_allclose(rho[j], expected_rho, atol=1e-10, err_msg=f"row {j}, {len(z)} covariates")
+                np.testing.assert_allclose(pvalue[j], expected_p, rtol=1e-8, err_msg=f"row {j}, {len(z)} covariates")
+
+    def test_confounded_correlation_vanishes(self):
+        rho, _ = matrix.spearman_matrix(self.x[np.newaxis, :], self.y[:1])
+        partial, _, _ = matrix.partial_spearman(self.x, self.y[:1], self.z[:1])
+        self.assertGreater(rho[0, 0], 0.5)
+        self.assertLess(abs(partial[0]), 0.3)
+
+    def test_rows_explained_by_the_covariates_are_nan(self):
+        # Row 3 ranks exactly like covariate 0
+        rho, pvalue, count = matrix.partial_spearman(self.x, self.y, self.z[:1])
+        self.assertTrue(np.isnan(rho[3]) and np.isnan(pvalue[3]))
+        self.assertEqual(count[3], 37)
+
+    def test_too_few_cell_lines(self):
+        z = np.full((4, len(self.x)), np.nan)
+        z[:, 3:9] = np.random.default_rng(0).normal(size=(4, 6))
+        rho, _, count = matrix.partial_spearman(self.x, self.y, z)
+        self.assertTrue(np.isnan(rho).all())
+        self.assertTrue((count <= 6).all())
@@ -0,0 +1,49 @@
+"""
+Tests of the request timing middleware and the database connection receivers it relies on.
+"""
+import json
+import re
+
+import numpy as np
+from django.apps import apps
+from django.db import connection
+
+from database.utils import timing
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+class TimingMiddlewareTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(5)
+        create_features("Nuclear", "Nuclear", {f"n{i}": row for i, row in enumerate(random_values(rng, 3))})
+
+    def request_log(self, logs) -> dict:
+        [record] = [json.loads(line.split(":", 2)[2]) for line in logs.output]
+        return record
+
+    def assert_queries_counted(self, response, logs):
+        self.assertEqual(response.status_code, 200)
+        queries = int(re.search(r'db;desc="(\d+) queries"', response["Server-Timing"]).group(1))
+        self.assertGreater(queries, 0)
+        self.assertIn("total;dur=", response["Server-Timing"])
+        self.assertEqual(self.request_log(logs)["db_queries"], queries)
+
+    def test_queries_are_counted(self):
+        with self.assertLogs("database.middleware", "INFO") as logs:
+            response = self.client.get("/api/features/")
+        self.assert_queries_counted(response, logs)
+
+    async def test_async_queries_are_counted(self):
+        with self.assertLogs("database.middleware", "INFO") as logs:
+            response = await self.async_client.get("/api/async/features/categories/")
+        self.assert_queries_counted(response, logs)
+
+    def test_connections_opened_before_ready_are_wrapped(self):
+        connection.ensure_connection()
+        connection.execute_wrappers.remove(timing.record_query)
+        self.addCleanup(timing.install_query_wrapper, sender=None, connection=connection)
+
+        apps.get_app_config("database").ready()
+        self.assertEqual(connection.execute_wrappers.count(timing.record_query), 1)
@@ -0,0 +1,102 @@
+"""
+Tests of the routing of reads between the primary and the replicas, and of the statement timeouts.
+"""
+import contextvars
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from database import routers
+from database.models import Feature
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"], DB_STATEMENT_TIMEOUT=10, DB_SCAN_STATEMENT_TIMEOUT=60)
+class RouteRequestTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.router = routers.ReplicaRouter()
+
+    def route(self, request, func=None):
+        """(read alias, write alias, statement timeout) of `request`, after running `func` in its context."""
+        def run():
+            routers.route_request(request)
+            if func is not None:
+                func()
+            return (self.router.db_for_read(Feature), self.router.db_for_write(Feature),
+                    routers._statement_timeout.get())
+        # In a copy of the context, so the routing doesn't leak into other tests
+        return contextvars.copy_context().run(run)
+
+    def test_api_reads_go_to_a_replica(self):
+        self.assertEqual(self.route(self.factory.get("/api/features/")), ("replica1", "default", 10_000))
+
+    def test_read_only_views(self):
+        request = self.factory.post("/api/correlations/", {}, content_type="application/json")
+        self.assertEqual(self.route(request), ("replica1", "default", 60_000))
+
+    def test_other_requests_use_the_primary(self):
+        request = self.factory.post("/api/correlations/cancel/", {}, content_type="application/json")
+        self.assertEqual(self.route(request), ("default", "default", 10_000))
+        # Outside the API, without a timeout
+        self.assertEqual(self.route(self.factory.get("/corr")), ("default", "default", None))
+
+    def test_use_primary(self):
+        def check():
+            with routers.use_primary():
+                self.assertEqual(self.router.db_for_read(Feature), "default")
+            self.assertEqual(self.router.db_for_read(Feature), "replica1")
+        self.route(self.factory.get("/api/features/"), check)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertEqual(self.route(self.factory.get("/api/features/")), ("default", "default", 10_000))
+
+    def test_management_commands_use_the_primary(self):
+        self.assertEqual(self.router.db_for_read(Feature), "default")
+        self.assertTrue(self.router.allow_migrate("default", "database"))
+        self.assertFalse(self.router.allow_migrate("replica1", "database"))
+
+
+class StatementTimeoutTests(SimpleTestCase):
+    def setUp(self):
+        self.connection = SimpleNamespace(vendor="postgresql", in_atomic_block=False, execute_wrappers=[])
+        routers.install_statement_timeout(sender=None, connection=self.connection)
+        self.assertEqual(self.connection.execute_wrappers, [routers.apply_statement_timeout])
+        self.cursor = SimpleNamespace(cursor=mock.Mock())
+
+    def query(self, timeout):
+        """Run a query with the request's statement timeout `timeout`, and return the timeouts set before it."""
+        execute = mock.Mock()
+
+        def run():
+            routers._statement_timeout.set(timeout)
+            routers.apply_statement_timeout(execute, "SELECT 1", None, False,
+                                            {"connection": self.connection, "cursor": self.cursor})
+        contextvars.copy_context().run(run)
+        execute.assert_called_once()
+        calls = [call.args[1] for call in self.cursor.cursor.execute.call_args_list]
+        self.cursor.cursor.execute.reset_mock()
+        return calls
+
+    def test_set_for_the_session_when_it_changes(self):
+        self.assertEqual(self.query(10_000), [["10000ms", False]])
+        self.assertEqual(self.query(10_000), [])
+        self.assertEqual(self.query(60_000), [["60000ms", False]])
+        # Outside requests, without a timeout
+        self.assertEqual(self.query(None), [["0ms", False]])
+
+    def test_set_locally_in_transactions(self):
+        self.query(10_000)
+        self.connection.in_atomic_block = True
+        self.assertEqual(self.query(10_000), [])
+        # Set before every query of the transaction, which may have rolled back to a savepoint since
+        self.assertEqual(self.query(60_000), [["60000ms", True]])
+        self.assertEqual(self.query(60_000), [["60000ms", True]])
+
+        self.connection.in_atomic_block = False
+        self.assertEqual(self.query(60_000), [["60000ms", False]])
+
+    def test_other_databases(self):
+        self.connection.vendor = "sqlite"
+        self.assertEqual(self.query(10_000), [])
@@ -0,0 +1,171 @@
+"""
+Tests of the coalescing of identical concurrent requests.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from database.utils import metrics, singleflight
+
+
+class LockError(Exception):
+    pass
+
+
+class RedisLock:
+    """
+    Lock double behaving like redis-py's: with `thread_local` (the default), the token is kept
+    per thread, so only the thread that acquired the lock can release it.
+    """
+
+    def __init__(self, held: set, name: str, thread_local: bool = True, **kwargs):
+        self.held = held
+        self.name = name
+        self.local = threading.local() if thread_local else type("Token", (), {})()
+
+    def acquire(self) -> bool:
+        if self.name in self.held:
+            return False
+        self.held.add(self.name)
+        self.local.token = self.name
+        return True
+
+    def release(self):
+        if getattr(self.local, "token", None) is None:
+            raise LockError("Cannot release an unlocked lock")
+        self.held.remove(self.name)
+        self.local.token = None
+
+
+class RedisCache:
+    """Cache double with a `lock` method, like django-redis' cache."""
+
+    def __init__(self):
+        self.held = set()
+
+    def lock(self, name: str, **kwargs) -> RedisLock:
+        return RedisLock(self.held, name, **kwargs)
+
+
+class ThreadPerCall(ThreadPoolExecutor):
+    """Executor running each call in a new thread, so no two calls share a thread."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run).start()
+        return future
+
+
+class SingleflightTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.computed = 0
+
+    def compute(self, seconds: float = 0.3):
+        self.computed += 1
+        time.sleep(seconds)
+        return "result"
+
+    def request(self, key: str, results: list, start: threading.Barrier):
+        start.wait()
+        result = cache.get(key)
+        if result is None:
+            with singleflight.hold(key):
+                result = cache.get(key)
+                if result is None:
+                    result = self.compute()
+                    cache.set(key, result)
+        results.append(result)
+
+    def test_concurrent_requests_compute_once(self):
+        results = []
+        start = threading.Barrier(4)
+        threads = [threading.Thread(target=self.request, args=("same", results, start)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.computed, 1)
+        self.assertEqual(results, ["result"] * 4)
+
+    def test_different_keys_run_in_parallel(self):
+        results = []
+        start = threading.Barrier(2)
+        threads = [threading.Thread(target=self.request, args=(key, results, start)) for key in ("a", "b")]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.computed, 2)
+        self.assertLess(time.perf_counter() - began, 0.5)
+
+    @override_settings(SINGLEFLIGHT_WAIT=0.05)
+    def test_wait_timeout(self):
+        timeouts = metrics.SINGLEFLIGHT_TIMEOUTS.get(scope="process")
+        holding = threading.Event()
+
+        def slow():
+            with singleflight.hold("slow"):
+                holding.set()
+                time.sleep(0.3)
+
+        thread = threading.Thread(target=slow)
+        thread.start()
+        holding.wait()
+        began = time.perf_counter()
+        with singleflight.hold("slow"):
+            waited = time.perf_counter() - began
+        thread.join()
+
+        self.assertLess(waited, 0.25)
+        self.assertEqual(metrics.SINGLEFLIGHT_TIMEOUTS.get(scope="process"), timeouts + 1)
+
+    def test_async_requests_compute_once(self):
+        async def request():
+            result = cache.get("async")
+            if result is None:
+                async with singleflight.ahold("async"):
+                    result = cache.get("async")
+                    if result is None:
+                        self.computed += 1
+                        await asyncio.sleep(0.1)
+                        result = "result"
+                        cache.set("async", result)
+            return result
+
+        async def main():
+            return await asyncio.gather(*(request() for _ in range(4)))
+
+        self.assertEqual(asyncio.run(main()), ["result"] * 4)
+        self.assertEqual(self.computed, 1)
+
+    def test_async_shared_lock_is_released(self):
+        redis = RedisCache()
+
+        async def main():
+            asyncio.get_running_loop().set_default_executor(ThreadPerCall())
+            async with singleflight.ahold("async"):
+                self.assertEqual(redis.held, {"singleflight:async"})
+
+        with mock.patch.object(singleflight, "cache", redis):
+            asyncio.run(main())
+            self.assertEqual(redis.held, set())
+
+            # The sync version acquires and releases it in the same thread
+            with singleflight.hold("sync"):
+                self.assertEqual(redis.held, {"singleflight:sync"})
+            self.assertEqual(redis.held, set())
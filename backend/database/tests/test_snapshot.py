@@ -0,0 +1,182 @@
+"""
+Tests of the memory-mapped matrix snapshots: writing, publishing and loading them, and reading
+feature values and ranks from them.
+"""
+import io
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from database import neighbors, store
+from database.models import Feature, FeatureNeighbor
+from database.utils import compact, matrix, snapshot
+from database.utils.constants import CELL_LINES
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+def table(values: np.ndarray, data_types=None) -> dict:
+    return {
+        "names": [f"f{i}" for i in range(len(values))],
+        "sub_categories": ["Protein Array"] * len(values),
+        "data_types": data_types or ["num"] * len(values),
+        "values": values,
+    }
+
+
+class WriteSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(MATRIX_SNAPSHOT_DIR=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        rng = np.random.default_rng(17)
+        self.values = random_values(rng, 4, missing=0.2, ties=True)
+        self.copy_number = rng.integers(-1, 2, size=(2, len(CELL_LINES))).astype(float)
+        self.copy_number[0, :5] = np.nan
+
+    def test_write_and_load(self):
+        version = snapshot.write_snapshot(self.root, {"Molecular": table(self.values)})
+        self.assertEqual(snapshot.current_version(self.root), version)
+        self.assertEqual(sorted(p.name for p in (self.root / version / "molecular").iterdir()),
+                         ["features.json", "ranks.npy", "values.npy"])
+
+        loaded = snapshot.get_snapshot()
+        self.assertEqual(loaded.version, version)
+        self.assertIsNone(loaded.get("Nuclear"))
+        molecular = loaded.get("Molecular")
+        self.assertIsInstance(molecular.values, np.memmap)
+        self.assertIsInstance(molecular.ranks, np.memmap)
+        self.assertFalse(molecular.compact)
+
+        idx = molecular.rows(["f2", "unknown", "f0"])
+        np.testing.assert_array_equal(idx, [2, 0])
+        np.testing.assert_array_equal(molecular.array(idx), self.values[[2, 0]])
+        np.testing.assert_array_equal(molecular.rank_array(idx), snapshot.rank_rows(self.values[[2, 0]]))
+        frame = molecular.frame(["f1"])
+        self.assertEqual(list(frame.columns), ["feature", *CELL_LINES])
+        np.testing.assert_array_equal(frame[CELL_LINES].to_numpy(), self.values[[1]])
+
+        # A new version is picked up, and old ones pruned
+        versions = [snapshot.write_snapshot(self.root, {"Molecular": table(self.values[:2])}) for _ in range(3)]
+        self.assertEqual(snapshot.get_snapshot().version, versions[-1])
+        self.assertEqual(len(snapshot.get_snapshot().get("Molecular")), 2)
+        kept = [p.name for p in self.root.iterdir() if p.is_dir()]
+        self.assertEqual(len(kept), snapshot.KEEP_VERSIONS + 1)
+        self.assertIn(versions[-1], kept)
+
+    def test_reuse(self):
+        first = snapshot.write_snapshot(self.root, {"Molecular": table(self.values), "Nuclear": table(self.values)})
+        second = snapshot.write_snapshot(self.root, {"Nuclear": table(self.values[:1])}, reuse=["Molecular"])
+
+        # Hard links to the files of the first version
+        self.assertEqual(os.stat(self.root / first / "molecular" / "values.npy").st_ino,
+                         os.stat(self.root / second / "molecular" / "values.npy").st_ino)
+        loaded = snapshot.get_snapshot()
+        self.assertEqual(len(loaded.get("Molecular")), 4)
+        self.assertEqual(len(loaded.get("Nuclear")), 1)
+
+    def test_compact(self):
+        values = np.vstack([self.values, self.copy_number])
+        snapshot.write_snapshot(self.root, {"Molecular": table(values, ["num"] * 4 + ["cat"] * 2)},
+                                compact_dtypes=True)
+        loaded = snapshot.get_snapshot()
+        self.assertEqual(loaded.manifest["format"], snapshot.FORMAT_VERSION)
+        self.assertEqual(sorted(p.name for p in (loaded.path / "molecular").iterdir()),
+                         ["features.json", "ranks.npy", "values.npy"])
+        molecular = loaded.get("Molecular")
+        self.assertTrue(molecular.compact)
+
+        idx = np.arange(6)
+        array = molecular.array(idx)
+        self.assertEqual(array.dtype, np.float32)
+        np.testing.assert_array_equal(array, values.astype(np.float32))
+        np.testing.assert_array_equal(molecular.rank_array(idx), snapshot.rank_rows(values))
+        np.testing.assert_array_equal(molecular.frame(["f5"])[CELL_LINES].to_numpy(), self.copy_number[[1]])
+
+    def test_other_format_is_ignored(self):
+        version = snapshot.write_snapshot(self.root, {"Molecular": table(self.values)})
+        manifest = self.root / version / "manifest.json"
+        manifest.write_text(manifest.read_text().replace(f'"format": {snapshot.FORMAT_VERSION}', '"format": 1'))
+        os.utime(self.root / snapshot.CURRENT_FILE, ns=(0, 0))
+        self.assertIsNone(snapshot.get_snapshot())
+
+
+class SnapshotReadTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(18)
+        self.protein = random_values(rng, 5, missing=0.1, ties=True)
+        self.nuclear = random_values(rng, 3, missing=0.1)
+        self.nuclear[2] = self.protein[0] * 2 + rng.normal(scale=0.1, size=len(CELL_LINES))
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.protein)})
+        create_features("Nuclear", "Nuclear", {f"n{i}": row for i, row in enumerate(self.nuclear)})
+        self.features = list(Feature.objects.order_by("name"))
+
+    def build(self, *options):
+        call_command("build_matrix_snapshot", *options, stdout=io.StringIO())
+
+    def test_ranks_give_the_same_correlations(self):
+        # Without a snapshot, the values are read
+        values = store.fetch_matrix(self.features)
+        np.testing.assert_array_equal(store.fetch_ranks(self.features), values)
+
+        cell_lines = CELL_LINES[5:]
+        subset = np.where(np.isin(CELL_LINES, cell_lines), values, np.nan)
+        expected, expected_count = matrix.spearman_matrix(subset, subset)
+        for options, tolerance in [((), 1e-12), (("--compact",), compact.SPEARMAN_TOLERANCE)]:
+            self.build(*options)
+            ranks = store.fetch_ranks(self.features, cell_lines)
+            # Ranked over all cell lines
+            np.testing.assert_array_equal(np.isnan(ranks), np.isnan(subset))
+            np.testing.assert_array_equal(ranks[:, 5:], snapshot.rank_rows(values)[:, 5:])
+
+            rho, count = matrix.spearman_matrix(ranks, ranks)
+            np.testing.assert_array_equal(count, expected_count)
+            np.testing.assert_allclose(rho, expected, atol=tolerance)
+
+    def test_compact_ranks_keep_float32_rounding_ties_apart(self):
+        # Values distinct in float64 but equal once rounded to float32
+        values = np.round(np.linspace(0, 1, len(CELL_LINES)), 1) + np.arange(len(CELL_LINES)) * 1e-9
+        other = values[::-1] + np.sin(np.arange(len(CELL_LINES)))
+        create_features("Drug Screen", "AUC", {"close": values, "other": other})
+        features = list(Feature.objects.filter(name__in=["close", "other"]).order_by("name"))
+        expected, _ = matrix.spearman_matrix(store.fetch_matrix(features), store.fetch_matrix(features))
+
+        self.build("--compact")
+        rounded = store.fetch_matrix(features)
+        self.assertEqual(rounded.dtype, np.float32)
+        self.assertLess(len(np.unique(rounded[0])), len(CELL_LINES))
+        ranks = store.fetch_ranks(features)
+        self.assertEqual(len(np.unique(ranks[0])), len(CELL_LINES))
+        rho, _ = matrix.spearman_matrix(ranks, ranks)
+        np.testing.assert_allclose(rho, expected, atol=compact.SPEARMAN_TOLERANCE)
+
+    def test_matrix_endpoint(self):
+        names2 = ["n0", "n1", "n2"]
+        query = {"features1": ["p0", "p1"], "features2": names2, "format": "json"}
+        expected = self.post("/api/correlations/matrix/", query).json()
+        self.build()
+        cache.clear()
+        self.assertEqual(self.post("/api/correlations/matrix/", query).json(), expected)
+
+    def test_neighbor_graph(self):
+        neighbors.build_neighbor_graph(k=2, min_count=3, log=lambda message: None)
+        expected = list(FeatureNeighbor.objects.order_by("feature", "rank").values_list(
+            "feature", "neighbor", "rank", "count", "spearman_corr"))
+        self.build()
+        neighbors.build_neighbor_graph(k=2, min_count=3, log=lambda message: None)
+        edges = list(FeatureNeighbor.objects.order_by("feature", "rank").values_list(
+            "feature", "neighbor", "rank", "count", "spearman_corr"))
+
+        self.assertEqual([edge[:4] for edge in edges], [edge[:4] for edge in expected])
+        np.testing.assert_allclose([edge[4] for edge in edges], [edge[4] for edge in expected], atol=1e-12)
+        self.assertIn(("n2", "p0", 1), [edge[:3] for edge in edges])
@@ -0,0 +1,121 @@
+"""
+Tests of the correlations computed in chunks, and of the streaming (Server-Sent Events) endpoints.
+"""
+import json
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+
+from database.utils import correlations, invalidation, streaming
+from database.utils.params import correlation_cache_key, parse_correlation_request
+
+from .helpers import DataTestCase, create_features, random_values
+
+
+def parse_events(body: str) -> list:
+    """(event, data) of each Server-Sent Events message of `body`."""
+    events = []
+    for message in body.split("\n\n")[:-1]:
+        fields = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+@mock.patch.object(streaming, "STREAM_FIRST_CHUNK", 2)
+class CorrelationStreamViewTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(15)
+        self.values = random_values(rng, 7, missing=0.1)
+        create_features("Nuclear", "Nuclear", {"n0": self.values[0]})
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.values[1:])})
+        self.query = {"feature1": "n0", "feature2": [f"p{i}" for i in range(6)], "database1": ["Nuclear"],
+                      "database2": ["Molecular"], "permutations": 50}
+
+    def cached(self):
+        params = parse_correlation_request(self.query)
+        names = [params["feature1"], *params["feature2"]]
+        return invalidation.get_result(correlation_cache_key(params), names)
+
+    async def test_async_batches_are_sent_before_the_result(self):
+        response = await self.async_client.post(
+            "/api/async/correlations/stream/", self.query, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(response.is_async)
+
+        # Chunks of 2, 4 rows
+        parts = aiter(response.streaming_content)
+        event, data = parse_events((await anext(parts)).decode())[0]
+        self.assertEqual(event, "batch")
+        self.assertEqual((data["done"], data["total"]), (2, 6))
+        body = b"".join([part async for part in parts]).decode()
+        events = parse_events(body)
+        self.assertEqual([e for e, _ in events], ["batch", "result"])
+        self.assertEqual(events[0][1]["done"], 6)
+
+        records = events[1][1]["correlations"]["spearman"]
+        self.assertEqual([r["feature_2"] for r in records], [f"p{i}" for i in range(6)])
+        # The best hits of the last batch are the strongest of all records
+        strongest = max(abs(r["spearman_correlation"]) for r in records)
+        self.assertEqual(abs(events[0][1]["top"]["spearman"][0]["spearman_correlation"]), strongest)
+
+        # Same as one request to the non-streaming endpoint
+        response = self.post("/api/correlations/", self.query)
+        self.assertEqual(response.json()["correlations"], events[1][1]["correlations"])
+
+    def test_sync_result_is_cached(self):
+        response = self.post("/api/correlations/stream/", self.query)
+        events = parse_events(b"".join(response.streaming_content).decode())
+        self.assertEqual([e for e, _ in events], ["batch", "batch", "result"])
+        self.assertEqual(self.cached(), events[-1][1]["correlations"])
+
+        # Sent at once the next time
+        response = self.post("/api/correlations/stream/", self.query)
+        events = parse_events(b"".join(response.streaming_content).decode())
+        self.assertEqual([e for e, _ in events], ["result"])
+
+    @override_settings(PERMUTATION_TIME_BUDGET=1e-9)
+    def test_result_is_not_cached_when_the_permutation_budget_ran_out(self):
+        response = self.post("/api/correlations/stream/", self.query)
+        events = parse_events(b"".join(response.streaming_content).decode())
+        self.assertEqual(events[-1][0], "result")
+        self.assertIsNone(self.cached())
+
+    def test_errors(self):
+        self.assertEqual(self.post("/api/correlations/stream/", {"feature1": "n0"}).status_code, 400)
+        response = self.post("/api/correlations/stream/", {**self.query, "feature2": ["unknown"]})
+        self.assertEqual(response.status_code, 404)
+
+
+class CorrelationStreamTests(SimpleTestCase):
+    def setUp(self):
+        values = random_values(np.random.default_rng(16), 9, missing=0.1)
+        # As fetched with values_list()
+        rows = [(f"f{i}", *(None if np.isnan(v) else v for v in row)) for i, row in enumerate(values)]
+        subcategories = {name: "Protein Array" for name, *_ in rows}
+        data_types = {name: "num" for name, *_ in rows}
+        self.df1 = correlations.build_feature_frame({"Nuclear": rows[:1]}, subcategories, data_types)
+        self.df2 = correlations.build_feature_frame({"Molecular": rows[1:]}, subcategories, data_types)
+
+    def run_stream(self, **options):
+        stream = streaming.CorrelationStream(self.df1, self.df2, top_k=3, **options)
+        for start, stop in stream.chunks():
+            stream.run_chunk(start, stop)
+        return stream
+
+    def test_chunks_give_the_results_of_one_call(self):
+        with mock.patch.object(streaming, "STREAM_FIRST_CHUNK", 3):
+            stream = self.run_stream(permutations=50, seed=1, bootstrap=20)
+            self.assertEqual(list(stream.chunks()), [(0, 3), (3, 8)])
+
+        expected = correlations.calculate_correlations(self.df1, self.df2, permutations=50, seed=1, bootstrap=20)
+        self.assertTrue(stream.complete)
+        self.assertEqual(stream.results(), {key: df.to_dict(orient="records") for key, df in expected.items()})
+        self.assertEqual(len(stream.top.best()["spearman"]), 3)
+
+    def test_incomplete_when_the_permutation_budget_ran_out(self):
+        stream = self.run_stream(permutations=50, seed=1, time_budget=1e-9)
+        self.assertFalse(stream.complete)
+        self.assertTrue(self.run_stream().complete)
@@ -0,0 +1,159 @@
+"""
+Tests of the API endpoints, on small tables created for each test.
+"""
+import numpy as np
+
+from database.utils import matrix
+from database.utils.constants import CELL_LINES
+
+from .helpers import DataTestCase, create_features, random_values
+from .test_matrix import scipy_partial_spearman, scipy_spearman
+
+
+class CorrelationMatrixViewTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(1)
+        self.values1 = random_values(rng, 3, missing=0.1, ties=True)
+        self.values2 = random_values(rng, 4, missing=0.1)
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.values1)})
+        create_features("Nuclear", "Nuclear", {f"n{i}": row for i, row in enumerate(self.values2)})
+        create_features("Molecular", "Arm Level CNA", {"1p": np.sign(random_values(rng, 1)[0])}, data_type="cat")
+
+    def test_json(self):
+        response = self.post("/api/correlations/matrix/", {
+            "subcategories1": ["Protein Array", "Arm Level CNA"], "features2": ["n0", "n1", "n2", "n3"],
+            "format": "json"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual(data["features1"], ["p0", "p1", "p2"])
+        self.assertEqual(data["features2"], ["n0", "n1", "n2", "n3"])
+        self.assertEqual(data["skipped"], ["1p"])
+        for i, a in enumerate(self.values1):
+            for j, b in enumerate(self.values2):
+                rho, pvalue, count = scipy_spearman(a, b)
+                self.assertAlmostEqual(data["rho"][i][j], rho, places=10)
+                self.assertAlmostEqual(data["pvalue"][i][j], pvalue, places=10)
+                self.assertEqual(data["count"][i][j], count)
+
+    def test_binary_and_cell_line_subset(self):
+        cell_lines = CELL_LINES[:20]
+        response = self.post("/api/correlations/matrix/", {
+            "features1": ["p0", "p1"], "features2": ["n0"], "cell_lines": cell_lines})
+        self.assertEqual(response.status_code, 200)
+        header, arrays = matrix.unpack_matrices(response.content)
+
+        self.assertEqual(header["features1"], ["p0", "p1"])
+        self.assertEqual(arrays["rho"].shape, (2, 1))
+        for i in range(2):
+            rho, _, count = scipy_spearman(self.values1[i, :20], self.values2[0, :20])
+            self.assertAlmostEqual(float(arrays["rho"][i, 0]), rho, places=6)
+            self.assertEqual(arrays["count"][i, 0], count)
+
+    def test_rejects(self):
+        response = self.post("/api/correlations/matrix/", {"features1": ["p0"]})
+        self.assertEqual(response.status_code, 400)
+        response = self.post("/api/correlations/matrix/", {"features1": ["1p"], "features2": ["n0"]})
+        self.assertEqual(response.status_code, 400)
+        with self.settings(MATRIX_MAX_CELLS=5):
+            response = self.post("/api/correlations/matrix/", {"subcategories1": ["Protein Array"],
+                                                               "subcategories2": ["Nuclear"]})
+        self.assertEqual(response.status_code, 400)
+
+
+class CellLineSimilarityViewTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(11)
+        self.protein = random_values(rng, 8, missing=0.1)
+        self.copy_number = rng.integers(-1, 2, size=(6, len(CELL_LINES))).astype(float)
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.protein)})
+        create_features("Molecular", "Arm Level CNA", {f"{i}p": row for i, row in enumerate(self.copy_number)},
+                        data_type="cat")
+
+    def test_numerical_features(self):
+        cell_lines = CELL_LINES[:6]
+        response = self.post("/api/celllines/similarity/", {
+            "subcategories": ["Protein Array"], "cell_lines": cell_lines, "cluster": True})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual(data["cell_lines"], cell_lines)
+        self.assertEqual(data["features"], 8)
+        self.assertEqual(sorted(data["order"]), list(range(6)))
+        for a in range(6):
+            for b in range(6):
+                rho, _, count = scipy_spearman(self.protein[:, a], self.protein[:, b])
+                self.assertEqual(data["count"][a][b], count)
+                if np.isnan(rho):
+                    self.assertIsNone(data["rho"][a][b])
+                else:
+                    self.assertAlmostEqual(data["rho"][a][b], rho, places=10)
+
+    def test_categorical_features(self):
+        response = self.post("/api/celllines/similarity/", {"subcategories": ["Arm Level CNA"],
+                                                             "cell_lines": CELL_LINES[:4]})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual(data["features"], 6)
+        self.assertEqual(data["skipped"], [])
+        rho, _, _ = scipy_spearman(self.copy_number[:, 0], self.copy_number[:, 1])
+        self.assertAlmostEqual(data["rho"][0][1], rho, places=10)
+
+    def test_rejects(self):
+        response = self.post("/api/celllines/similarity/", {"subcategories": ["Protein Array"], "method": "kendall"})
+        self.assertEqual(response.status_code, 400)
+        response = self.post("/api/celllines/similarity/", {"features": ["unknown"]})
+        self.assertEqual(response.status_code, 400)
+
+
+class PartialCorrelationViewTests(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(13)
+        self.ploidy = rng.normal(size=len(CELL_LINES))
+        self.feature1 = self.ploidy + rng.normal(scale=0.5, size=len(CELL_LINES))
+        self.features2 = np.vstack([self.ploidy + rng.normal(scale=0.5, size=len(CELL_LINES)),
+                                    random_values(rng, 2, missing=0.1)])
+        self.feature1[:4] = np.nan
+        self.ploidy[10] = np.nan
+        create_features("Nuclear", "Nuclear", {"n0": self.feature1})
+        create_features("Molecular", "Ploidy", {"Ploidy": self.ploidy})
+        create_features("Molecular", "Protein Array", {f"p{i}": row for i, row in enumerate(self.features2)})
+        create_features("Molecular", "Arm Level CNA", {"1p": np.sign(self.ploidy)}, data_type="cat")
+
+    def request(self, covariates):
+        return self.post("/api/correlations/", {
+            "feature1": "n0", "feature2": ["p0", "p1", "p2"], "database1": ["Nuclear"],
+            "database2": ["Molecular"], "covariates": covariates})
+
+    def test_partial_correlations(self):
+        response = self.request(["Ploidy"])
+        self.assertEqual(response.status_code, 200)
+        records = {r["feature_2"]: r for r in response.json()["correlations"]["spearman"]}
+
+        self.assertEqual(sorted(records), ["p0", "p1", "p2"])
+        for i, row in enumerate(self.features2):
+            record = records[f"p{i}"]
+            rho, pvalue, count = scipy_partial_spearman(self.feature1, row, self.ploidy[np.newaxis, :])
+            # Results are rounded to 3 significant digits
+            self.assertAlmostEqual(record["partial_correlation"], rho, delta=5e-3 * abs(rho))
+            self.assertAlmostEqual(record["partial_pvalue"], pvalue, delta=5e-3 * pvalue)
+            self.assertEqual(record["partial_count"], count)
+            rho, _, _ = scipy_spearman(self.feature1, row)
+            self.assertAlmostEqual(record["spearman_correlation"], rho, delta=5e-3 * abs(rho))
+
+        # Ploidy drives the correlation with p0
+        self.assertLess(abs(records["p0"]["partial_correlation"]), abs(records["p0"]["spearman_correlation"]))
+
+    def test_without_covariates(self):
+        records = self.request([]).json()["correlations"]["spearman"]
+        self.assertEqual(len(records), 3)
+        self.assertNotIn("partial_correlation", records[0])
+
+    def test_invalid_covariates(self):
+        self.assertEqual(self.request(["unknown"]).status_code, 400)
+        self.assertEqual(self.request(["1p"]).status_code, 400)
+        self.assertEqual(self.request([f"c{i}" for i in range(11)]).status_code, 400)
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import views, async_views
 
 router = DefaultRouter()
 router.register("features", views.FeatureViewSet)
@@ -13,7 +13,23 @@ urlpatterns = [
     path('', views.index, name=""),
     path('cellline', views.cellline, name="cellline"),
     path('corr', views.corr, name="corr"),
+    path('metrics', views.metrics_view, name="metrics"),
     path('api/', include(router.urls)),
     path('api/correlations/', views.CorrelationView.as_view()),
+    path('api/correlations/cancel/', views.CancelQueryView.as_view()),
+    path('api/correlations/stream/', views.CorrelationStreamView.as_view()),
+    path('api/correlations/matrix/', views.CorrelationMatrixView.as_view()),
+    path('api/celllines/similarity/', views.CellLineSimilarityView.as_view()),
     path('api/scatter/', views.ScatterView.as_view()),
+    path('api/history/', views.QueryHistoryView.as_view()),
+    path('api/export/', views.ExportView.as_view()),
+
+    # Async endpoints, for use when served over ASGI
+    path('api/async/features/', async_views.feature_search),
+    path('api/async/features/categories/', async_views.categories),
+    path('api/async/features/subcategories/', async_views.subcategories),
+    path('api/async/scatter/', async_views.scatter),
+    path('api/async/export/', async_views.export),
+    path('api/async/correlations/', async_views.correlations_view),
+    path('api/async/correlations/stream/', async_views.correlations_stream),
 ]
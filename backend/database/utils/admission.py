@@ -0,0 +1,210 @@
+"""
+Cost-based admission control for correlation work.
+
+Each request's cost is estimated from the Feature metadata before any values are read.
+Requests under ADMISSION_CHEAP_COST run immediately. More expensive ones go through the
+"expensive" lane, which runs at most ADMISSION_EXPENSIVE_WORKERS of them at a time per
+process and queues at most ADMISSION_QUEUE_SIZE more, so a few huge requests can't
+monopolize the server while cheap requests (e.g. scatter plots) wait. Requests over
+ADMISSION_MAX_COST are rejected outright with 413, and requests the lane has no room for
+with 503 and a Retry-After header.
+
+Costs are in relative units of roughly one cell line of one pairwise test.
+"""
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics, timing
+
+# Relative cost per cell line of each test, by the data types of the two features
+TEST_WEIGHTS = {
+    ("num", "num"): 1.0,    # Spearman
+    ("num", "cat"): 2.0,    # ANOVA
+    ("cat", "num"): 2.0,
+    ("cat", "cat"): 4.0,    # chi-squared, with a contingency table per pair
+}
+
+# Relative cost per cell line of one permutation or bootstrap resample of a Spearman pair,
+# which are evaluated in vectorized blocks
+RESAMPLE_WEIGHT = 0.01
+
+# Relative cost per cell line of one pair of a correlation matrix, computed as matrix products
+MATRIX_WEIGHT = 0.01
+
+
+class Rejected(Exception):
+    """
+    The request can't be admitted. `status_code` is the HTTP status to respond with, and
+    `retry_after` the number of seconds after which the client may retry, if it is worth it.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict:
+        """Headers of the response."""
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+
+
+def _busy(message: str) -> Rejected:
+    """Rejection of a request the expensive lane has no room for, worth retrying after the queue timeout."""
+    return Rejected(message, 503, retry_after=max(math.ceil(settings.ADMISSION_QUEUE_TIMEOUT), 1))
+
+
+def estimate_cost(f1_data_type: str, f2_data_types: list, n_cell_lines: int,
+                  permutations: int = 0, bootstrap: int = 0) -> float:
+    """
+    Estimated cost of correlating one feature against others.
+
+    :param f1_data_type: data type of feature 1 ("num" or "cat")
+    :param f2_data_types: data type of each feature 2 that will be read
+    :param n_cell_lines: number of cell lines used
+    """
+    cost = 0.0
+    for data_type in f2_data_types:
+        weight = TEST_WEIGHTS.get((f1_data_type, data_type), 1.0)
+        if (f1_data_type, data_type) == ("num", "num"):
+            weight += RESAMPLE_WEIGHT * (permutations + bootstrap)
+        cost += weight * n_cell_lines
+    return cost
+
+
+def estimate_matrix_cost(n1: int, n2: int, n_cell_lines: int) -> float:
+    """Estimated cost of an `n1` x `n2` correlation matrix."""
+    return MATRIX_WEIGHT * n1 * n2 * n_cell_lines
+
+
+class Lane:
+    """
+    Runs at most `concurrency` requests at a time and queues at most `queue_size` more.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float):
+        """
+        Wait for a free slot.
+
+        :raises Rejected: if the queue is full or no slot frees up within `timeout` seconds
+        """
+        with self._condition:
+            if self.active >= self.concurrency and self.waiting >= self.queue_size:
+                metrics.ADMISSION_DECISIONS.inc(lane=self.name, result="queue_full")
+                raise _busy("The server is busy with other large requests, please try again later.")
+
+            self.waiting += 1
+            metrics.ADMISSION_QUEUE_DEPTH.set(self.waiting, lane=self.name)
+            start = time.perf_counter()
+            try:
+                admitted = self._condition.wait_for(lambda: self.active < self.concurrency, timeout=timeout)
+            finally:
+                self.waiting -= 1
+                metrics.ADMISSION_QUEUE_DEPTH.set(self.waiting, lane=self.name)
+            metrics.ADMISSION_WAIT.observe(time.perf_counter() - start, lane=self.name)
+
+            if not admitted:
+                metrics.ADMISSION_DECISIONS.inc(lane=self.name, result="timeout")
+                raise _busy("Timed out waiting behind other large requests, please try again later.")
+
+            self.active += 1
+            metrics.ADMISSION_DECISIONS.inc(lane=self.name, result="admitted")
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+_lane = None
+_lane_lock = threading.Lock()
+
+
+def expensive_lane() -> Lane:
+    """The process-wide lane for expensive requests, created on first use."""
+    global _lane
+    with _lane_lock:
+        if _lane is None:
+            _lane = Lane("expensive", settings.ADMISSION_EXPENSIVE_WORKERS, settings.ADMISSION_QUEUE_SIZE)
+    return _lane
+
+
+def _lane_for(cost: float):
+    """The lane a request of `cost` must go through, or None to run it immediately."""
+    timing.count("cost", round(cost))
+    if cost > settings.ADMISSION_MAX_COST:
+        metrics.ADMISSION_DECISIONS.inc(lane="none", result="rejected")
+        raise Rejected(f"This request is too large (estimated cost {cost:.0f}, limit "
+                       f"{settings.ADMISSION_MAX_COST:.0f}). Please select fewer features.", 413)
+    if cost <= settings.ADMISSION_CHEAP_COST:
+        metrics.ADMISSION_DECISIONS.inc(lane="cheap", result="admitted")
+        return None
+    return expensive_lane()
+
+
+@contextmanager
+def admit(cost: float):
+    """
+    Run the block once a request of `cost` is admitted.
+
+    :raises Rejected: if the request is too expensive or the expensive lane is full or times out
+    """
+    lane = _lane_for(cost)
+    if lane is None:
+        yield
+        return
+
+    with timing.stage("queue"):
+        lane.acquire(settings.ADMISSION_QUEUE_TIMEOUT)
+    try:
+        yield
+    finally:
+        lane.release()
+
+
+def _release_acquired(lane: Lane):
+    """Done callback of an abandoned `lane.acquire` call that releases the slot if it got one."""
+    def release(future):
+        # Retrieving the exception also keeps asyncio from logging the Rejected nobody awaits
+        if not future.cancelled() and future.exception() is None:
+            lane.release()
+    return release
+
+
+@asynccontextmanager
+async def aadmit(cost: float):
+    """
+    Async version of `admit`. Waiting for a slot happens in a worker thread, which can't be
+    interrupted: if the request is cancelled meanwhile, the slot is released once it gets one.
+    """
+    lane = _lane_for(cost)
+    if lane is None:
+        yield
+        return
+
+    acquiring = asyncio.ensure_future(
+        sync_to_async(lane.acquire, thread_sensitive=False)(settings.ADMISSION_QUEUE_TIMEOUT))
+    try:
+        with timing.stage("queue"):
+            await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(_release_acquired(lane))
+        raise
+    try:
+        yield
+    finally:
+        lane.release()
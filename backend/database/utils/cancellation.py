@@ -0,0 +1,226 @@
+"""
+Cooperative cancellation of correlation computations whose result nobody will read.
+
+Each correlation request runs with a cancellation token (see `active`). The correlation
+loops call `check()` between chunks of work, which raises `Cancelled` once the token is
+tripped, so the request stops without caching a result. A token is tripped when:
+- the same query session (a browser tab, identified by the `session` query parameter)
+  submits a new query, which supersedes the one still running;
+- the client goes away: the async view is cancelled by the ASGI server when the client
+  disconnects, and the browser reports closed tabs to /api/correlations/cancel/.
+
+Sessions are also tracked in the cache, so a query running in another process notices
+it was superseded (within POLL_INTERVAL) when the cache is shared (Redis). Async views use
+`aactive` and `acheck`, which reach the cache without blocking the event loop.
+"""
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from django.core.cache import cache
+
+from . import metrics
+
+# Seconds between checks of the shared cache for a newer query of the same session
+POLL_INTERVAL = 0.5
+# Seconds a session's latest query id is kept in the cache
+SESSION_TTL = 3600
+# Status of the (unread) response to a cancelled request, as in nginx's "client closed request"
+CANCELLED_STATUS = 499
+
+# Token of the request currently being served (None outside of a cancellable request)
+_current_token = contextvars.ContextVar("cancellation_token", default=None)
+
+# Token of the query currently running for each session in this process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    """Raised by `check()` when the current request was cancelled."""
+
+
+def _session_key(session: str) -> str:
+    return f"query-session:{session}"
+
+
+class Token:
+    """
+    Cancellation state of one request. Tripped with `cancel`, from any thread.
+    Also records how far the computation got, to estimate the CPU time saved by stopping it.
+    """
+
+    def __init__(self, session: str = None):
+        self.id = uuid.uuid4().hex
+        self.session = session
+        self.reason = None
+        self.done = 0
+        self.total = 0
+        self._event = threading.Event()
+        # CPU time between checks, per thread: thread ident -> [thread_time at its last check, seconds]
+        self._cpu = {}
+        self._next_poll = 0.0
+        self._reported = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def _poll_due(self) -> bool:
+        """Whether it is time to check the shared cache for a newer query of the session."""
+        now = time.monotonic()
+        if self.session is None or now < self._next_poll:
+            return False
+        self._next_poll = now + POLL_INTERVAL
+        return True
+
+    def _apply_latest(self, latest):
+        """Trip the token if `latest`, the session's entry in the cache, isn't this query."""
+        if latest is not None and latest != self.id:
+            # Either the id of a newer query, or "<reason>:<nonce>" from `cancel_session`
+            self.cancel(latest.split(":", 1)[0] if ":" in latest else "superseded")
+
+    def _progress(self, done, total):
+        self._measure_cpu()
+        if done is not None:
+            self.done, self.total = done, total
+
+    def _raise_if_cancelled(self):
+        if self._event.is_set():
+            self._report()
+            raise Cancelled(f"The query was cancelled ({self.reason}).")
+
+    def check(self, done: int = None, total: int = None):
+        """
+        Raise `Cancelled` if the token was tripped.
+
+        :param done: units of work (e.g. feature pairs) completed so far
+        :param total: units of work in the whole computation
+        """
+        self._progress(done, total)
+        if self._poll_due():
+            self._apply_latest(cache.get(_session_key(self.session)))
+        self._raise_if_cancelled()
+
+    async def acheck(self, done: int = None, total: int = None):
+        """Async version of `check`."""
+        self._progress(done, total)
+        if self._poll_due():
+            self._apply_latest(await cache.aget(_session_key(self.session)))
+        self._raise_if_cancelled()
+
+    def _measure_cpu(self):
+        """
+        Add the CPU time this thread spent since its previous check. thread_time() is per
+        thread, and the checks of one request can run in different (pool) threads.
+        """
+        now = time.thread_time()
+        # Each thread only updates its own entry
+        times = self._cpu.setdefault(threading.get_ident(), [now, 0.0])
+        if now >= times[0]:
+            times[1] += now - times[0]
+        # Otherwise the ident belongs to a new thread that reused it: start over from now
+        times[0] = now
+
+    def _report(self):
+        if self._reported:
+            return
+        self._reported = True
+        spent = sum(seconds for _, seconds in list(self._cpu.values()))
+        metrics.CANCELLATIONS.inc(reason=self.reason)
+        metrics.CANCELLED_CPU.inc(spent, kind="spent")
+        if self.done and self.total > self.done:
+            # Assume the remaining work would have gone at the same rate
+            metrics.CANCELLED_CPU.inc(spent * (self.total - self.done) / self.done, kind="saved")
+
+
+def check(done: int = None, total: int = None):
+    """`Token.check` on the current request's token. Does nothing outside a cancellable request."""
+    token = _current_token.get()
+    if token is not None:
+        token.check(done, total)
+
+
+async def acheck(done: int = None, total: int = None):
+    """Async version of `check`."""
+    token = _current_token.get()
+    if token is not None:
+        await token.acheck(done, total)
+
+
+def current():
+    """Token of the current request, or None."""
+    return _current_token.get()
+
+
+@contextmanager
+def active(session: str = None):
+    """
+    Run the block as a cancellable request of query session `session` (optional),
+    superseding the query the session is still running, if any.
+    """
+    token = _start(session)
+    if session:
+        cache.set(_session_key(session), token.id, timeout=SESSION_TTL)
+
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+        _finish(token)
+
+
+@asynccontextmanager
+async def aactive(session: str = None):
+    """Async version of `active`."""
+    token = _start(session)
+    reset = _current_token.set(token)
+    try:
+        if session:
+            await cache.aset(_session_key(session), token.id, timeout=SESSION_TTL)
+        yield token
+    finally:
+        _current_token.reset(reset)
+        _finish(token)
+
+
+def _start(session: str) -> Token:
+    """New token for a query of `session`, superseding the session's query still running in this process."""
+    token = Token(session)
+    if session:
+        with _sessions_lock:
+            previous = _sessions.get(session)
+            _sessions[session] = token
+        if previous is not None:
+            previous.cancel("superseded")
+    return token
+
+
+def _finish(token: Token):
+    if token.session:
+        with _sessions_lock:
+            if _sessions.get(token.session) is token:
+                del _sessions[token.session]
+
+
+def cancel_session(session: str, reason: str = "disconnect") -> bool:
+    """
+    Cancel the query running for `session`, in this process and (through the cache) in others.
+
+    :returns: whether a query of the session was running in this process
+    """
+    with _sessions_lock:
+        token = _sessions.get(session)
+    if token is not None:
+        token.cancel(reason)
+    # No query will ever have this id, so queries of the session in other processes stop
+    cache.set(_session_key(session), f"{reason}:{uuid.uuid4().hex}", timeout=SESSION_TTL)
+    return token is not None
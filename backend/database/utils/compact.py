@@ -0,0 +1,28 @@
+"""
+Compact representation of feature values: float32 instead of float64 matrices. Categorical
+features are stored the same way, since their levels are small integer codes (at most
+CAT_MAX_LEVELS, see `utils.ingest`), which float32 holds exactly. Used by compact snapshots
+(`manage.py build_matrix_snapshot --compact`); see `manage.py benchmark_compact` for the
+memory and throughput difference.
+
+The Spearman kernels (the correlation matrix endpoint and the neighbour graph) compute in
+float32 on the ranks stored in the snapshot, which are taken from the float64 values before
+rounding (see `utils.snapshot`). Their correlations differ from the float64 ones by at most
+SPEARMAN_TOLERANCE.
+
+The other endpoints read the float32-rounded values (`FeatureMatrix.frame`) and compute in
+float64. Values that only differ beyond float32 precision become ties there, so their
+correlations are not bounded by SPEARMAN_TOLERANCE: each new tie moves rho by up to about
+6 / n² for n shared cell lines. Ranking the rounded values has the same effect, which is why
+the kernels read the stored ranks.
+"""
+import numpy as np
+
+# Largest absolute difference between Spearman correlations computed in float32 from the
+# stored ranks and in float64 from the values
+SPEARMAN_TOLERANCE = 1e-5
+
+
+def compact_values(values: np.ndarray) -> np.ndarray:
+    """float32 copy of a (n_features, n_cell_lines) value table, NaN = missing."""
+    return np.asarray(values, dtype=np.float64).astype(np.float32)
@@ -1,9 +1,15 @@
 import math
+import time
+import numpy as np
 import pandas as pd
 import warnings
 from scipy.stats import spearmanr, f_oneway, chi2_contingency
 
 from .constants import CELL_LINES
+from . import cancellation, matrix, metrics, timing
+
+# Feature pairs correlated between checks for cancellation
+CANCELLATION_CHECK_PAIRS = 64
 
 
 def _round_to_n(x, n):
@@ -14,7 +20,65 @@ def _round_to_n(x, n):
         return round(x, -int(math.floor(math.log10(abs(x)))) + (n - 1))
 
 
-def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame):
+def _per_numeric_pair(df1: pd.DataFrame, df2: pd.DataFrame, kernel) -> dict:
+    """
+    Run a vectorized `kernel(x, y)` for each numerical row `x` of `df1` against all numerical
+    rows `y` of `df2` (indexed as in `calculate_correlations`). The kernel returns a tuple
+    of per-row arrays and/or scalars.
+
+    :returns: dictionary mapping (df1 index, df2 index) to the tuple of values for that pair
+    """
+    num1 = df1[df1.index.get_level_values("datatype") == "num"]
+    num2 = df2[df2.index.get_level_values("datatype") == "num"]
+    y = num2.to_numpy(dtype=np.float64)
+
+    results = {}
+    for key1, f1_vals in num1.iterrows():
+        cancellation.check()
+        outputs = kernel(f1_vals.to_numpy(dtype=np.float64), y)
+        for i, key2 in enumerate(num2.index):
+            results[(key1, key2)] = tuple(o[i] if np.ndim(o) else o for o in outputs)
+    return results
+
+
+def _spearman_permutation_pvalues(df1: pd.DataFrame, df2: pd.DataFrame, permutations: int,
+                                  seed: int, time_budget: float) -> dict:
+    """
+    Permutation p-values for every numerical pair of rows of `df1` and `df2`, evaluated in
+    vectorized blocks. All rows of `df1` share the same `time_budget` (in seconds).
+
+    :returns: dictionary mapping (df1 index, df2 index) to (pvalue, permutations completed)
+    """
+    deadline = time.perf_counter() + time_budget if time_budget else None
+    return _per_numeric_pair(df1, df2, lambda x, y: matrix.spearman_permutation_pvalues(
+        x, y, permutations, seed=seed, deadline=deadline))
+
+
+def _spearman_bootstrap_cis(df1: pd.DataFrame, df2: pd.DataFrame, resamples: int, seed: int,
+                            confidence: float, max_bytes: int) -> dict:
+    """
+    Bootstrap confidence intervals for every numerical pair of rows of `df1` and `df2`.
+
+    :returns: dictionary mapping (df1 index, df2 index) to (low, high)
+    """
+    return _per_numeric_pair(df1, df2, lambda x, y: matrix.spearman_bootstrap_ci(
+        x, y, resamples, seed=seed, confidence=confidence, max_bytes=max_bytes))
+
+
+def _partial_correlations(df1: pd.DataFrame, df2: pd.DataFrame, covariates: np.ndarray) -> dict:
+    """
+    Spearman partial correlations controlling for `covariates` for every numerical pair of
+    rows of `df1` and `df2`, all rows of `df2` at once.
+
+    :returns: dictionary mapping (df1 index, df2 index) to (rho, pvalue, count)
+    """
+    return _per_numeric_pair(df1, df2, lambda x, y: matrix.partial_spearman(x, y, covariates))
+
+
+def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame, permutations: int = 0,
+                           seed: int = 0, time_budget: float = None, bootstrap: int = 0,
+                           confidence: float = 0.95, bootstrap_max_bytes: int = 256 * 2 ** 20,
+                           covariates: np.ndarray = None):
     """
     Given two DataFrames `df1` and `df2`, computes the correlations between each row of
     `df1` and each row of `df2`. `df1` and `df2` are assumed to have the same columns
@@ -30,16 +94,53 @@ def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame):
     :param df2: Same columns and in the same order as `df1`
     :type df2: DataFrame
 
+    :param permutations: if greater than 0, also compute permutation p-values for the Spearman
+    correlations, which are more reliable than the asymptotic ones for small sample sizes
+    :param seed: random seed for the permutations, so results are reproducible
+    :param time_budget: maximum time in seconds to spend on permutations; fewer permutations
+    are evaluated if it runs out
+    :param bootstrap: if greater than 0, also compute percentile bootstrap confidence
+    intervals for the Spearman correlations using this many resamples
+    :param confidence: confidence level of the bootstrap intervals
+    :param bootstrap_max_bytes: memory cap for the resampled arrays
+    :param covariates: if given, (n_covariates, n_cell_lines) values of numerical features to
+    control for, in the same column order as `df1`; also computes Spearman partial correlations
+
     :rtype: DataFrame
     :returns: DataFrame with the following columns:
     database_1, subcategory_1, feature_1, database_2, subcategory_2, feature_2,
     count (number of non-NaN values used for the correlation),
-    <type>_correlation (if applicable), <type>_p-value
+    <type>_correlation (if applicable), <type>_p-value.
+    With permutations, the Spearman DataFrame also has spearman_perm_pvalue and
+    permutations (the number of permutations actually evaluated).
+    With bootstrap, it also has spearman_ci_low and spearman_ci_high.
+    With covariates, it also has partial_correlation, partial_pvalue and partial_count
+    (the number of cell lines where both features and every covariate have a value)
+    The Spearman DataFrame's attrs["permutation_seconds"] is the time spent on permutations.
     """
     # Set a multi-index based on first four columns
     df1 = df1.set_index(["database", "feature", "subcategory", "datatype"])
     df2 = df2.set_index(["database", "feature", "subcategory", "datatype"])
 
+    perm_pvalues = {}
+    permutation_seconds = 0.0
+    if permutations > 0:
+        started = time.perf_counter()
+        with timing.stage("permutations"):
+            perm_pvalues = _spearman_permutation_pvalues(df1, df2, permutations, seed, time_budget)
+        permutation_seconds = time.perf_counter() - started
+
+    bootstrap_cis = {}
+    if bootstrap > 0:
+        with timing.stage("bootstrap"):
+            bootstrap_cis = _spearman_bootstrap_cis(
+                df1, df2, bootstrap, seed, confidence, bootstrap_max_bytes)
+
+    partial = {}
+    if covariates is not None:
+        with timing.stage("partial"):
+            partial = _partial_correlations(df1, df2, covariates)
+
     spearman_results = []
     anova_results = []
     chisq_results = []
@@ -49,9 +150,18 @@ def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame):
         warnings.simplefilter("ignore")
 
         # Outer loop only runs once since correlating one feature against many
-        for (db1, f1_name, f1_subcategory, f1_type), f1_vals in df1.iterrows():
+        total = len(df1) * len(df2)
+        done = 0
+        for key1, f1_vals in df1.iterrows():
+            db1, f1_name, f1_subcategory, f1_type = key1
             # Inner loop runs as many times as there are features
-            for (db2, f2_name, f2_subcategory, f2_type), f2_vals in df2.iterrows():
+            for key2, f2_vals in df2.iterrows():
+                db2, f2_name, f2_subcategory, f2_type = key2
+
+                # Stop if nobody is waiting for the result anymore
+                if done % CANCELLATION_CHECK_PAIRS == 0:
+                    cancellation.check(done, total)
+                done += 1
 
                 valid_data = pd.concat([f1_vals, f2_vals], axis=1).dropna()
                 count = valid_data.shape[0]  # Number of valid data points
@@ -75,8 +185,18 @@ def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame):
                     if (spearman_corr is not None and math.isfinite(spearman_corr)) and (spearman_pvalue is not None and math.isfinite(spearman_pvalue)):
                         spearman_corr = _round_to_n(spearman_corr, 3)
                         spearman_pvalue = _round_to_n(spearman_pvalue, 3)
-                        spearman_results.append(
-                            [db1, f1_subcategory, f1_name, db2, f2_subcategory, f2_name, count, spearman_corr, spearman_pvalue])
+                        row = [db1, f1_subcategory, f1_name, db2, f2_subcategory, f2_name, count, spearman_corr, spearman_pvalue]
+                        if permutations > 0:
+                            perm_pvalue, completed = perm_pvalues.get((key1, key2), (math.nan, 0))
+                            row += [_round_to_n(perm_pvalue, 3) if math.isfinite(perm_pvalue) else None, completed]
+                        if bootstrap > 0:
+                            ci = bootstrap_cis.get((key1, key2), (math.nan, math.nan))
+                            row += [_round_to_n(v, 3) if math.isfinite(v) else None for v in ci]
+                        if covariates is not None:
+                            partial_corr, partial_pvalue, partial_count = partial.get((key1, key2), (math.nan, math.nan, 0))
+                            row += [_round_to_n(v, 3) if math.isfinite(v) else None for v in (partial_corr, partial_pvalue)]
+                            row.append(int(partial_count))
+                        spearman_results.append(row)
 
                 # ANOVA: one categorical, one numerical
                 elif (f1_type == "cat" and f2_type == "num") or (f1_type == "num" and f2_type == "cat"):
@@ -108,13 +228,26 @@ def calculate_correlations(df1: pd.DataFrame, df2: pd.DataFrame):
                         except:
                             continue
 
+    spearman_columns = ["database_1", "subcategory_1", "feature_1", "database_2",
+                        "subcategory_2", "feature_2", "count",
+                        "spearman_correlation", "spearman_pvalue"]
+    if permutations > 0:
+        spearman_columns += ["spearman_perm_pvalue", "permutations"]
+    if bootstrap > 0:
+        spearman_columns += ["spearman_ci_low", "spearman_ci_high"]
+    if covariates is not None:
+        spearman_columns += ["partial_correlation", "partial_pvalue", "partial_count"]
+
+    spearman_df = pd.DataFrame(spearman_results, columns=spearman_columns)
+    # Keep undefined optional values as None (a float column would turn them into NaN, which isn't valid JSON)
+    for column in ["spearman_perm_pvalue", "spearman_ci_low", "spearman_ci_high", "partial_correlation", "partial_pvalue"]:
+        if column in spearman_df:
+            spearman_df[column] = spearman_df[column].astype(object).where(spearman_df[column].notna(), None)
+    # For callers that share one time budget across several calls (see `streaming.CorrelationStream`)
+    spearman_df.attrs["permutation_seconds"] = permutation_seconds
+
     return {
-        "spearman": pd.DataFrame(
-            spearman_results,
-            columns=["database_1", "subcategory_1", "feature_1", "database_2",
-                     "subcategory_2", "feature_2", "count",
-                     "spearman_correlation", "spearman_pvalue"]
-        ),
+        "spearman": spearman_df,
         "anova": pd.DataFrame(
             anova_results,
             columns=["database_1", "subcategory_1", "feature_1", "database_2",
@@ -139,31 +272,122 @@ def get_feature_values(db_dict: dict, feature_to_subcategory: dict, feature_to_d
     :param feature_to_subcategory: dictionary mapping each feature to its subcategory
     :param feature_to_datatype: dictionary mapping each feature to its data type (num, cat)
     """
-    df_list = []
+    rows_dict = {}
 
     for key in db_dict.keys():
-        tmp_queryset = db_dict[key].values_list()
-        if len(tmp_queryset) == 0:
+        with timing.stage("orm"):
+            rows_dict[key] = list(db_dict[key].values_list())
+        metrics.ROWS_SCANNED.inc(len(rows_dict[key]), table=key, source="db")
+        timing.count("rows_scanned", len(rows_dict[key]))
+
+    return build_feature_frame(rows_dict, feature_to_subcategory, feature_to_datatype)
+
+
+def _as_frame(rows) -> pd.DataFrame:
+    """Accept either `values_list()` tuples or a DataFrame with columns "feature", *CELL_LINES."""
+    if isinstance(rows, pd.DataFrame):
+        return rows.copy()
+    return pd.DataFrame(rows, columns=["feature", *CELL_LINES])
+
+
+def mask_cell_lines(values, cell_lines):
+    """
+    Set the values of cell lines outside the subset `cell_lines` to NaN, so that every
+    correlation only uses (and only re-ranks) the selected cell lines.
+
+    :param values: DataFrame with CELL_LINES columns, or a float array with one column per cell line
+    :param cell_lines: selected cell lines, or None for all (returns `values` unchanged)
+    """
+    if cell_lines is None:
+        return values
+    excluded = [c for c in CELL_LINES if c not in set(cell_lines)]
+    if isinstance(values, pd.DataFrame):
+        values = values.copy()
+        values[excluded] = np.nan
+    else:
+        values = np.array(values, dtype=np.float64)
+        values[:, [CELL_LINES.index(c) for c in excluded]] = np.nan
+    return values
+
+
+def build_feature_frame(rows_dict: dict, feature_to_subcategory: dict, feature_to_datatype: dict,
+                        cell_lines: list = None) -> pd.DataFrame:
+    """
+    Same as `get_feature_values`, but takes rows that have already been fetched.
+    Does not touch the database, so it is safe to run in a worker thread.
+
+    :param rows_dict: dictionary mapping each database (Nuclear, Molecular, Drug Screen)
+    to a list of `values_list()` tuples (feature, *CELL_LINES), or to a DataFrame with
+    columns "feature", *CELL_LINES (see `store.fetch_values`)
+    :param cell_lines: only use this subset of cell lines (others are set to NaN)
+    """
+    df_list = []
+
+    for key, rows in rows_dict.items():
+        if len(rows) == 0:
             continue
 
-        # Converting to a dataframe
-        tmp_df = pd.DataFrame(list(tmp_queryset), columns=["feature", *CELL_LINES])
+        with timing.stage("dataframe"):
+            # Converting to a dataframe
+            tmp_df = _as_frame(rows)
 
-        # Adding the database information to the row
-        tmp_df["database"] = key
+            # Adding the database information to the row
+            tmp_df["database"] = key
 
-        tmp_df["subcategory"] = tmp_df["feature"].map(feature_to_subcategory)
-        tmp_df["datatype"] = tmp_df["feature"].map(feature_to_datatype)
+            tmp_df["subcategory"] = tmp_df["feature"].map(feature_to_subcategory)
+            tmp_df["datatype"] = tmp_df["feature"].map(feature_to_datatype)
 
-        # Moving it so that its the first column
-        col = tmp_df.pop('database')
-        tmp_df.insert(0, "database", col)
+            # Moving it so that its the first column
+            col = tmp_df.pop('database')
+            tmp_df.insert(0, "database", col)
 
         df_list.append(tmp_df)
 
-    # Combine all the dataframes in the list
-    df = pd.concat(df_list, ignore_index=True)
+    # Every requested feature was skipped (e.g. pruned as degenerate) or has no values
+    if not df_list:
+        return pd.DataFrame(columns=["database", "feature", *CELL_LINES, "subcategory", "datatype"])
+
+    with timing.stage("dataframe"):
+        # Combine all the dataframes in the list
+        df = pd.concat(df_list, ignore_index=True)
 
-    # Filtering the columns where the values for CELL_LINE are 0
-    df_filtered = df.loc[~(df[CELL_LINES] == 0).all(axis=1)]
+        df = mask_cell_lines(df, cell_lines)
+
+        # Filtering the columns where the values for CELL_LINE are 0
+        df_filtered = df.loc[~(df[cell_lines or CELL_LINES] == 0).all(axis=1)]
     return df_filtered
+
+
+def build_scatter_records(f1_rows: list, f2_rows: list, f1_name: str, f2_name: str,
+                          cell_lines: list = None) -> list:
+    """
+    Pair up the values of two features by cell line for a scatter plot.
+
+    :param f1_rows: `values_list()` tuples (feature, *CELL_LINES) or DataFrame for feature 1
+    :param f2_rows: `values_list()` tuples (feature, *CELL_LINES) or DataFrame for feature 2
+    :param cell_lines: only include this subset of cell lines
+
+    :returns: list of records {"cell_lines": ..., f1_name: ..., f2_name: ...},
+    skipping cell lines where either value is missing
+    """
+    with timing.stage("dataframe"):
+        f1_df = mask_cell_lines(_as_frame(f1_rows), cell_lines)
+        f2_df = mask_cell_lines(_as_frame(f2_rows), cell_lines)
+
+        # Merge the two DataFrames by column
+        merged_df = pd.concat([f1_df, f2_df], axis=0)
+
+        # Transpose the merged DataFrame
+        transposed_df = merged_df.T.reset_index()
+        transposed_df.columns = ["cell_lines"] + \
+            [f"{f1_name}", f"{f2_name}"]  # Rename columns
+
+        # Remove redundnant first row
+        transposed_df = transposed_df.iloc[1:].reset_index(drop=True)
+
+        # Drop columns with na values
+        transposed_df = transposed_df.dropna(axis=0)
+
+    with timing.stage("serialize"):
+        # Convert the transposed DataFrame to a JSON-compatible format
+        return transposed_df.to_dict(orient="records")
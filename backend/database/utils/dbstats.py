@@ -0,0 +1,54 @@
+from django.db import connections
+
+from . import metrics
+
+CONNECTIONS_OPENED = metrics.REGISTRY.counter(
+    "db_connections_opened_total",
+    "Database connections opened, or checked out of the pool when pooling is enabled.")
+
+# psycopg_pool statistics exposed as gauges (see ConnectionPool.get_stats())
+POOL_STATS = {
+    "pool_min": metrics.REGISTRY.gauge(
+        "db_pool_min_size", "Minimum number of connections kept in the pool."),
+    "pool_max": metrics.REGISTRY.gauge(
+        "db_pool_max_size", "Maximum number of connections in the pool."),
+    "pool_size": metrics.REGISTRY.gauge(
+        "db_pool_size", "Connections currently managed by the pool (in use or idle)."),
+    "pool_available": metrics.REGISTRY.gauge(
+        "db_pool_available", "Idle connections available in the pool."),
+    "requests_waiting": metrics.REGISTRY.gauge(
+        "db_pool_requests_waiting", "Requests currently waiting for a connection."),
+    "requests_queued": metrics.REGISTRY.gauge(
+        "db_pool_requests_queued", "Requests that had to wait for a connection since startup."),
+    "requests_wait_ms": metrics.REGISTRY.gauge(
+        "db_pool_requests_wait_ms", "Total time spent waiting for a connection since startup."),
+    "requests_errors": metrics.REGISTRY.gauge(
+        "db_pool_requests_errors", "Connection requests that failed (e.g. timed out) since startup."),
+    "connections_num": metrics.REGISTRY.gauge(
+        "db_pool_connections_opened", "Physical connections opened by the pool since startup."),
+}
+
+POOL_IN_USE = metrics.REGISTRY.gauge(
+    "db_pool_in_use", "Connections currently checked out of the pool.")
+
+
+def count_connection(sender, connection, **kwargs):
+    """`connection_created` receiver counting new connections per database alias."""
+    CONNECTIONS_OPENED.inc(alias=connection.alias)
+
+
+def collect_pool_stats():
+    """Refresh the pool gauges for every database alias that uses a psycopg pool."""
+    for alias in connections:
+        conn = connections[alias]
+        if conn.vendor != "postgresql" or not conn.settings_dict["OPTIONS"].get("pool"):
+            continue
+
+        stats = conn.pool.get_stats()
+        for key, gauge in POOL_STATS.items():
+            if key in stats:
+                gauge.set(stats[key], alias=alias)
+        POOL_IN_USE.set(stats.get("pool_size", 0) - stats.get("pool_available", 0), alias=alias)
+
+
+metrics.REGISTRY.register_collector(collect_pool_stats)
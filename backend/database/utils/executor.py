@@ -0,0 +1,32 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Bounded pool for CPU-bound correlation work, created on first use.
+    Its size caps how many heavy computations run at once in this process,
+    so they cannot starve the event loop serving lightweight requests.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.CORRELATION_WORKERS, thread_name_prefix="correlation")
+    return _executor
+
+
+async def run_cpu_bound(func, *args, **kwargs):
+    """
+    Run `func(*args, **kwargs)` in the correlation pool and await its result.
+    The caller's context is copied so request timings are still recorded.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(), call)
@@ -0,0 +1,216 @@
+"""
+Helpers for loading feature values (see `manage.py loadfile`).
+"""
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .stats import distinct_counts
+
+
+def value_hashes(values: np.ndarray) -> list:
+    """
+    Hash of each row of a value table, to detect which features changed between imports.
+    Missing values hash the same whether they come from NaN or NULL.
+
+    :param values: (n_features, n_cell_lines) float matrix, NaN = missing
+    """
+    values = np.array(values, dtype=np.float64)
+    # One canonical NaN, and 0.0 == -0.0
+    values[np.isnan(values)] = np.nan
+    values += 0.0
+    return [hashlib.md5(row.tobytes()).hexdigest() for row in np.ascontiguousarray(values)]
+
+
+# Columns of the CSV files, before the cell line columns
+METADATA_COLUMNS = ["Feature", "Data_Type", "Category", "Sub_Category"]
+
+# Rows of a workbook sheet loaded per batch
+SHEET_CHUNK_ROWS = 2000
+
+DATA_TYPES = ("num", "cat")
+
+# Largest number of levels of a categorical ("cat") feature
+CAT_MAX_LEVELS = 10
+
+# Text read as a missing value (lower case), as `pd.read_csv` does for CSV files
+MISSING_VALUES = ["", "na", "n/a", "nan", "null", "none", "#n/a"]
+
+
+def parse_sheet_mapping(value: str) -> tuple:
+    """
+    Parse a "SHEET=CATEGORY[:SUB_CATEGORY]" mapping (the sub_category defaults to the sheet name).
+
+    :returns: (sheet, category, sub_category)
+    """
+    sheet, sep, target = value.partition("=")
+    category, _, sub_category = target.partition(":")
+    if not sep or not sheet or not category:
+        raise ValueError(f"Invalid sheet mapping '{value}' (expected SHEET=CATEGORY[:SUB_CATEGORY]).")
+    return sheet, category, sub_category or sheet
+
+
+def sheet_layout(header, cell_lines, defaults=None) -> dict:
+    """
+    Layout of a workbook sheet in the format of the CSV files: the feature name in the first
+    column, optional Data_Type, Category and Sub_Category columns, and one column per cell line.
+
+    :param header: values of the sheet's first row
+    :param cell_lines: known cell lines; other columns are ignored
+    :param defaults: dictionary of values for the metadata columns the sheet doesn't have
+    :returns: dictionary with keys "metadata" (column index, or default value, of each of
+    METADATA_COLUMNS after the first) and "cell_lines" (dictionary mapping cell lines to column indices)
+    """
+    names = [str(h).strip() if h is not None else "" for h in (header or ())]
+    if not names:
+        raise ValueError("The sheet is empty.")
+
+    lower = {name.lower(): i for i, name in enumerate(names)}
+    defaults = defaults or {}
+    metadata = {}
+    for column in METADATA_COLUMNS[1:]:
+        if column.lower() in lower:
+            metadata[column] = lower[column.lower()]
+        elif column in defaults:
+            metadata[column] = defaults[column]
+        else:
+            raise ValueError(f"The sheet has no {column} column; map it to a category and sub_category.")
+
+    known = set(cell_lines)
+    columns = {name: i for i, name in enumerate(names) if name in known}
+    if not columns:
+        raise ValueError("None of the sheet's columns are known cell lines.")
+    return {"metadata": metadata, "cell_lines": columns}
+
+
+def sheet_chunks(rows, layout: dict, chunk_rows: int = SHEET_CHUNK_ROWS):
+    """
+    Convert an iterator of sheet rows (after the header) to DataFrames of at most `chunk_rows`
+    rows with columns METADATA_COLUMNS and the sheet's cell line columns, as read from a CSV file.
+    Only one chunk is held in memory at a time. Rows without a feature name are skipped.
+    """
+    def to_frame(chunk):
+        df = pd.DataFrame({"Feature": [str(row[0]).strip() for row in chunk]})
+        for column, source in layout["metadata"].items():
+            df[column] = [row[source] for row in chunk] if isinstance(source, int) else source
+        # Values are converted (and checked) by `validate_frame`
+        for cell_line, i in layout["cell_lines"].items():
+            df[cell_line] = [row[i] if i < len(row) else None for row in chunk]
+        return df
+
+    chunk = []
+    for row in rows:
+        if not row or row[0] is None or not str(row[0]).strip():
+            continue
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield to_frame(chunk)
+            chunk = []
+    if chunk:
+        yield to_frame(chunk)
+
+
+def infer_data_types(values: np.ndarray) -> np.ndarray:
+    """
+    Data type of each row of a float matrix (NaN = missing) from its values: "cat" for
+    integer codes with at most CAT_MAX_LEVELS levels, "num" otherwise.
+    """
+    return np.where(_categorical(values), "cat", "num")
+
+
+def _categorical(values: np.ndarray) -> np.ndarray:
+    """Whether each row holds integer codes with at most CAT_MAX_LEVELS levels."""
+    with np.errstate(invalid="ignore"):
+        integral = ((values == np.round(values)) | np.isnan(values)).all(axis=1)
+    return integral & (distinct_counts(values) <= CAT_MAX_LEVELS)
+
+
+def validate_frame(df: pd.DataFrame, category: str, cell_lines) -> tuple:
+    """
+    Check rows in the layout of the CSV files (METADATA_COLUMNS, then one column per cell line)
+    before loading them into the table of `category`. Every check runs on whole columns at once.
+
+    Rows are rejected when their feature name is missing or repeated, their category isn't
+    `category`, a value isn't a finite number, or they are declared "cat"
+    but don't hold integer codes with at most CAT_MAX_LEVELS levels. Missing or unknown data
+    types are inferred from the values (see `infer_data_types`).
+
+    :param cell_lines: known cell lines; other value columns are ignored
+    :returns: (valid, rejects, warnings): the valid rows with columns METADATA_COLUMNS + `cell_lines`
+    and float values, the rejected rows as given with a "reason" column, and messages about
+    the whole frame (e.g. ignored columns)
+    """
+    if df.shape[1] < len(METADATA_COLUMNS):
+        raise ValueError(f"Expected the columns {', '.join(METADATA_COLUMNS)} before the cell line columns.")
+
+    warnings = []
+    headers = [str(c).strip() for c in df.columns[len(METADATA_COLUMNS):]]
+    known = set(cell_lines)
+    unknown = [h for h in headers if h not in known]
+    if unknown:
+        warnings.append(f"Ignoring {len(unknown)} columns that aren't known cell lines: {', '.join(unknown[:5])}"
+                        + (", ..." if len(unknown) > 5 else ""))
+    missing = len(known - set(headers))
+    if missing:
+        warnings.append(f"{missing} cell lines have no column and are loaded as missing values.")
+
+    metadata = df.iloc[:, :len(METADATA_COLUMNS)].copy()
+    metadata.columns = METADATA_COLUMNS
+    for column in METADATA_COLUMNS:
+        metadata[column] = metadata[column].astype("string").str.strip()
+    metadata["Sub_Category"] = metadata["Sub_Category"].fillna("NA")
+
+    raw = df.iloc[:, len(METADATA_COLUMNS):].set_axis(headers, axis=1)
+    raw = raw.loc[:, [h in known for h in headers] & ~raw.columns.duplicated()]
+    # Only text columns need parsing (and can hold something other than a number)
+    text = np.array([not pd.api.types.is_numeric_dtype(dtype) for dtype in raw.dtypes], dtype=bool)
+    numeric = raw.astype({c: np.float64 for c, t in zip(raw.columns, text) if not t})
+    bad = np.zeros(raw.shape, dtype=bool)
+    if text.any():
+        parsed = raw.loc[:, text].apply(pd.to_numeric, errors="coerce").astype(np.float64)
+        cells = raw.loc[:, text].apply(lambda c: c.astype("string").str.strip().str.lower())
+        bad[:, text] = (parsed.isna() & ~(cells.isna() | cells.isin(MISSING_VALUES))).to_numpy()
+        numeric[parsed.columns] = parsed
+    bad |= np.isinf(numeric.to_numpy(dtype=np.float64))
+
+    values = numeric.reindex(columns=list(cell_lines)).to_numpy(dtype=np.float64, copy=True)
+    values[np.isinf(values)] = np.nan
+
+    data_types = metadata["Data_Type"].str.lower()
+    declared = data_types.isin(DATA_TYPES).to_numpy(dtype=bool)
+    categorical = _categorical(values)
+    inferred = np.where(categorical, "cat", "num")
+    invalid_cat = data_types.eq("cat").fillna(False).to_numpy(dtype=bool) & ~categorical
+    if (~declared).any():
+        warnings.append(f"Inferred the data type of {int((~declared).sum())} features from their values.")
+    empty = int(np.isnan(values).all(axis=1).sum())
+    if empty:
+        warnings.append(f"{empty} features have no values.")
+
+    checks = [
+        (metadata["Feature"].fillna("").eq("").to_numpy(dtype=bool), "missing feature name"),
+        (metadata["Feature"].duplicated().to_numpy(dtype=bool), "duplicate feature"),
+        (metadata["Category"].ne(category).fillna(True).to_numpy(dtype=bool), f"category is not {category}"),
+        (bad.any(axis=1), "values that aren't finite numbers"),
+        (invalid_cat, f"declared cat but not integer codes with at most {CAT_MAX_LEVELS} levels"),
+    ]
+    rejected = np.zeros(len(df), dtype=bool)
+    reasons = np.full(len(df), "", dtype=object)
+    for failed, reason in checks:
+        reasons[failed & ~rejected] = reason
+        rejected |= failed
+
+    metadata["Data_Type"] = np.where(declared, data_types.fillna(""), inferred)
+    valid = pd.concat([metadata, pd.DataFrame(values, columns=list(cell_lines), index=df.index)], axis=1)
+    rejects = df.assign(reason=reasons)[rejected]
+    return valid[~rejected], rejects, warnings
+
+
+def write_rejects(rejects: pd.DataFrame, path: Path):
+    """Append rejected rows to the CSV file `path`, writing the header if the file is new."""
+    if rejects.empty:
+        return
+    rejects.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
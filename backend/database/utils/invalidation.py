@@ -0,0 +1,104 @@
+"""
+Targeted invalidation of cached results when feature values change.
+
+Cache keys are hashes of the requests, so the entries that involve a given feature can't be
+listed. Instead, every import that changes features (`manage.py loadfile --incremental`)
+bumps a data epoch and appends the changed features to a journal kept in the cache.
+Results are cached together with the epoch they were computed at, and on a hit the
+result is only discarded if a later journal entry changed one of the request's features,
+so a refresh that touches a few features keeps every other cached result.
+
+With the local memory cache each process has its own cache, which an import run from
+another process can't reach; use Redis to invalidate across processes.
+"""
+from django.core.cache import cache
+
+EPOCH_KEY = "data:epoch"
+JOURNAL_KEY = "data:journal"
+
+# Number of imports kept in the journal. Results older than the journal are discarded
+JOURNAL_SIZE = 100
+
+
+def current_epoch() -> int:
+    """Epoch of the data currently loaded. Read it before fetching values and pass it to `set_result`."""
+    return cache.get(EPOCH_KEY, 0)
+
+
+def record_changes(names) -> int:
+    """Record that the features `names` changed. Returns the new epoch."""
+    names = sorted(set(names))
+    state = cache.get_many([EPOCH_KEY, JOURNAL_KEY])
+    if not names:
+        return state.get(EPOCH_KEY, 0)
+
+    epoch = state.get(EPOCH_KEY, 0) + 1
+    journal = (state.get(JOURNAL_KEY, []) + [(epoch, names)])[-JOURNAL_SIZE:]
+    cache.set_many({EPOCH_KEY: epoch, JOURNAL_KEY: journal}, timeout=None)
+    return epoch
+
+
+def invalidate_all() -> int:
+    """Discard every cached result, e.g. after replacing the whole dataset. Returns the new epoch."""
+    epoch = cache.get(EPOCH_KEY, 0) + 1
+    # An empty journal can't vouch for any entry older than the epoch
+    cache.set_many({EPOCH_KEY: epoch, JOURNAL_KEY: []}, timeout=None)
+    return epoch
+
+
+def _is_stale(entry_epoch: int, names, state: dict) -> bool:
+    epoch = state.get(EPOCH_KEY, 0)
+    if entry_epoch >= epoch:
+        return False
+    journal = state.get(JOURNAL_KEY, [])
+    # Some changes since the entry was computed are no longer in the journal
+    if not journal or journal[0][0] > entry_epoch + 1:
+        return True
+    names = set(names)
+    return any(changed_epoch > entry_epoch and not names.isdisjoint(changed)
+               for changed_epoch, changed in journal)
+
+
+def _unwrap(entry, names, state: dict):
+    """(value, stale) of a cache entry written by `set_result`. Entries in another format are misses."""
+    if not isinstance(entry, dict) or "epoch" not in entry:
+        return None, False
+    if _is_stale(entry["epoch"], names, state):
+        return None, True
+    return entry["value"], False
+
+
+def get_result(key: str, names):
+    """
+    Cached result under `key`, or None if there is none or one of the features `names`
+    it was computed from changed since.
+    """
+    state = cache.get_many([key, EPOCH_KEY, JOURNAL_KEY])
+    value, stale = _unwrap(state.get(key), names, state)
+    if stale:
+        cache.delete(key)
+    return value
+
+
+def set_result(key: str, value, epoch: int, timeout: int):
+    """Cache `value`, computed from the data of `epoch`, under `key`."""
+    cache.set(key, {"epoch": epoch, "value": value}, timeout=timeout)
+
+
+async def aget_result(key: str, names):
+    """Async version of `get_result`."""
+    state = await cache.aget_many([key, EPOCH_KEY, JOURNAL_KEY])
+    value, stale = _unwrap(state.get(key), names, state)
+    if stale:
+        await cache.adelete(key)
+    return value
+
+
+async def acurrent_epoch() -> int:
+    """Async version of `current_epoch`."""
+    return await cache.aget(EPOCH_KEY, 0)
+
+
+async def aset_result(key: str, value, epoch: int, timeout: int):
+    """Async version of `set_result`."""
+    await cache.aset(key, {"epoch": epoch, "value": value}, timeout=timeout)
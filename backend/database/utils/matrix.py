@@ -0,0 +1,554 @@
+"""
+Vectorized many-vs-many correlation kernels.
+
+Spearman correlations are computed over the pairwise-complete cell lines of each pair of
+features, exactly like `scipy.stats.spearmanr` on the pair with NaNs dropped. Instead of
+looping over pairs, features are grouped by their missing-value pattern: every pair of groups
+shares the same set of cell lines, so both groups are re-ranked on those cell lines once and
+the whole block of correlations is a single matrix product.
+"""
+import json
+import struct
+import time
+import warnings
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.stats import rankdata, t as t_dist
+
+from . import cancellation
+
+# Fewer shared non-NaN values than this and the correlation is left undefined
+MIN_COUNT = 3
+
+# Permutations evaluated per block, and the largest (permutations x features) block of
+# null correlations held in memory at once
+PERMUTATION_BLOCK = 256
+PERMUTATION_MAX_CELLS = 4_000_000
+
+# Largest (rows x features) block of candidate scores held in memory at once by `nearest_neighbors`
+NEIGHBOR_BLOCK_CELLS = 4_000_000
+# Candidates per neighbour re-scored exactly by `nearest_neighbors`
+NEIGHBOR_OVERSAMPLE = 4
+# Largest (pairs x values) block re-ranked at once by `column_correlations`
+PAIR_BLOCK_CELLS = 1_000_000
+
+COLUMN_METHODS = ("spearman", "pearson")
+
+
+def group_by_mask(mask: np.ndarray):
+    """
+    Group rows of a boolean mask by identical pattern.
+
+    :returns: (patterns, groups) where patterns[g] is the mask of group g and
+    groups[g] is the array of row indices in that group
+    """
+    if len(mask) == 0:
+        return np.zeros((0, mask.shape[1]), dtype=bool), []
+    patterns, inverse = np.unique(mask, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(patterns)))[:-1]
+    return patterns, np.split(order, bounds)
+
+
+def standardized_ranks(values: np.ndarray) -> np.ndarray:
+    """
+    Rank each row (ties averaged), then center and scale it to unit norm, so that the
+    dot product of two rows is their Spearman correlation. Constant rows become NaN.
+    """
+    ranks = rankdata(values, axis=1)
+    ranks -= ranks.mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ranks /= np.linalg.norm(ranks, axis=1, keepdims=True)
+    return ranks
+
+
+def pair_counts(mask1: np.ndarray, mask2: np.ndarray) -> np.ndarray:
+    """Number of cell lines where both features have a value, for every pair."""
+    return (mask1.astype(np.float32) @ mask2.T.astype(np.float32)).astype(np.int32)
+
+
+def spearman_matrix(x: np.ndarray, y: np.ndarray, min_count: int = MIN_COUNT):
+    """
+    Spearman correlation of every row of `x` against every row of `y`, over the columns
+    where both rows are non-NaN.
+
+    :param x: (n1, n_cell_lines) float matrix, NaN = missing
+    :param y: (n2, n_cell_lines) float matrix, NaN = missing
+
+    If both inputs are float32 (see `utils.compact`), the rank products are computed in
+    float32 as well, which is faster and within `compact.SPEARMAN_TOLERANCE` of float64.
+
+    :returns: (rho, count), both of shape (n1, n2). rho is NaN where count < `min_count`
+    or either feature is constant over the shared cell lines.
+    """
+    dtype = np.result_type(x.dtype, y.dtype, np.float32)
+    mask_x = ~np.isnan(x)
+    mask_y = ~np.isnan(y)
+
+    rho = np.full((len(x), len(y)), np.nan, dtype=dtype)
+    count = pair_counts(mask_x, mask_y)
+
+    patterns_x, groups_x = group_by_mask(mask_x)
+    patterns_y, groups_y = group_by_mask(mask_y)
+
+    for pattern_x, rows_x in zip(patterns_x, groups_x):
+        for pattern_y, rows_y in zip(patterns_y, groups_y):
+            shared = pattern_x & pattern_y
+            if shared.sum() < min_count:
+                continue
+
+            zx = standardized_ranks(x[np.ix_(rows_x, shared)]).astype(dtype, copy=False)
+            zy = standardized_ranks(y[np.ix_(rows_y, shared)]).astype(dtype, copy=False)
+            rho[np.ix_(rows_x, rows_y)] = zx @ zy.T
+
+    np.clip(rho, -1, 1, out=rho)
+    return rho, count
+
+
+def spearman_pvalues(rho: np.ndarray, count: np.ndarray, covariates: int = 0) -> np.ndarray:
+    """
+    Two-sided p-values for Spearman correlations, using the same t-distribution
+    approximation as `scipy.stats.spearmanr`.
+
+    :param covariates: number of covariates controlled for, for partial correlations
+    (each takes one more degree of freedom)
+    """
+    rho = np.asarray(rho, dtype=np.float64)
+    dof = (np.asarray(count) - 2 - covariates).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = rho * np.sqrt(dof / ((1.0 - rho) * (1.0 + rho)))
+        pvalue = 2 * t_dist.sf(np.abs(t), dof)
+    pvalue[np.isnan(rho)] = np.nan
+    return pvalue
+
+
+def partial_spearman(x: np.ndarray, y: np.ndarray, z: np.ndarray, min_count: int = MIN_COUNT):
+    """
+    Spearman partial correlation of `x` against every row of `y`, controlling for the rows
+    of `z`: the correlation of the residuals of the ranks of `x` and of each row after a
+    least-squares fit on the ranks of the covariates (with an intercept), over the cell lines
+    where `x`, the row and every covariate have a value.
+
+    Rows of `y` are grouped by missing-value pattern. Within a group, `x`, the rows and the
+    covariates are ranked over the same cell lines, and `x` and all the rows are residualized
+    together with a single least-squares solve against the shared design matrix.
+
+    :param x: (n_cell_lines,) float vector, NaN = missing
+    :param y: (n2, n_cell_lines) float matrix, NaN = missing
+    :param z: (n_covariates, n_cell_lines) float matrix, NaN = missing
+    :returns: (rho, pvalue, count), each of shape (n2,). rho is NaN where count is below
+    `min_count` or n_covariates + 3, or a residual is zero.
+    """
+    n2, n_covariates = len(y), len(z)
+    rho = np.full(n2, np.nan)
+    count = np.zeros(n2, dtype=np.int32)
+
+    base = ~np.isnan(x) & ~np.isnan(z).any(axis=0)
+    patterns, groups = group_by_mask(~np.isnan(y))
+    for pattern, rows in zip(patterns, groups):
+        cancellation.check()
+        shared = base & pattern
+        n = int(shared.sum())
+        count[rows] = n
+        if n < max(min_count, n_covariates + 3):
+            continue
+
+        design = np.column_stack([np.ones(n), rankdata(z[:, shared], axis=1).T])
+        targets = np.column_stack([rankdata(x[shared]), rankdata(y[np.ix_(rows, shared)], axis=1).T])
+        coef, *_ = np.linalg.lstsq(design, targets, rcond=None)
+        residuals = targets - design @ coef
+
+        norms = np.linalg.norm(residuals, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rho[rows] = residuals[:, 1:].T @ residuals[:, 0] / (norms[1:] * norms[0])
+        # Residuals that are only rounding noise (the ranks are fully explained by the covariates)
+        rho[rows[norms[1:] < 1e-9 * n]] = np.nan
+        if norms[0] < 1e-9 * n:
+            rho[rows] = np.nan
+
+    rho = np.clip(rho, -1, 1)
+    return rho, spearman_pvalues(rho, count, n_covariates), count
+
+
+def masked_correlation(x: np.ndarray, mask_x: np.ndarray, y: np.ndarray, mask_y: np.ndarray,
+                       min_count: int = MIN_COUNT):
+    """
+    Pearson correlation of every row of `x` against every row of `y`, over the columns where
+    both rows have a value, from six matrix products (the shared count and the sums of x, y,
+    x², y² and xy over the shared columns), without grouping rows by mask.
+
+    Given ranks taken once over each row's own values, this equals `spearman_matrix` for rows
+    with the same missing values and approximates it otherwise, since the ranks aren't
+    re-computed over the columns shared by each pair.
+
+    :param x: (n1, n_cell_lines) values (or ranks), 0 where missing
+    :param mask_x: (n1, n_cell_lines) float matrix, 1 where a value is present
+    :returns: (rho, count), both of shape (n1, n2). rho is NaN where count < `min_count`
+    or either row is constant over the shared columns.
+    """
+    count = mask_x @ mask_y.T
+    sum_x = x @ mask_y.T
+    sum_y = mask_x @ y.T
+    sum_xx = (x * x) @ mask_y.T
+    sum_yy = mask_x @ (y * y).T
+    sum_xy = x @ y.T
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rho = (count * sum_xy - sum_x * sum_y) / np.sqrt((count * sum_xx - sum_x ** 2) * (count * sum_yy - sum_y ** 2))
+    rho[count < min_count] = np.nan
+    np.clip(rho, -1, 1, out=rho)
+    return rho, count.astype(np.int32)
+
+
+def _spearman_pairs(x: np.ndarray, y: np.ndarray, min_count: int = MIN_COUNT):
+    """
+    Spearman correlation of each row of `x` against the rows of `y` at the same index, over
+    their shared columns, re-ranking all pairs at once instead of by mask group like
+    `spearman_matrix`, which is faster for a few pairs per row with different masks.
+
+    :param x: (n, n_cell_lines) float matrix, NaN = missing
+    :param y: (n, m, n_cell_lines) float array, NaN = missing
+    :returns: (rho, count), both of shape (n, m)
+    """
+    x = np.broadcast_to(x[:, np.newaxis, :], y.shape)
+    shared = ~np.isnan(x) & ~np.isnan(y)
+    count = shared.sum(axis=-1)
+    rx = rankdata(np.where(shared, x, np.nan), axis=-1, nan_policy="omit")
+    ry = rankdata(np.where(shared, y, np.nan), axis=-1, nan_policy="omit")
+
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        rx = np.nan_to_num(rx - np.nanmean(rx, axis=-1, keepdims=True))
+        ry = np.nan_to_num(ry - np.nanmean(ry, axis=-1, keepdims=True))
+        rho = (rx * ry).sum(axis=-1) / np.sqrt((rx * rx).sum(axis=-1) * (ry * ry).sum(axis=-1))
+    rho[count < min_count] = np.nan
+    return np.clip(rho, -1, 1), count.astype(np.int32)
+
+
+def nearest_neighbors(values: np.ndarray, k: int, min_count: int = MIN_COUNT,
+                      oversample: int = NEIGHBOR_OVERSAMPLE):
+    """
+    The `k` rows of `values` most correlated (by absolute Spearman correlation over their
+    shared columns) with each row.
+
+    Candidates are found with `masked_correlation` of the ranks in blocks of rows against all rows,
+    holding at most NEIGHBOR_BLOCK_CELLS scores at once. The `k * oversample` best candidates
+    of each row are then re-scored exactly with `spearman_matrix`, and the best `k` kept.
+
+    :param values: (n, n_cell_lines) float matrix, NaN = missing
+    :returns: (neighbors, rho, count), each of shape (n, k) and sorted by decreasing |rho|.
+    neighbors is -1 (and rho NaN) where a row has fewer than `k` neighbours with a defined correlation.
+    """
+    n = len(values)
+    neighbors = np.full((n, k), -1, dtype=np.int64)
+    rho = np.full((n, k), np.nan)
+    count = np.zeros((n, k), dtype=np.int32)
+    if n < 2 or k < 1:
+        return neighbors, rho, count
+
+    mask = (~np.isnan(values)).astype(np.float64)
+    ranks = np.nan_to_num(rankdata(values, axis=1, nan_policy="omit"), nan=0.0)
+    candidates = min(k * oversample, n - 1)
+
+    block = max(1, NEIGHBOR_BLOCK_CELLS // n)
+    for start in range(0, n, block):
+        rows = np.arange(start, min(start + block, n))
+        scores, _ = masked_correlation(ranks[rows], mask[rows], ranks, mask, min_count)
+        scores = np.abs(scores)
+        scores[np.arange(len(rows)), rows] = np.nan
+        scores = np.nan_to_num(scores, nan=-1.0)
+        best = np.argpartition(-scores, candidates - 1, axis=1)[:, :candidates]
+        # Candidates without a defined score are dropped after re-scoring
+        undefined = np.take_along_axis(scores, best, axis=1) < 0
+
+        chunk = max(1, NEIGHBOR_BLOCK_CELLS // (candidates * values.shape[1]))
+        for i in range(0, len(rows), chunk):
+            exact, shared = _spearman_pairs(values[rows[i:i + chunk]], values[best[i:i + chunk]], min_count)
+            exact[undefined[i:i + chunk]] = np.nan
+            order = np.argsort(-np.nan_to_num(np.abs(exact), nan=-1.0), axis=1, kind="stable")[:, :k]
+            exact = np.take_along_axis(exact, order, axis=1)
+            missing = np.isnan(exact)
+            target = rows[i:i + chunk]
+            neighbors[target, :order.shape[1]] = np.where(missing, -1, np.take_along_axis(best[i:i + chunk], order, axis=1))
+            rho[target, :order.shape[1]] = exact
+            count[target, :order.shape[1]] = np.where(missing, 0, np.take_along_axis(shared, order, axis=1))
+
+    return neighbors, rho, count
+
+
+def column_correlations(values: np.ndarray, method: str = "spearman", min_count: int = MIN_COUNT):
+    """
+    Correlation of every column of `values` against every column, over the rows where both
+    have a value: e.g. of each cell line against each other cell line across features.
+
+    The columns are copied into contiguous rows first. Pearson correlations are a single
+    `masked_correlation` of the centered values. For Spearman correlations, each column is
+    sorted once, and the ranks of each pair of columns over their shared rows (exactly like
+    `scipy.stats.spearmanr` on the pair with NaNs dropped) are read off cumulative counts
+    along that order (see `_shared_ranks`), for up to PAIR_BLOCK_CELLS values of pairs at
+    once. If no value is missing, they are the Pearson correlations of the ranks.
+
+    :param values: (n_features, n_columns) float matrix, NaN = missing
+    :param method: one of COLUMN_METHODS
+    :returns: (rho, count), both of shape (n_columns, n_columns)
+    """
+    x = np.ascontiguousarray(values.T, dtype=np.float64)
+    missing = np.isnan(x)
+    mask = (~missing).astype(np.float64)
+
+    if method == "pearson" or not missing.any():
+        if method == "spearman":
+            x = rankdata(x, axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            centered = np.nan_to_num(x - np.nanmean(x, axis=1, keepdims=True))
+        rho, count = masked_correlation(centered, mask, centered, mask, min_count)
+        np.fill_diagonal(rho, np.where(np.diag(count) >= min_count, 1.0, np.nan))
+        return rho, count
+
+    n = len(x)
+    rho = np.full((n, n), np.nan)
+    count = np.zeros((n, n), dtype=np.int32)
+    order, first, last = _tie_groups(x)
+    present = ~missing
+    pairs_a, pairs_b = np.triu_indices(n)
+    chunk = max(1, PAIR_BLOCK_CELLS // max(x.shape[1], 1))
+    for i in range(0, len(pairs_a), chunk):
+        a, b = pairs_a[i:i + chunk], pairs_b[i:i + chunk]
+        shared = present[a] & present[b]
+        k = shared.sum(axis=1, keepdims=True)
+        # Average ranks over k values always sum to k (k + 1) / 2, ties or not
+        ra = np.where(shared, _shared_ranks(order[a], first[a], last[a], shared) - (k + 1) / 2, 0)
+        rb = np.where(shared, _shared_ranks(order[b], first[b], last[b], shared) - (k + 1) / 2, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pair_rho = (ra * rb).sum(axis=1) / np.sqrt((ra * ra).sum(axis=1) * (rb * rb).sum(axis=1))
+        pair_rho[k[:, 0] < min_count] = np.nan
+        rho[a, b] = rho[b, a] = np.clip(pair_rho, -1, 1)
+        count[a, b] = count[b, a] = k[:, 0]
+    return rho, count
+
+
+def _tie_groups(x: np.ndarray):
+    """
+    Sort order of each row of `x` (NaN last), and for each sorted position, the first and
+    last positions of its group of tied values.
+    """
+    order = np.argsort(x, axis=1, kind="stable")
+    sorted_x = np.take_along_axis(x, order, axis=1)
+    positions = np.broadcast_to(np.arange(x.shape[1]), x.shape)
+
+    starts = np.ones(x.shape, dtype=bool)
+    starts[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    ends = np.ones(x.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, x.shape[1] - 1)[:, ::-1], axis=1)[:, ::-1]
+    return order, first, last
+
+
+def _shared_ranks(order: np.ndarray, first: np.ndarray, last: np.ndarray, shared: np.ndarray) -> np.ndarray:
+    """
+    Average ranks of each row over its `shared` positions, from the sort order and tie
+    groups of the row (see `_tie_groups`), without sorting again: the rank of a value is
+    the number of shared values sorted before it, averaged over its tie group.
+
+    :returns: ranks in the original positions (undefined outside `shared`)
+    """
+    in_order = np.take_along_axis(shared, order, axis=1)
+    seen = np.cumsum(in_order, axis=1)
+    below = np.take_along_axis(seen - in_order, first, axis=1)
+    through = np.take_along_axis(seen, last, axis=1)
+
+    ranks = np.empty(shared.shape)
+    np.put_along_axis(ranks, order, (below + 1 + through) / 2, axis=1)
+    return ranks
+
+
+def spearman_permutation_pvalues(x: np.ndarray, y: np.ndarray, n_permutations: int, seed: int = 0,
+                                 deadline: float = None, min_count: int = MIN_COUNT):
+    """
+    Permutation p-values for the Spearman correlation of `x` against every row of `y`.
+
+    Random sort keys for all permutations are drawn once from `seed`. The permutation of the
+    cell lines shared by a pair is the argsort of their keys, so all pairs are tested against
+    the same sequence of permutations and results are reproducible. For each group of `y` rows
+    with the same missing-value pattern, a block of permuted `x` ranks is multiplied against
+    the whole group at once.
+
+    :param x: (n_cell_lines,) float vector, NaN = missing
+    :param y: (n2, n_cell_lines) float matrix, NaN = missing
+    :param deadline: `time.perf_counter()` value after which no new permutation blocks are started
+
+    :returns: (pvalues, completed). pvalues has shape (n2,) and is (1 + #|null rho| >= |rho|) /
+    (1 + completed), or NaN where rho is undefined. completed is the number of permutations
+    evaluated, which is less than `n_permutations` if the deadline was reached.
+    """
+    n2 = len(y)
+    pvalues = np.full(n2, np.nan)
+    exceed = np.zeros(n2, dtype=np.int64)
+    completed = 0
+
+    keys = np.random.default_rng(seed).random((n_permutations, len(x)))
+
+    # Precompute the observed correlations for each group of rows sharing a mask
+    groups = []
+    mask_x = ~np.isnan(x)
+    patterns, row_groups = group_by_mask(~np.isnan(y))
+    for pattern, rows in zip(patterns, row_groups):
+        shared = mask_x & pattern
+        if shared.sum() < min_count:
+            continue
+        zx = standardized_ranks(x[shared][np.newaxis, :])[0]
+        zy = standardized_ranks(y[np.ix_(rows, shared)])
+        if np.isnan(zx).any():
+            continue
+        observed = np.abs(zy @ zx) - 1e-12
+        valid = ~np.isnan(observed)
+        if valid.any():
+            groups.append((shared, zx, zy[valid], observed[valid], rows[valid]))
+
+    for start in range(0, n_permutations, PERMUTATION_BLOCK):
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        cancellation.check()
+        block_keys = keys[start:start + PERMUTATION_BLOCK]
+
+        for shared, zx, zy, observed, rows in groups:
+            permuted = zx[np.argsort(block_keys[:, shared], axis=1)]
+            chunk = max(1, PERMUTATION_MAX_CELLS // len(block_keys))
+            for i in range(0, len(rows), chunk):
+                null = np.abs(permuted @ zy[i:i + chunk].T)
+                exceed[rows[i:i + chunk]] += (null >= observed[i:i + chunk]).sum(axis=0)
+
+        completed += len(block_keys)
+
+    if completed:
+        for _, _, _, _, rows in groups:
+            pvalues[rows] = (exceed[rows] + 1) / (completed + 1)
+    return pvalues, completed
+
+
+def _standardize_last_axis(ranks: np.ndarray) -> np.ndarray:
+    ranks -= ranks.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ranks /= np.linalg.norm(ranks, axis=-1, keepdims=True)
+    return ranks
+
+
+def spearman_bootstrap_ci(x: np.ndarray, y: np.ndarray, n_resamples: int, seed: int = 0,
+                          confidence: float = 0.95, max_bytes: int = 256 * 2 ** 20,
+                          min_count: int = MIN_COUNT):
+    """
+    Percentile bootstrap confidence intervals for the Spearman correlation of `x` against
+    every row of `y`.
+
+    Resample indices are drawn once from `seed` as an (n_resamples, n_cell_lines) matrix of
+    random integers; a pair with k shared cell lines uses the first k columns modulo k.
+    For each group of `y` rows with the same missing-value pattern, the resampled values
+    of `x` and of all rows in the group are re-ranked at once along the last axis, and the
+    correlations of all resamples are a single multiply-and-sum. Rows are processed in chunks
+    so that the resampled arrays stay under `max_bytes`.
+
+    :returns: (low, high), each of shape (n2,), NaN where rho is undefined
+    """
+    n2 = len(y)
+    low = np.full(n2, np.nan)
+    high = np.full(n2, np.nan)
+    tail = (1 - confidence) / 2 * 100
+
+    draws = np.random.default_rng(seed).integers(0, 2 ** 31, size=(n_resamples, len(x)))
+
+    mask_x = ~np.isnan(x)
+    patterns, row_groups = group_by_mask(~np.isnan(y))
+    for pattern, rows in zip(patterns, row_groups):
+        shared = mask_x & pattern
+        k = int(shared.sum())
+        if k < min_count:
+            continue
+
+        cancellation.check()
+        idx = draws[:, :k] % k
+        zx = _standardize_last_axis(rankdata(x[shared][idx], axis=-1))
+
+        y_shared = y[np.ix_(rows, shared)]
+        # Resampled values, ranks and products are each (chunk, n_resamples, k) floats
+        chunk = max(1, max_bytes // (3 * n_resamples * k * 8))
+        for i in range(0, len(rows), chunk):
+            zy = _standardize_last_axis(rankdata(y_shared[i:i + chunk][:, idx], axis=-1))
+            rho = np.einsum("rbk,bk->rb", zy, zx)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                bounds = np.nanpercentile(rho, [tail, 100 - tail], axis=1)
+            low[rows[i:i + chunk]] = bounds[0]
+            high[rows[i:i + chunk]] = bounds[1]
+
+    return np.clip(low, -1, 1), np.clip(high, -1, 1)
+
+
+def cluster_order(matrix: np.ndarray) -> list:
+    """
+    Leaf order of an average-linkage hierarchical clustering of the rows of `matrix`,
+    so that rows with similar correlation profiles end up next to each other.
+    """
+    if len(matrix) < 3:
+        return list(range(len(matrix)))
+    data = np.nan_to_num(matrix, nan=0.0)
+    return leaves_list(linkage(data, method="average", metric="euclidean", optimal_ordering=True)).tolist()
+
+
+MAGIC = b"CORM"
+
+
+def pack_matrices(header: dict, arrays: dict) -> bytes:
+    """
+    Encode matrices in a compact binary format that can be read without a parser:
+
+        4 bytes     magic "CORM"
+        4 bytes     header length (uint32, little-endian)
+        header      UTF-8 JSON, padded with spaces to a multiple of 8 bytes
+        arrays      raw little-endian array data, each starting on an 8-byte boundary
+
+    The header is `header` plus an "arrays" list giving each array's name, dtype,
+    shape and byte offset (relative to the end of the header), so a browser can wrap
+    them directly in typed arrays (e.g. Float32Array).
+    """
+    descriptors = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        descriptors.append({
+            "name": name,
+            "dtype": array.dtype.newbyteorder("<").str,
+            "shape": list(array.shape),
+            "offset": offset,
+        })
+        offset += -(-array.nbytes // 8) * 8
+
+    header_bytes = json.dumps({**header, "arrays": descriptors}).encode("utf-8")
+    header_bytes += b" " * (-(len(header_bytes) + 8) % 8)
+
+    chunks = [MAGIC, struct.pack("<I", len(header_bytes)), header_bytes]
+    for array in arrays.values():
+        data = np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<"), copy=False).tobytes()
+        chunks.append(data + b"\0" * (-len(data) % 8))
+    return b"".join(chunks)
+
+
+def unpack_matrices(data: bytes):
+    """Inverse of `pack_matrices`. Returns (header, arrays)."""
+    if data[:4] != MAGIC:
+        raise ValueError("Not a correlation matrix payload.")
+    (header_length,) = struct.unpack("<I", data[4:8])
+    header = json.loads(data[8:8 + header_length])
+    start = 8 + header_length
+
+    arrays = {}
+    for desc in header["arrays"]:
+        dtype = np.dtype(desc["dtype"])
+        size = int(np.prod(desc["shape"])) * dtype.itemsize
+        begin = start + desc["offset"]
+        arrays[desc["name"]] = np.frombuffer(data[begin:begin + size], dtype=dtype).reshape(desc["shape"])
+    return header, arrays
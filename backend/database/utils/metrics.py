@@ -0,0 +1,171 @@
+import threading
+
+# Default latency buckets (in seconds) for request and stage histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    """Label value escaped for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in items)
+    return "{" + body + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing value, optionally split by labels.
+    """
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, optionally split by labels.
+    """
+
+    def set(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values, optionally split by labels.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            series = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._values.items():
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics for this process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register_collector(self, func):
+        """Register `func` to be called before each render, to refresh point-in-time gauges."""
+        if func not in self._collectors:
+            self._collectors.append(func)
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            collect()
+
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Total time spent serving a request.")
+STAGE_DURATION = REGISTRY.histogram(
+    "request_stage_duration_seconds", "Time spent in each stage of a request.")
+DB_QUERIES = REGISTRY.counter(
+    "db_queries_total", "Number of database queries executed.")
+DB_QUERY_DURATION = REGISTRY.histogram(
+    "db_query_duration_seconds", "Total database time per request.")
+CACHE_REQUESTS = REGISTRY.counter(
+    "cache_requests_total", "Cache lookups, split by cache and result (hit/miss).")
+ROWS_SCANNED = REGISTRY.counter(
+    "rows_scanned_total", "Feature rows read from each value table.")
+FEATURES_PRUNED = REGISTRY.counter(
+    "features_pruned_total", "Requested features skipped as degenerate before fetching their values.")
+SINGLEFLIGHT_TIMEOUTS = REGISTRY.counter(
+    "singleflight_timeouts_total", "Requests that stopped waiting for an identical in-flight request, by scope (process/shared).")
+ADMISSION_DECISIONS = REGISTRY.counter(
+    "admission_decisions_total", "Admission decisions for correlation work, by lane and result.")
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "admission_queue_depth", "Requests currently waiting in each admission lane.")
+ADMISSION_WAIT = REGISTRY.histogram(
+    "admission_wait_seconds", "Time spent waiting in each admission lane.")
+CANCELLATIONS = REGISTRY.counter(
+    "correlations_cancelled_total", "Correlation computations stopped before completion, by reason (superseded/disconnect).")
+CANCELLED_CPU = REGISTRY.counter(
+    "cancelled_cpu_seconds_total", "CPU time of cancelled correlation computations, spent before stopping and estimated saved by stopping (kind=spent/saved).")
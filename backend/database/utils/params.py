@@ -0,0 +1,155 @@
+import json
+import hashlib
+
+from django.conf import settings
+
+from .constants import CELL_LINES
+
+# Most covariates a partial correlation request can control for
+COVARIATES_MAX = 10
+
+
+def _as_list(value) -> list:
+    """Allow a single string wherever a list of names is accepted."""
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def _bounded_int(data, name: str, maximum: int) -> int:
+    """Optional non-negative integer field, 0 if missing."""
+    try:
+        value = int(data.get(name) or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name.capitalize()} must be an integer.")
+    if not 0 <= value <= maximum:
+        raise ValueError(f"{name.capitalize()} must be between 0 and {maximum}.")
+    return value
+
+
+def parse_cell_lines(data):
+    """
+    Cell line subset of a request. `cell_lines` may be a list of cell lines to include, or
+    an object {"include": [...], "exclude": [...]} (either key optional).
+
+    :raises ValueError: with a user-facing message for unknown cell lines or an empty subset
+    :returns: selected cell lines in CELL_LINES order, or None if all cell lines are used
+    """
+    value = data.get("cell_lines")
+    if not value:
+        return None
+
+    if isinstance(value, dict):
+        include = _as_list(value.get("include") or CELL_LINES)
+        exclude = _as_list(value.get("exclude") or [])
+    else:
+        include = _as_list(value)
+        exclude = []
+
+    unknown = [c for c in [*include, *exclude] if c not in CELL_LINES]
+    if unknown:
+        raise ValueError(f"Unknown cell lines: {unknown}.")
+
+    selected = [c for c in CELL_LINES if c in set(include) - set(exclude)]
+    if not selected:
+        raise ValueError("The cell line selection is empty.")
+    if len(selected) == len(CELL_LINES):
+        return None
+    return selected
+
+
+def cell_lines_hash(cell_lines) -> str:
+    """Short hash identifying a cell line subset, for cache keys. Empty for all cell lines."""
+    if cell_lines is None:
+        return ""
+    return hashlib.md5(",".join(cell_lines).encode("utf-8")).hexdigest()[:12]
+
+
+def parse_correlation_request(data) -> dict:
+    """
+    Extract and normalize the parameters of a correlation request body.
+    `feature2`, `database1` and `database2` may be a single string or a list.
+
+    `permutations` and `bootstrap` optionally request permutation p-values and bootstrap
+    confidence intervals (see `calculate_correlations`), `cell_lines` restricts the
+    computation to a subset of cell lines (see `parse_cell_lines`), and `covariates`
+    (a feature name or a list) requests partial correlations controlling for those features.
+
+    :raises ValueError: with a user-facing message if a required field is missing or invalid
+    :returns: dict with keys feature1 (str), feature2, database1, database2 (lists),
+    permutations, bootstrap (ints), cell_lines (list or None), covariates (list)
+    """
+    # f1, f2 refer to feature 1/2
+    f1_name = data.get("feature1")
+    f2_names = data.get("feature2")
+
+    # Extract database names for feature 1 and features 2
+    db1_names = data.get("database1")
+    db2_names = data.get("database2")
+
+    # Ensure input features are provided
+    if not f1_name:
+        raise ValueError("Feature 1 is required.")
+    if not f2_names:
+        raise ValueError("Feature 2 is required (can be a single feature or a list).")
+
+    if not db1_names:
+        raise ValueError("Database 1 is required (can be a single feature or a list).")
+    if not db2_names:
+        raise ValueError("Database 2 is required (can be a single feature or a list).")
+
+    permutations = _bounded_int(data, "permutations", settings.PERMUTATION_MAX)
+    bootstrap = _bounded_int(data, "bootstrap", settings.BOOTSTRAP_MAX)
+
+    covariates = list(dict.fromkeys(_as_list(data.get("covariates") or [])))
+    if len(covariates) > COVARIATES_MAX:
+        raise ValueError(f"At most {COVARIATES_MAX} covariates are supported.")
+
+    return {
+        "feature1": f1_name,
+        "feature2": _as_list(f2_names),
+        "database1": _as_list(db1_names),
+        "database2": _as_list(db2_names),
+        "permutations": permutations,
+        "bootstrap": bootstrap,
+        "cell_lines": parse_cell_lines(data),
+        "covariates": covariates,
+    }
+
+
+def correlation_cache_key(params: dict) -> str:
+    """
+    Cache key for a parsed correlation request. The feature and database lists are
+    sorted so that the same query submitted in a different order shares a key.
+    """
+    key_data = {
+        "f1": params["feature1"],
+        "f2": sorted(params["feature2"]),
+        "db1": sorted(params["database1"]),
+        "db2": sorted(params["database2"]),
+    }
+    # Only part of the key when used, so existing keys stay valid
+    if params.get("permutations"):
+        key_data["perm"] = params["permutations"]
+    if params.get("bootstrap"):
+        key_data["boot"] = params["bootstrap"]
+    if params.get("cell_lines"):
+        key_data["cl"] = cell_lines_hash(params["cell_lines"])
+    if params.get("covariates"):
+        key_data["cov"] = sorted(params["covariates"])
+    key_json = json.dumps(key_data, separators=(",", ":"), sort_keys=True)
+    return "corr:" + hashlib.md5(key_json.encode("utf-8")).hexdigest()
+
+
+def matrix_cache_key(features1: list, features2: list, cell_lines=None) -> str:
+    """Cache key for a correlation matrix of two ordered feature lists over a cell line subset."""
+    key_data = {"f1": features1, "f2": features2, "cl": cell_lines_hash(cell_lines)}
+    key_json = json.dumps(key_data, separators=(",", ":"), sort_keys=True)
+    return "matrix:" + hashlib.md5(key_json.encode("utf-8")).hexdigest()
+
+
+def cell_similarity_cache_key(features: list, method: str, cell_lines: list) -> str:
+    """Cache key for a cell line similarity matrix. The features are sorted, since their order doesn't matter."""
+    key_data = {"f": sorted(features), "m": method, "cl": cell_lines_hash(cell_lines)}
+    key_json = json.dumps(key_data, separators=(",", ":"), sort_keys=True)
+    return "cellsim:" + hashlib.md5(key_json.encode("utf-8")).hexdigest()
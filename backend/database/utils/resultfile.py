@@ -0,0 +1,33 @@
+"""
+Compressed columnar files holding the results of a correlation request.
+
+A file is a single-row Parquet table with one column per test ("spearman", "anova",
+"chisquared"), each a list of records stored as a list of structs, so every record
+field is its own compressed column and the records read back exactly as they were written.
+"""
+import os
+import uuid
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def write_results(path: Path, results: dict) -> int:
+    """
+    Write `results` (dictionary mapping each test to a list of records) to `path`.
+    The file is written under a temporary name and renamed, so readers never see a partial file.
+
+    :returns: size of the file in bytes
+    """
+    path = Path(path)
+    table = pa.Table.from_pydict({test: [records] for test, records in results.items()})
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    pq.write_table(table, tmp, compression="zstd")
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+
+def read_results(path: Path) -> dict:
+    """Results written by `write_results`."""
+    return pq.read_table(path).to_pylist()[0]
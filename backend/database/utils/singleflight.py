@@ -0,0 +1,123 @@
+"""
+Coalescing of identical concurrent requests ("single flight").
+
+Requests with the same cache key are serialized: the first one computes the result and
+caches it, and the others wait for it and then read it from the cache. Waiting happens
+on a per-key lock within the process and, when the cache is Redis (django-redis), on a
+Redis lock shared by all processes. If the wait exceeds SINGLEFLIGHT_WAIT, the request
+stops waiting and computes the result itself.
+
+Usage, after a cache miss:
+
+    with singleflight.hold(cache_key):
+        result = cache.get(cache_key)      # filled in by the request we waited for, if any
+        if result is None:
+            result = compute()
+            cache.set(cache_key, result)
+"""
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, timing
+
+
+class _LockTable:
+    """Per-key locks, created on first use and dropped once no request holds or waits on them."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._entries = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def get(self, key: str):
+        with self._guard:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [self._factory(), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._entries[key]
+
+
+_thread_locks = _LockTable(threading.Lock)
+_async_locks = _LockTable(asyncio.Lock)
+
+
+def _acquire_shared(key: str):
+    """
+    Acquire the cross-process lock for `key` if the cache backend supports locks.
+    Returns the lock, or None if there is none or it couldn't be acquired in time.
+    """
+    if not hasattr(cache, "lock"):
+        return None
+    # Not thread-local: `ahold` acquires and releases it in executor threads, which can differ
+    lock = cache.lock(f"singleflight:{key}", timeout=settings.SINGLEFLIGHT_LOCK_TTL,
+                      blocking_timeout=settings.SINGLEFLIGHT_WAIT, thread_local=False)
+    try:
+        acquired = lock.acquire()
+    except Exception:
+        # Redis unavailable: computing without the lock is better than failing the request
+        acquired = False
+    if not acquired:
+        metrics.SINGLEFLIGHT_TIMEOUTS.inc(scope="shared")
+        return None
+    return lock
+
+
+def _release_shared(lock):
+    if lock is None:
+        return
+    try:
+        lock.release()
+    except Exception:
+        # The lock expired while computing and may now belong to another request
+        pass
+
+
+@contextmanager
+def hold(key: str):
+    """Wait for any in-flight request with the same `key`, then hold its locks until the block exits."""
+    with _thread_locks.get(key) as local:
+        with timing.stage("wait"):
+            acquired = local.acquire(timeout=settings.SINGLEFLIGHT_WAIT)
+            if not acquired:
+                metrics.SINGLEFLIGHT_TIMEOUTS.inc(scope="process")
+            shared = _acquire_shared(key)
+        try:
+            yield
+        finally:
+            _release_shared(shared)
+            if acquired:
+                local.release()
+
+
+@asynccontextmanager
+async def ahold(key: str):
+    """Async version of `hold`, for views running on the event loop."""
+    with _async_locks.get(key) as local:
+        with timing.stage("wait"):
+            try:
+                await asyncio.wait_for(local.acquire(), settings.SINGLEFLIGHT_WAIT)
+                acquired = True
+            except asyncio.TimeoutError:
+                acquired = False
+                metrics.SINGLEFLIGHT_TIMEOUTS.inc(scope="process")
+            shared = await sync_to_async(_acquire_shared, thread_sensitive=False)(key)
+        try:
+            yield
+        finally:
+            if shared is not None:
+                await sync_to_async(_release_shared, thread_sensitive=False)(shared)
+            if acquired:
+                local.release()
@@ -0,0 +1,253 @@
+"""
+On-disk snapshots of the feature value tables as NumPy arrays.
+
+A snapshot holds, for each category (Nuclear, Molecular, Drug Screen):
+    values.npy      float matrix, one row per feature and one column per cell line (NaN = missing)
+    ranks.npy       average ranks of each row over its present values (NaN = missing)
+    features.json   feature names, sub_categories and data types in row order, and the cell line order
+
+Ranks are a monotone function of each row's values, so re-ranking them over any subset of
+cell lines gives the same ranks as re-ranking the values: the Spearman kernels read them
+instead of the values (see `store.fetch_ranks`), which spares each worker ranking every
+row again.
+
+Compact snapshots (see `utils.compact`) store values.npy and ranks.npy as float32. Ranks are
+taken before rounding, so values that only differ beyond float32 precision keep their order.
+
+Snapshots are written to a new versioned directory and then published by atomically
+replacing the CURRENT file, so readers never see a half-written snapshot.
+Workers open the arrays with `np.load(mmap_mode="r")`, which returns read-only `np.memmap`s:
+every worker process on the machine shares the same pages of the OS page cache
+instead of holding its own copy of the data.
+"""
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from scipy.stats import rankdata
+
+from . import compact
+from .constants import CELL_LINES
+
+CURRENT_FILE = "CURRENT"
+
+# Layout of the snapshot files. Snapshots in another layout are ignored until rebuilt
+FORMAT_VERSION = 2
+
+# Number of old snapshot versions to keep around for workers that still have them open
+KEEP_VERSIONS = 2
+
+
+def category_slug(category: str) -> str:
+    """Directory name for a category, e.g. "Drug Screen" -> "drug_screen"."""
+    return category.lower().replace(" ", "_")
+
+
+def rank_rows(values: np.ndarray) -> np.ndarray:
+    """
+    Average ranks (1-based, ties averaged) of each row over its non-NaN values.
+    Missing values stay NaN.
+    """
+    if values.size == 0:
+        return values.astype(np.float64)
+    return rankdata(values, axis=1, nan_policy="omit")
+
+
+class FeatureMatrix:
+    """
+    Read-only view of one category of a snapshot.
+    Arrays are memory-mapped, so indexing only reads (and copies) the rows requested.
+    """
+
+    def __init__(self, path: Path, category: str):
+        self.path = path
+        self.category = category
+
+        with open(path / "features.json") as f:
+            meta = json.load(f)
+
+        self.names = meta["names"]
+        self.sub_categories = meta["sub_categories"]
+        self.data_types = meta["data_types"]
+        self.cell_lines = meta["cell_lines"]
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        self.values = np.load(path / "values.npy", mmap_mode="r")
+        self.ranks = np.load(path / "ranks.npy", mmap_mode="r")
+
+    @property
+    def compact(self) -> bool:
+        return self.values.dtype == np.float32
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self, names) -> np.ndarray:
+        """Row indices of the given feature names, skipping names not in this category."""
+        return np.array([self.index[n] for n in names if n in self.index], dtype=np.intp)
+
+    def array(self, idx) -> np.ndarray:
+        """Values of the rows `idx` in the stored dtype: float64, or float32 for compact snapshots."""
+        return np.array(self.values[idx])
+
+    def rank_array(self, idx) -> np.ndarray:
+        """Precomputed ranks of the rows `idx`, in the dtype of `array`."""
+        return np.array(self.ranks[idx])
+
+    def frame(self, names) -> pd.DataFrame:
+        """
+        Values of the given features as a DataFrame with columns "feature", *CELL_LINES,
+        matching what `values_list()` on the category's model would return.
+        """
+        idx = self.rows(names)
+        values = self.array(idx)
+        if values.dtype == np.float32:
+            # Shortest decimal form of each float32, so values read e.g. 0.7284644 rather than 0.72846442461
+            values = values.astype(str).astype(np.float64)
+        df = pd.DataFrame(values, columns=self.cell_lines)
+        df.insert(0, "feature", [self.names[i] for i in idx])
+        return df[["feature", *CELL_LINES]]
+
+
+class Snapshot:
+    """All categories of one snapshot version."""
+
+    def __init__(self, path: Path, version: str):
+        self.path = path
+        self.version = version
+
+        with open(path / "manifest.json") as f:
+            self.manifest = json.load(f)
+
+        self.categories = {
+            category: FeatureMatrix(path / category_slug(category), category)
+            for category in self.manifest["categories"]
+        }
+
+    def get(self, category: str):
+        """FeatureMatrix for `category`, or None if the snapshot doesn't include it."""
+        return self.categories.get(category)
+
+
+def write_snapshot(root: Path, tables: dict, compact_dtypes: bool = False, reuse=()) -> str:
+    """
+    Write a new snapshot version under `root` and publish it.
+
+    :param root: snapshot directory (e.g. settings.MATRIX_SNAPSHOT_DIR)
+    :param tables: dictionary mapping each category to a dict with keys
+    "names", "sub_categories", "data_types" (lists) and "values" (2D float array
+    with columns in CELL_LINES order)
+    :param compact_dtypes: store float32 values and ranks (see `utils.compact`)
+    :param reuse: categories to take unchanged from the current version (hard-linked, not copied)
+
+    :returns: the new version string
+    """
+    root = Path(root)
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    path = root / version
+    path.mkdir(parents=True)
+
+    if reuse:
+        current = current_version(root)
+        if current is None:
+            raise ValueError("There is no current snapshot to reuse categories from.")
+        for category in reuse:
+            shutil.copytree(root / current / category_slug(category), path / category_slug(category),
+                            copy_function=os.link)
+
+    for category, table in tables.items():
+        category_path = path / category_slug(category)
+        category_path.mkdir()
+
+        values = np.ascontiguousarray(table["values"], dtype=np.float64).reshape(-1, len(CELL_LINES))
+        meta = {
+            "names": list(table["names"]),
+            "sub_categories": list(table["sub_categories"]),
+            "data_types": list(table["data_types"]),
+            "cell_lines": CELL_LINES,
+        }
+
+        if compact_dtypes:
+            np.save(category_path / "values.npy", compact.compact_values(values))
+            # Ranked before rounding, so values that only differ beyond float32 precision keep their order
+            np.save(category_path / "ranks.npy", rank_rows(values).astype(np.float32))
+        else:
+            np.save(category_path / "values.npy", values)
+            np.save(category_path / "ranks.npy", rank_rows(values))
+
+        with open(category_path / "features.json", "w") as f:
+            json.dump(meta, f)
+
+    with open(path / "manifest.json", "w") as f:
+        json.dump({"format": FORMAT_VERSION, "version": version, "categories": [*reuse, *tables.keys()],
+                   "compact": compact_dtypes}, f)
+
+    # Publish atomically
+    tmp = root / f"{CURRENT_FILE}.{uuid.uuid4().hex}"
+    tmp.write_text(version)
+    os.replace(tmp, root / CURRENT_FILE)
+
+    _prune(root, version)
+    return version
+
+
+def current_version(root: Path):
+    """Version published under `root`, or None."""
+    try:
+        return (Path(root) / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(root: Path):
+    """Manifest of the version published under `root`, or None."""
+    version = current_version(root)
+    if version is None:
+        return None
+    with open(Path(root) / version / "manifest.json") as f:
+        return json.load(f)
+
+
+def _prune(root: Path, current: str):
+    """Remove old snapshot versions. Workers that still have them mapped keep working."""
+    others = sorted(p for p in root.iterdir() if p.is_dir() and p.name != current)
+    for p in others[:max(len(others) - KEEP_VERSIONS, 0)]:
+        shutil.rmtree(p, ignore_errors=True)
+
+
+_lock = threading.Lock()
+_loaded = None
+_loaded_mtime = None
+
+
+def get_snapshot():
+    """
+    The current snapshot, or None if none has been written or it is in another layout
+    (FORMAT_VERSION). Reloaded automatically when a new version is published.
+    """
+    global _loaded, _loaded_mtime
+
+    current = Path(settings.MATRIX_SNAPSHOT_DIR) / CURRENT_FILE
+    try:
+        mtime = current.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if mtime == _loaded_mtime:
+        return _loaded
+
+    with _lock:
+        if mtime != _loaded_mtime:
+            version = current.read_text().strip()
+            manifest = read_manifest(current.parent)
+            _loaded = Snapshot(current.parent / version, version) \
+                if manifest.get("format") == FORMAT_VERSION else None
+            _loaded_mtime = mtime
+    return _loaded
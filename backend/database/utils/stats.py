@@ -0,0 +1,92 @@
+"""
+Per-feature summary statistics, computed once at ingest (see `manage.py build_feature_stats`)
+so that requests can skip degenerate features without reading their values.
+"""
+import warnings
+
+import numpy as np
+
+from .matrix import MIN_COUNT
+
+HISTOGRAM_BINS = 20
+
+
+def _histogram(values: np.ndarray, data_type: str) -> dict:
+    """Histogram of the non-NaN `values` of one feature: bins for "num", level counts for "cat"."""
+    if len(values) == 0:
+        return {}
+    if data_type == "cat":
+        levels, counts = np.unique(values, return_counts=True)
+        return {"levels": levels.tolist(), "counts": counts.tolist()}
+    counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+    return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+
+def distinct_counts(values: np.ndarray, ordered: np.ndarray = None) -> np.ndarray:
+    """
+    Number of distinct non-NaN values of each row of a float matrix.
+
+    :param ordered: `values` sorted along each row, if already computed
+    """
+    # NaNs sort last, so distinct values are 1 + the number of changes between present values
+    if ordered is None:
+        ordered = np.sort(values, axis=1)
+    changes = (np.diff(ordered, axis=1) != 0) & ~np.isnan(ordered[:, 1:])
+    return changes.sum(axis=1) + (~np.isnan(ordered[:, :1])).sum(axis=1)
+
+
+def compute_feature_stats(values: np.ndarray, data_types: list) -> list:
+    """
+    Summary statistics of each row of a value table.
+
+    :param values: (n_features, n_cell_lines) float matrix, NaN = missing
+    :param data_types: data type ("num" or "cat") of each row
+
+    :returns: list with one dictionary per row, with keys count (non-NaN values),
+    zero_fraction, distinct (number of distinct values), variance, minimum, maximum,
+    q25, median, q75 (None where undefined) and histogram
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mask = ~np.isnan(values)
+    count = mask.sum(axis=1)
+
+    # NaNs sort last, so each row's present values are its first `count` sorted values
+    ordered = np.sort(values, axis=1)
+    distinct = distinct_counts(values, ordered)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        zero_fraction = (values == 0).sum(axis=1) / count
+        variance = np.nanvar(values, axis=1, ddof=1)
+        minimum = np.nanmin(values, axis=1) if values.size else np.zeros(0)
+        maximum = np.nanmax(values, axis=1) if values.size else np.zeros(0)
+        quantiles = np.nanpercentile(values, [25, 50, 75], axis=1) if values.size else np.zeros((3, 0))
+
+    def finite(x):
+        return float(x) if np.isfinite(x) else None
+
+    stats = []
+    for i, data_type in enumerate(data_types):
+        stats.append({
+            "count": int(count[i]),
+            "zero_fraction": finite(zero_fraction[i]),
+            "distinct": int(distinct[i]),
+            "variance": finite(variance[i]),
+            "minimum": finite(minimum[i]),
+            "maximum": finite(maximum[i]),
+            "q25": finite(quantiles[0, i]),
+            "median": finite(quantiles[1, i]),
+            "q75": finite(quantiles[2, i]),
+            "histogram": _histogram(ordered[i, :count[i]], data_type),
+        })
+    return stats
+
+
+def is_degenerate(count: int, distinct: int) -> bool:
+    """
+    Whether a feature can't have any correlation: fewer than MIN_COUNT values (so no pair
+    has enough shared cell lines) or a single distinct value (a constant numerical feature
+    has no Spearman correlation or ANOVA, a categorical one with one level has no ANOVA or
+    chi-squared test). Both hold for any subset of cell lines as well.
+    """
+    return count < MIN_COUNT or distinct < 2
@@ -0,0 +1,141 @@
+"""
+Correlations computed in chunks of feature 2 rows, for the streaming correlation endpoints.
+
+`CorrelationStream` correlates feature 1 against one chunk of feature 2 at a time and keeps
+the strongest hits seen so far in a bounded min-heap per result type, so the client can show
+them while the scan goes on. Chunks start small, so the first hits arrive quickly, and double
+up to STREAM_MAX_CHUNK so later chunks don't pay the per-call overhead. The results of all
+chunks are the same as one `calculate_correlations` call over every row (the permutation and
+bootstrap draws only depend on the seed), so they are cached under the same key. Except when
+the permutation time budget runs out: the chunks after that get fewer permutations than one
+call would have run on their rows, so these results are not `complete` and aren't cached.
+"""
+import heapq
+import itertools
+import json
+
+import pandas as pd
+
+from . import correlations
+
+# Feature 2 rows in the first chunk, and the most in any chunk
+STREAM_FIRST_CHUNK = 50
+STREAM_MAX_CHUNK = 1000
+# Strongest hits sent with each batch, per result type
+STREAM_TOP_K = 50
+
+RESULT_KEYS = ("spearman", "anova", "chisquared")
+_PVALUE_COLUMNS = {"anova": "anova_pvalue", "chisquared": "chisq_pvalue"}
+
+
+def sse(event: str, data) -> str:
+    """One Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def _strength(key: str, record: dict) -> float:
+    """How strong a hit is, higher is stronger: |rho| for Spearman, -p-value for the tests."""
+    if key == "spearman":
+        return abs(record["spearman_correlation"])
+    return -record[_PVALUE_COLUMNS[key]]
+
+
+class TopHits:
+    """The `k` strongest records of each result type, kept in a min-heap of (strength, -seen, record)."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self._heaps = {key: [] for key in RESULT_KEYS}
+        # Of two equally strong hits, the one seen first is kept
+        self._seen = itertools.count()
+
+    def push(self, key: str, records: list):
+        heap = self._heaps[key]
+        for record in records:
+            item = (_strength(key, record), -next(self._seen), record)
+            if len(heap) < self.k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    def best(self) -> dict:
+        """Records of each result type, strongest first."""
+        return {
+            key: [record for _, _, record in sorted(heap, key=lambda item: item[:2], reverse=True)]
+            for key, heap in self._heaps.items()
+        }
+
+
+class CorrelationStream:
+    """
+    Correlations of `df1` against `df2` (as built by `correlations.build_feature_frame`),
+    computed one chunk of `df2` rows at a time:
+
+        stream = CorrelationStream(df1, df2, permutations=1000)
+        for start, stop in stream.chunks():
+            progress = stream.run_chunk(start, stop)
+        results = stream.results()
+
+    :param top_k: number of strongest hits to keep per result type
+    :param time_budget: permutation time budget in seconds, shared by all chunks
+    :param options: other keyword arguments of `correlations.calculate_correlations`
+    """
+
+    def __init__(self, df1: pd.DataFrame, df2: pd.DataFrame, top_k: int = STREAM_TOP_K,
+                 time_budget: float = None, **options):
+        self.df1 = df1
+        self.df2 = df2
+        self.options = options
+        self.top = TopHits(top_k)
+        self.done = 0
+        # False once a chunk ran fewer permutations than requested
+        self.complete = True
+        self._records = {key: [] for key in RESULT_KEYS}
+        # Permutation time left, None for no limit
+        self._time_left = time_budget or None
+
+    @property
+    def total(self) -> int:
+        return len(self.df2)
+
+    def chunks(self):
+        """(start, stop) row ranges of `df2`, growing from STREAM_FIRST_CHUNK to STREAM_MAX_CHUNK rows."""
+        start, size = 0, STREAM_FIRST_CHUNK
+        while start < self.total:
+            yield start, min(start + size, self.total)
+            start += size
+            size = min(size * 2, STREAM_MAX_CHUNK)
+
+    def run_chunk(self, start: int, stop: int) -> dict:
+        """
+        Correlate rows `start:stop` of `df2`.
+
+        :returns: the progress so far: {"done": rows correlated, "total": rows, "top": strongest hits}
+        """
+        time_budget = None
+        if self._time_left is not None:
+            # Once the budget is spent, later chunks get no permutations (as when one call runs out)
+            time_budget = max(self._time_left, 1e-9)
+
+        results = correlations.calculate_correlations(
+            self.df1, self.df2.iloc[start:stop], time_budget=time_budget, **self.options)
+        spearman = results["spearman"]
+        if self._time_left is not None:
+            self._time_left -= spearman.attrs["permutation_seconds"]
+        if "permutations" in spearman and (spearman["permutations"] < self.options["permutations"]).any():
+            self.complete = False
+        for key, df in results.items():
+            records = df.to_dict(orient="records")
+            self._records[key] += records
+            self.top.push(key, records)
+
+        self.done = stop
+        return {"done": self.done, "total": self.total, "top": self.top.best()}
+
+    def results(self) -> dict:
+        """Records of all chunks, in the order of one `calculate_correlations` call (by df1 row, then df2 row)."""
+        order = {key: i for i, key in enumerate(zip(self.df1["database"], self.df1["feature"]))}
+        return {
+            key: sorted(records, key=lambda r: order[(r["database_1"], r["feature_1"])])
+            for key, records in self._records.items()
+        }
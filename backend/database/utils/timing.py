@@ -0,0 +1,118 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+# Timer for the request currently being served (None outside of a request)
+_current_timer = contextvars.ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """
+    Collects per-stage timings, database query counts and other counters for a single request.
+    Stages with the same name are accumulated, so helpers called more than once
+    (e.g. `get_feature_values` for feature 1 and features 2) report their total time.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.query_count = 0
+        self.query_time = 0.0
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        Wrapper to be installed with `connection.execute_wrapper` to time every query.
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_count += 1
+            self.query_time += time.perf_counter() - start
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """
+        Format the collected timings as a `Server-Timing` header value (durations in ms).
+        """
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f'db;desc="{self.query_count} queries";dur={self.query_time * 1000:.1f}')
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def as_dict(self) -> dict:
+        return {
+            "total_ms": round(self.elapsed() * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "db_queries": self.query_count,
+            "db_ms": round(self.query_time * 1000, 1),
+            **self.counters,
+        }
+
+
+def activate(timer: RequestTimer):
+    """Make `timer` the current request timer. Returns a token for `deactivate`."""
+    return _current_timer.set(timer)
+
+
+def deactivate(token):
+    _current_timer.reset(token)
+
+
+def current_timer():
+    return _current_timer.get()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block of code as stage `name` of the current request.
+    Does nothing when called outside of a request (e.g. from management commands).
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper that times the query against the current request, if any.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer.record_query(execute, sql, params, many, context)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    `connection_created` receiver that installs `record_query` on every new connection.
+    Connections are per thread, so this also covers queries that the async ORM runs
+    in worker threads, where a wrapper installed by the middleware would not apply.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def count(name: str, amount: int = 1):
+    """Increment counter `name` of the current request, if any."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.count(name, amount)
@@ -1,19 +1,22 @@
-import json
-import hashlib
-import pandas as pd
 import traceback
 
+import numpy as np
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
-from django.core.cache import cache
 from rest_framework import viewsets, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
 
-from .models import Feature, Nuclear, Molecular, DrugScreen, Correlation
-from .serializers import FeatureSerializer, NuclearSerializer, MolecularSerializer, DrugScreenSerializer
-from .utils import correlations
-from .utils.constants import CELL_LINES, CACHE_DURATION
+from . import archive, dataset, neighbors, planner, routers, store
+from .models import Feature, FeatureStats, Nuclear, Molecular, DrugScreen, Correlation, CATEGORY_MODELS
+from .serializers import FeatureSerializer, FeatureStatsSerializer, NuclearSerializer, MolecularSerializer, DrugScreenSerializer
+from .utils import admission, cancellation, correlations, invalidation, matrix, metrics, singleflight, streaming, timing
+from .utils.constants import CACHE_DURATION, CELL_LINES
+from .utils.params import (parse_correlation_request, correlation_cache_key, parse_cell_lines, matrix_cache_key,
+                           cell_similarity_cache_key)
 
 
 def index(request):
@@ -40,6 +43,14 @@ def corr(request):
     return render(request, 'database/corr.html', context)
 
 
+def metrics_view(request):
+    """
+    Expose this process's metrics in the Prometheus text format. Each gunicorn worker keeps
+    its own registry, so a scrape only sees the requests of the worker that serves it.
+    """
+    return HttpResponse(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4")
+
+
 class FeatureViewSet(viewsets.ModelViewSet):
     queryset = Feature.objects.all()
     serializer_class = FeatureSerializer
@@ -66,6 +77,31 @@ class FeatureViewSet(viewsets.ModelViewSet):
 
         return Response({'subcategories': list(subcategories)})
 
+    # Get summary statistics and histograms of a feature with /api/features/<name>/summary/
+    @action(detail=True, methods=['get'])
+    def summary(self, request, pk=None):
+        feature = self.get_object()
+        stats = FeatureStats.objects.filter(feature=feature).order_by("database")
+        return Response({
+            'feature': FeatureSerializer(feature).data,
+            'stats': FeatureStatsSerializer(stats, many=True).data,
+        })
+
+    # Get the precomputed nearest neighbours of a feature with /api/features/<name>/neighbors/?limit=10
+    @action(detail=True, methods=['get'])
+    def neighbors(self, request, pk=None):
+        try:
+            limit = int(request.query_params.get('limit', neighbors.NEIGHBORS_LIMIT))
+        except ValueError:
+            return Response({'error': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), neighbors.NEIGHBORS_K)
+
+        # Read straight from the neighbour table, without loading the feature first
+        rows = neighbors.feature_neighbors(pk, limit)
+        if rows is None:
+            return Response({'error': f"Feature '{pk}' not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'feature': pk, 'neighbors': rows})
+
     def list(self, request, *args, **kwargs):
         # Get database list and sub_category list from query parameters
         database_list = request.query_params.getlist('databaseList', [])
@@ -78,8 +114,6 @@ class FeatureViewSet(viewsets.ModelViewSet):
         if sub_category_list:
             self.queryset = self.queryset.filter(sub_category__in=sub_category_list)
 
-        print(self.queryset)
-
         return super().list(request, *args, **kwargs)
 
 
@@ -98,55 +132,74 @@ class DrugScreenViewSet(viewsets.ModelViewSet):
     serializer_class = DrugScreenSerializer
 
 
+@routers.read_only("scan")
 class CorrelationView(APIView):
     def post(self, request, *args, **kwargs):
+        # Queries of the same session (browser tab) supersede each other, see `utils.cancellation`
+        session = request.query_params.get("session")
         try:
-            # Extract input features from the request body
-            # f1, f2 refer to feature 1/2
-            f1_name = request.data.get("feature1")
-            f2_names = request.data.get("feature2")
-
-            # Extract database names for feature 1 and features 2
-            db1_names = request.data.get("database1")
-            db2_names = request.data.get("database2")
+            with cancellation.active(session):
+                # Extract input features and databases from the request body
+                try:
+                    params = parse_correlation_request(request.data)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+                # Prepare key for cache
+                cache_key = correlation_cache_key(params)
+                feature_names = [params["feature1"], *params["feature2"], *params["covariates"]]
+
+                # Retrieve correlation from cache if possible (unless the features changed since)
+                with timing.stage("cache"):
+                    cached_result = invalidation.get_result(cache_key, feature_names)
+                if cached_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="hit")
+                    return Response({"correlations": cached_result}, status=status.HTTP_200_OK)
+
+                # Identical requests in flight are computed once: wait for them and reuse their result
+                with singleflight.hold(cache_key):
+                    with timing.stage("cache"):
+                        cached_result = invalidation.get_result(cache_key, feature_names)
+                    if cached_result is not None:
+                        metrics.CACHE_REQUESTS.inc(cache="correlations", result="coalesced")
+                        return Response({"correlations": cached_result}, status=status.HTTP_200_OK)
+
+                    # Reload the result from the archive if it was computed before from the same data
+                    epoch = invalidation.current_epoch()
+                    with timing.stage("archive"):
+                        version = archive.data_version(params)
+                        archived_result = archive.load(cache_key, version)
+                    if archived_result is not None:
+                        metrics.CACHE_REQUESTS.inc(cache="correlations", result="archived")
+                        invalidation.set_result(cache_key, archived_result, epoch, timeout=CACHE_DURATION)
+                        return Response({"correlations": archived_result}, status=status.HTTP_200_OK)
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="miss")
+
+                    return self.compute(params, cache_key, epoch, version, archive.history_query(request.data, params))
+
+        except admission.Rejected as e:
+            return Response({"error": str(e)}, status=e.status_code, headers=e.headers)
+        except cancellation.Cancelled as e:
+            # Nobody reads this response: the client left or submitted another query
+            return Response({"error": str(e)}, status=cancellation.CANCELLED_STATUS)
+        except Exception as e:
+            print("Error:", traceback.format_exc())
+            return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Ensure input features are provided
-            if not f1_name:
-                return Response({"error": "Feature 1 is required."}, status=status.HTTP_400_BAD_REQUEST)
-            if not f2_names:
-                return Response({"error": "Feature 2 is required (can be a single feature or a list)."}, status=status.HTTP_400_BAD_REQUEST)
-
-            if not db1_names:
-                return Response({"error": "Database 1 is required (can be a single feature or a list)."}, status=status.HTTP_400_BAD_REQUEST)
-            if not db2_names:
-                return Response({"error": "Database 1 is required (can be a single feature or a list)."}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Convert f2_names to a list if necessary
-            if isinstance(f2_names, str):
-                f2_names = [f2_names]
-
-            # Convert db1 and 2 names to list if necessary
-            if isinstance(db1_names, str):
-                db1_names = [db1_names]
-
-            if isinstance(db2_names, str):
-                db2_names = [db2_names]
-
-            # Prepare key for cache
-            key_data = {
-                "f1": f1_name,
-                "f2": sorted(f2_names),
-                "db1": sorted(db1_names),
-                "db2": sorted(db2_names),
-            }
-            key_json = json.dumps(key_data, separators=(",", ":"), sort_keys=True)
-            cache_key = "corr:" + hashlib.md5(key_json.encode("utf-8")).hexdigest()
+    def compute(self, params: dict, cache_key: str, epoch: int, version, query: dict):
+        """
+        Compute the correlations of a parsed request, cache them under `cache_key` and archive them.
 
-            # Retrieve correlation from cache if possible
-            cached_result = cache.get(cache_key)
-            if cached_result is not None:
-                return Response({"correlations": cached_result}, status=status.HTTP_200_OK)
+        :param epoch: data epoch read before the computation (see `invalidation.set_result`)
+        :param version: data version of the request (see `archive.data_version`)
+        :param query: the request as listed in the history
+        """
+        f1_name = params["feature1"]
+        f2_names = params["feature2"]
+        db1_names = params["database1"]
+        db2_names = params["database2"]
 
+        with timing.stage("lookup"):
             # Fetch Feature objects for feature 1
             try:
                 f1_object = Feature.objects.get(name=f1_name)
@@ -154,31 +207,32 @@ class CorrelationView(APIView):
                 return Response({"error": f"Feature '{f1_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
 
             # Fetch Feature objects for features 2
-            f2_objects = Feature.objects.filter(name__in=f2_names)
-            if not f2_objects.exists():
-                return Response({"error": f"None of the provided features in Feature 2 were found: {f2_names}."}, status=status.HTTP_404_NOT_FOUND)
-
-            f1_data = {}
-            for db_name in db1_names:
-                if db_name == "Nuclear":
-                    f1_data["Nuclear"] = Nuclear.objects.filter(feature=f1_object)
-                elif db_name == "Molecular":
-                    f1_data["Molecular"] = Molecular.objects.filter(
-                        feature=f1_object).values_list()
-                elif db_name == "Drug Screen":
-                    f1_data["Drug Screen"] = DrugScreen.objects.filter(
-                        feature=f1_object).values_list()
+            f2_objects = list(Feature.objects.filter(name__in=f2_names))
+        if not f2_objects:
+            return Response({"error": f"None of the provided features in Feature 2 were found: {f2_names}."}, status=status.HTTP_404_NOT_FOUND)
 
+        # Values of the features to control for, for partial correlations
+        covariates = None
+        if params["covariates"]:
+            try:
+                covariates = planner.fetch_covariates(params["covariates"], params["cell_lines"])
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Expensive requests wait for a slot so they can't starve cheap ones
+        f2_read = [f for f in f2_objects if f.category in db2_names]
+        cost = admission.estimate_cost(
+            f1_object.data_type, [f.data_type for f in f2_read], len(params["cell_lines"] or CELL_LINES),
+            params["permutations"], params["bootstrap"])
+        with admission.admit(cost):
+            # The query may have been superseded while waiting for a slot
+            cancellation.check()
+
+            # Read each feature from its own table, skipping features that can't have any correlation
+            f1_data = planner.fetch_features([f1_object], db1_names, params["cell_lines"])
             f2_data = {}
-            for db_name in db2_names:
-                if db_name == "Nuclear":
-                    f2_data["Nuclear"] = Nuclear.objects.filter(feature__in=f2_objects)
-                elif db_name == "Molecular":
-                    f2_data["Molecular"] = Molecular.objects.filter(
-                        feature__in=f2_objects).values_list()
-                elif db_name == "Drug Screen":
-                    f2_data["Drug Screen"] = DrugScreen.objects.filter(
-                        feature__in=f2_objects).values_list()
+            if any(len(rows) for rows in f1_data.values()):
+                f2_data = planner.fetch_features(f2_objects, db2_names, params["cell_lines"])
 
             # Map each feature (in current query) to its sub_category
             feature_to_subcategory = {
@@ -192,10 +246,10 @@ class CorrelationView(APIView):
             }
             feature_to_datatype[f1_object.name] = f1_object.data_type
 
-            f1_df = correlations.get_feature_values(
-                f1_data, feature_to_subcategory, feature_to_datatype)
-            f2_df = correlations.get_feature_values(
-                f2_data, feature_to_subcategory, feature_to_datatype)
+            f1_df = correlations.build_feature_frame(
+                f1_data, feature_to_subcategory, feature_to_datatype, cell_lines=params["cell_lines"])
+            f2_df = correlations.build_feature_frame(
+                f2_data, feature_to_subcategory, feature_to_datatype, cell_lines=params["cell_lines"])
 
             # print("Feature 1 df:")
             # print(f1_df.head(5))
@@ -203,23 +257,213 @@ class CorrelationView(APIView):
             # print(f2_df.head(5))
 
             # Call the updated calculate_correlations function
-            results_df_dict = correlations.calculate_correlations(f1_df, f2_df)
+            with timing.stage("compute"):
+                results_df_dict = correlations.calculate_correlations(
+                    f1_df, f2_df, permutations=params["permutations"],
+                    seed=settings.RESAMPLING_SEED, time_budget=settings.PERMUTATION_TIME_BUDGET,
+                    bootstrap=params["bootstrap"], confidence=settings.BOOTSTRAP_CONFIDENCE,
+                    bootstrap_max_bytes=settings.BOOTSTRAP_MEMORY_CAP_MB * 2 ** 20, covariates=covariates)
 
             # Convert each DataFrame in the dict to a list of records
-            results_json = {
-                key: df.to_dict(orient="records")
-                for key, df in results_df_dict.items()
-            }
+            with timing.stage("serialize"):
+                results_json = {
+                    key: df.to_dict(orient="records")
+                    for key, df in results_df_dict.items()
+                }
+
+        # Save correlation results to cache, and to the archive for later recall
+        invalidation.set_result(cache_key, results_json, epoch, timeout=CACHE_DURATION)
+        with timing.stage("archive"):
+            archive.save(cache_key, version, query, results_json)
+        return Response({"correlations": results_json}, status=status.HTTP_200_OK)
+
+
+class CancelQueryView(APIView):
+    # Cancel the correlation query still running for a session with /api/correlations/cancel/?session=...
+    # Sent by the browser (navigator.sendBeacon) when the tab is closed
+    def post(self, request, *args, **kwargs):
+        session = request.query_params.get("session")
+        if not session:
+            return Response({"error": "The session parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        running = cancellation.cancel_session(session)
+        return Response({"cancelled": running}, status=status.HTTP_200_OK)
+
+
+@routers.read_only("scan")
+class CorrelationStreamView(APIView):
+    # Same request as /api/correlations/, answered as Server-Sent Events with /api/correlations/stream/?session=...
+    # "batch" events carry the progress ({"done", "total"} feature 2 rows) and the strongest hits so far ("top"),
+    # the final "result" event the full correlations; failures after the stream started are sent as "error" events
+    def post(self, request, *args, **kwargs):
+        try:
+            try:
+                params = parse_correlation_request(request.data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            cache_key = correlation_cache_key(params)
+            feature_names = [params["feature1"], *params["feature2"], *params["covariates"]]
+
+            # Cached results are sent at once
+            with timing.stage("cache"):
+                cached_result = invalidation.get_result(cache_key, feature_names)
+            if cached_result is not None:
+                metrics.CACHE_REQUESTS.inc(cache="correlations", result="hit")
+                return self.respond([streaming.sse("result", {"correlations": cached_result})])
+
+            with timing.stage("lookup"):
+                try:
+                    f1_object = Feature.objects.get(name=params["feature1"])
+                except Feature.DoesNotExist:
+                    return Response({"error": f"Feature '{params['feature1']}' not found."}, status=status.HTTP_404_NOT_FOUND)
+                f2_objects = list(Feature.objects.filter(name__in=params["feature2"]))
+            if not f2_objects:
+                return Response({"error": f"None of the provided features in Feature 2 were found: {params['feature2']}."}, status=status.HTTP_404_NOT_FOUND)
+
+            covariates = None
+            if params["covariates"]:
+                try:
+                    covariates = planner.fetch_covariates(params["covariates"], params["cell_lines"])
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            return self.respond(self.events(
+                params, cache_key, feature_names, f1_object, f2_objects, covariates,
+                request.query_params.get("session"), archive.history_query(request.data, params)))
+
+        except Exception as e:
+            print("Error:", traceback.format_exc())
+            return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @staticmethod
+    def respond(events):
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Don't let nginx buffer the events
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def events(self, params: dict, cache_key: str, feature_names: list, f1_object, f2_objects: list,
+               covariates, session, query: dict):
+        """
+        Events of a correlation request that wasn't cached: the batches of a `streaming.CorrelationStream`,
+        then its result, which is cached and archived as by /api/correlations/.
+        """
+        try:
+            # Queries of the same session (browser tab) supersede each other, see `utils.cancellation`
+            with cancellation.active(session), singleflight.hold(cache_key):
+                cached_result = invalidation.get_result(cache_key, feature_names)
+                if cached_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="coalesced")
+                    yield streaming.sse("result", {"correlations": cached_result})
+                    return
+
+                epoch = invalidation.current_epoch()
+                version = archive.data_version(params)
+                archived_result = archive.load(cache_key, version)
+                if archived_result is not None:
+                    metrics.CACHE_REQUESTS.inc(cache="correlations", result="archived")
+                    invalidation.set_result(cache_key, archived_result, epoch, timeout=CACHE_DURATION)
+                    yield streaming.sse("result", {"correlations": archived_result})
+                    return
+                metrics.CACHE_REQUESTS.inc(cache="correlations", result="miss")
+
+                f2_read = [f for f in f2_objects if f.category in params["database2"]]
+                cost = admission.estimate_cost(
+                    f1_object.data_type, [f.data_type for f in f2_read], len(params["cell_lines"] or CELL_LINES),
+                    params["permutations"], params["bootstrap"])
+                with admission.admit(cost):
+                    cancellation.check()
+
+                    f1_data = planner.fetch_features([f1_object], params["database1"], params["cell_lines"])
+                    f2_data = {}
+                    if any(len(rows) for rows in f1_data.values()):
+                        f2_data = planner.fetch_features(f2_objects, params["database2"], params["cell_lines"])
+
+                    feature_to_subcategory = {f.name: f.sub_category for f in [f1_object, *f2_objects]}
+                    feature_to_datatype = {f.name: f.data_type for f in [f1_object, *f2_objects]}
+                    stream = streaming.CorrelationStream(
+                        correlations.build_feature_frame(
+                            f1_data, feature_to_subcategory, feature_to_datatype, cell_lines=params["cell_lines"]),
+                        correlations.build_feature_frame(
+                            f2_data, feature_to_subcategory, feature_to_datatype, cell_lines=params["cell_lines"]),
+                        permutations=params["permutations"], seed=settings.RESAMPLING_SEED,
+                        time_budget=settings.PERMUTATION_TIME_BUDGET, bootstrap=params["bootstrap"],
+                        confidence=settings.BOOTSTRAP_CONFIDENCE,
+                        bootstrap_max_bytes=settings.BOOTSTRAP_MEMORY_CAP_MB * 2 ** 20, covariates=covariates)
+
+                    for start, stop in stream.chunks():
+                        yield streaming.sse("batch", stream.run_chunk(start, stop))
+                    results_json = stream.results()
+
+                # Not when the permutation budget ran out mid-stream, see `utils.streaming`
+                if stream.complete:
+                    invalidation.set_result(cache_key, results_json, epoch, timeout=CACHE_DURATION)
+                    archive.save(cache_key, version, query, results_json)
+                yield streaming.sse("result", {"correlations": results_json})
+
+        except admission.Rejected as e:
+            yield streaming.sse("error", {"error": str(e), "status": e.status_code, "retry_after": e.retry_after})
+        except cancellation.Cancelled as e:
+            yield streaming.sse("error", {"error": str(e), "status": cancellation.CANCELLED_STATUS})
+        except Exception as e:
+            print("Error:", traceback.format_exc())
+            yield streaming.sse("error", {"Error": str(e), "status": status.HTTP_500_INTERNAL_SERVER_ERROR})
+
+
+class QueryHistoryView(APIView):
+    # Get the most recent correlation queries with /api/history/?limit=20
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.query_params.get("limit", archive.HISTORY_LENGTH))
+        except ValueError:
+            return Response({"error": "limit must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), archive.HISTORY_MAX_LENGTH)
+        return Response({"history": archive.history(limit)}, status=status.HTTP_200_OK)
+
+
+@routers.read_only("scan")
+class ExportView(APIView):
+    # Download the values of a category with
+    # /api/export/?category=Molecular&sub_category=Gene%20Expression&features=A&cell_lines=ACH-000001&file_format=parquet
+    # (sub_category, features and cell_lines may be repeated, and are optional)
+    # Under ASGI the response is buffered until the whole file is built: use /api/async/export/ instead
+    def get(self, request, *args, **kwargs):
+        try:
+            category = request.query_params.get("category")
+            if category not in CATEGORY_MODELS:
+                return Response({"error": f"category must be one of {list(CATEGORY_MODELS)}."},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            file_format = request.query_params.get("file_format", "csv")
+            if file_format not in dataset.STREAM_FORMATS:
+                return Response({"error": f"file_format must be one of {list(dataset.STREAM_FORMATS)}."},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-            # Save correlation results to cache
-            cache.set(cache_key, results_json, timeout=CACHE_DURATION)
-            return Response({"correlations": results_json}, status=status.HTTP_200_OK)
+            try:
+                cell_lines = parse_cell_lines({"cell_lines": request.query_params.getlist("cell_lines")})
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            # The body is generated while it is sent, one chunk of rows at a time
+            response = StreamingHttpResponse(
+                dataset.stream_values(
+                    category,
+                    sub_categories=request.query_params.getlist("sub_category"),
+                    features=request.query_params.getlist("features"),
+                    cell_lines=cell_lines,
+                    file_format=file_format),
+                content_type="text/csv" if file_format == "csv" else "application/vnd.apache.parquet")
+            filename = category.lower().replace(" ", "_") + "." + file_format
+            response["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return response
 
         except Exception as e:
             print("Error:", traceback.format_exc())
             return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@routers.read_only("lookup")
 class ScatterView(APIView):
     def post(self, request, *args, **kwargs):
         try:
@@ -227,82 +471,44 @@ class ScatterView(APIView):
             f1_name = request.data.get("feature1")
             f2_name = request.data.get("feature2")
 
-            db1_name = request.data.get("database1")
-            db2_name = request.data.get("database2")
-
             # Ensure input features are provided
             if not f1_name:
                 return Response({"error": "Feature 1 is required."}, status=status.HTTP_400_BAD_REQUEST)
             if not f2_name:  # Check for single value
                 return Response({"error": "Feature 2 is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Fetch Feature objects
             try:
-                feature1 = Feature.objects.get(name=f1_name)
-                # Get data_type for feature1
-                f1_data_type = feature1.data_type  # This will be "num" or "cat"
-            except Feature.DoesNotExist:
-                return Response({"error": f"Feature '{f1_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
+                cell_lines = parse_cell_lines(request.data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-            try:
-                feature2 = Feature.objects.get(name=f2_name)
-                # Get data_type for feature2
-                f2_data_type = feature2.data_type  # This will be "num" or "cat"
-            except Feature.DoesNotExist:
-                return Response({"error": f"Feature '{f2_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
-
-            f1_data = None
-            f2_data = None
-
-            # Query CellLine table using the retrieved Features
-            if db1_name == "Nuclear":
-                f1_data = Nuclear.objects.filter(feature=feature1)
-            elif db1_name == "Molecular":
-                f1_data = Molecular.objects.filter(feature=feature1)
-            elif db1_name == "Drug Screen":
-                f1_data = DrugScreen.objects.filter(feature=feature1)
-
-            if db2_name == "Nuclear":
-                f2_data = Nuclear.objects.filter(feature=feature2)
-            elif db2_name == "Molecular":
-                f2_data = Molecular.objects.filter(feature=feature2)
-            elif db2_name == "Drug Screen":
-                f2_data = DrugScreen.objects.filter(feature=feature2)
-
-            if not f1_data or not f2_data:
-                # print(f1_data.values_list())
-                # print(f2_data)
+            # Fetch Feature objects
+            with timing.stage("lookup"):
+                try:
+                    feature1 = Feature.objects.get(name=f1_name)
+                    # Get data_type for feature1
+                    f1_data_type = feature1.data_type  # This will be "num" or "cat"
+                except Feature.DoesNotExist:
+                    return Response({"error": f"Feature '{f1_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
+
+                try:
+                    feature2 = Feature.objects.get(name=f2_name)
+                    # Get data_type for feature2
+                    f2_data_type = feature2.data_type  # This will be "num" or "cat"
+                except Feature.DoesNotExist:
+                    return Response({"error": f"Feature '{f2_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
+
+            # Each feature is read from the table of its category, whatever database1/database2 say
+            f1_df = store.fetch_values(feature1.category, [feature1.name], cell_lines) \
+                if feature1.category in CATEGORY_MODELS else None
+            f2_df = store.fetch_values(feature2.category, [feature2.name], cell_lines) \
+                if feature2.category in CATEGORY_MODELS else None
+
+            if f1_df is None or f1_df.empty or f2_df is None or f2_df.empty:
                 return Response({"error": "No cell line data found for the specified features."}, status=status.HTTP_404_NOT_FOUND)
 
-            # Convert CellLine data into dataframes
-            f1_queryset = f1_data.values_list()
-            f2_queryset = f2_data.values_list()
-            f1_df = pd.DataFrame(list(f1_queryset), columns=["Feature", *CELL_LINES])
-            f2_df = pd.DataFrame(list(f2_queryset), columns=["Feature", *CELL_LINES])
-
-            # Merge the two DataFrames by column
-            merged_df = pd.concat([f1_df, f2_df], axis=0)
-
-            # print("Merged DataFrame:")
-            # print(merged_df.head(5))
-
-            # Transpose the merged DataFrame
-            transposed_df = merged_df.T.reset_index()
-            transposed_df.columns = ["cell_lines"] + \
-                [f"{f1_name}", f"{f2_name}"]  # Rename columns
-
-            # Remove redundnant first row
-            transposed_df = transposed_df.iloc[1:].reset_index(drop=True)
-
-            # Drop columns with na values
-            transposed_df = transposed_df.dropna(axis=0)
-
-            # print("Transposed DataFrame:")
-            # print(transposed_df.head(5))
-
-            # Convert the transposed DataFrame to a JSON-compatible format
-            transposed_json = transposed_df.to_dict(orient="records")
-            print(transposed_json)
+            transposed_json = correlations.build_scatter_records(
+                f1_df, f2_df, f1_name, f2_name, cell_lines=cell_lines)
 
             # Include the data types in the response
             return Response({
@@ -314,3 +520,206 @@ class ScatterView(APIView):
         except Exception as e:
             print("Error:", traceback.format_exc())
             return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _resolve_matrix_features(data, side: str, categorical: bool = False):
+    """
+    Numerical features for one side of a matrix request, given either as a list of names
+    (`features<side>`), as whole sub_categories (`subcategories<side>`), or as whole
+    categories (`categories<side>`).
+
+    :param categorical: also include categorical features, by their stored level values
+    :returns: (features, skipped) where skipped lists requested categorical features
+    """
+    names = data.get(f"features{side}")
+    sub_categories = data.get(f"subcategories{side}")
+    categories = data.get(f"categories{side}")
+
+    if names:
+        if isinstance(names, str):
+            names = [names]
+        found = {f.name: f for f in Feature.objects.filter(name__in=names)}
+        features = [found[n] for n in dict.fromkeys(names) if n in found]
+    elif sub_categories:
+        if isinstance(sub_categories, str):
+            sub_categories = [sub_categories]
+        features = list(Feature.objects.filter(sub_category__in=sub_categories).order_by("category", "sub_category", "name"))
+    elif categories:
+        if isinstance(categories, str):
+            categories = [categories]
+        features = Feature.objects.filter(category__in=categories)
+        if not categorical:
+            # Categorical features are skipped without listing them all
+            features = features.filter(data_type="num")
+        features = list(features.order_by("category", "sub_category", "name"))
+    else:
+        raise ValueError(f"One of features{side}, subcategories{side} or categories{side} is required.")
+
+    if categorical:
+        if not features:
+            raise ValueError("No features found.")
+        return features, []
+
+    skipped = [f.name for f in features if f.data_type != "num"]
+    features = [f for f in features if f.data_type == "num"]
+    if not features:
+        raise ValueError(f"No numerical features found for side {side}." if side else "No numerical features found.")
+    return features, skipped
+
+
+@routers.read_only("scan")
+class CorrelationMatrixView(APIView):
+    """
+    Spearman correlations of every feature in one list against every feature in another,
+    for heatmaps. Only numerical features are included.
+
+    Body: features1/subcategories1, features2/subcategories2, cell_lines (optional subset,
+    see `parse_cell_lines`), cluster (bool, reorder rows and columns by hierarchical
+    clustering), format ("binary" (default) or "json").
+    The binary format is described in `utils.matrix.pack_matrices`.
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            with timing.stage("lookup"):
+                try:
+                    features1, skipped1 = _resolve_matrix_features(request.data, "1")
+                    features2, skipped2 = _resolve_matrix_features(request.data, "2")
+                    cell_lines = parse_cell_lines(request.data)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            cells = len(features1) * len(features2)
+            if cells > settings.MATRIX_MAX_CELLS:
+                return Response({"error": f"Matrix of {len(features1)} x {len(features2)} features is too large "
+                                          f"(limit is {settings.MATRIX_MAX_CELLS} pairs)."},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            # Matrices for the same features and cell line subset are cached, so switching
+            # between output formats or toggling clustering doesn't recompute them
+            cache_key = matrix_cache_key(
+                [f.name for f in features1], [f.name for f in features2], cell_lines)
+
+            feature_names = [f.name for f in features1 + features2]
+            with timing.stage("cache"):
+                cached = invalidation.get_result(cache_key, feature_names)
+            if cached is not None:
+                metrics.CACHE_REQUESTS.inc(cache="matrix", result="hit")
+                rho, pvalue, count = cached
+            else:
+                metrics.CACHE_REQUESTS.inc(cache="matrix", result="miss")
+                epoch = invalidation.current_epoch()
+
+                cost = admission.estimate_matrix_cost(
+                    len(features1), len(features2), len(cell_lines or CELL_LINES))
+                with admission.admit(cost):
+                    # Only the selected cell lines are read; the others are missing values,
+                    # so the kernels re-rank every pair over the selected cell lines only
+                    x = store.fetch_ranks(features1, cell_lines)
+                    y = store.fetch_ranks(features2, cell_lines)
+
+                    with timing.stage("compute"):
+                        rho, count = matrix.spearman_matrix(x, y)
+                        pvalue = matrix.spearman_pvalues(rho, count)
+                invalidation.set_result(cache_key, (rho, pvalue, count), epoch, timeout=CACHE_DURATION)
+
+            header = {
+                "features1": [f.name for f in features1],
+                "features2": [f.name for f in features2],
+                "subcategories1": [f.sub_category for f in features1],
+                "subcategories2": [f.sub_category for f in features2],
+                "skipped": skipped1 + skipped2,
+                "cell_lines": cell_lines,
+            }
+
+            if request.data.get("cluster"):
+                with timing.stage("cluster"):
+                    header["row_order"] = matrix.cluster_order(rho)
+                    header["col_order"] = matrix.cluster_order(rho.T)
+
+            with timing.stage("serialize"):
+                if request.data.get("format", "binary") == "json":
+                    def to_list(a):
+                        return np.where(np.isnan(a), None, a).tolist()
+                    return Response({**header, "rho": to_list(rho), "pvalue": to_list(pvalue),
+                                     "count": count.tolist()}, status=status.HTTP_200_OK)
+
+                payload = matrix.pack_matrices(header, {
+                    "rho": rho.astype(np.float32),
+                    "pvalue": pvalue.astype(np.float32),
+                    "count": count.astype(np.uint16),
+                })
+                return HttpResponse(payload, content_type="application/octet-stream")
+
+        except admission.Rejected as e:
+            return Response({"error": str(e)}, status=e.status_code, headers=e.headers)
+        except Exception as e:
+            print("Error:", traceback.format_exc())
+            return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@routers.read_only("scan")
+class CellLineSimilarityView(APIView):
+    """
+    Correlations of every cell line against every other cell line across a set of features
+    (the transpose of the usual feature-vs-feature analysis), e.g. which cell lines have the
+    most similar proteomics or copy number profiles. Categorical features are used by their
+    stored level values, which for copy number calls are ordered (-1 loss, 0 neutral, 1 gain).
+
+    Body: features/subcategories/categories, method ("spearman" (default) or "pearson"),
+    cell_lines (optional subset, see `parse_cell_lines`), cluster (bool, also return the
+    hierarchical clustering order of the cell lines).
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            with timing.stage("lookup"):
+                try:
+                    features, skipped = _resolve_matrix_features(request.data, "", categorical=True)
+                    cell_lines = parse_cell_lines(request.data) or CELL_LINES
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            method = request.data.get("method", "spearman")
+            if method not in matrix.COLUMN_METHODS:
+                return Response({"error": f"method must be one of {list(matrix.COLUMN_METHODS)}."},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            names = [f.name for f in features]
+            cache_key = cell_similarity_cache_key(names, method, cell_lines)
+            with timing.stage("cache"):
+                cached = invalidation.get_result(cache_key, names)
+            if cached is not None:
+                metrics.CACHE_REQUESTS.inc(cache="cellsim", result="hit")
+                rho, count = cached
+            else:
+                metrics.CACHE_REQUESTS.inc(cache="cellsim", result="miss")
+                epoch = invalidation.current_epoch()
+
+                cost = admission.estimate_matrix_cost(len(cell_lines), len(cell_lines), len(features))
+                with admission.admit(cost):
+                    values = store.fetch_matrix(features)
+                    with timing.stage("compute"):
+                        # Cell lines are the columns of the feature matrix
+                        columns = [CELL_LINES.index(c) for c in cell_lines]
+                        rho, count = matrix.column_correlations(values[:, columns], method)
+                invalidation.set_result(cache_key, (rho, count), epoch, timeout=CACHE_DURATION)
+
+            response = {
+                "cell_lines": cell_lines,
+                "method": method,
+                "features": len(features),
+                "skipped": skipped,
+                "rho": np.where(np.isnan(rho), None, rho).tolist(),
+                "count": count.tolist(),
+            }
+            if request.data.get("cluster"):
+                with timing.stage("cluster"):
+                    response["order"] = matrix.cluster_order(rho)
+            return Response(response, status=status.HTTP_200_OK)
+
+        except admission.Rejected as e:
+            return Response({"error": str(e)}, status=e.status_code, headers=e.headers)
+        except Exception as e:
+            print("Error:", traceback.format_exc())
+            return Response({"Error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,4 +1,3 @@
-import axios from 'axios';
 import { useEffect, useRef, useState } from 'react';
 import Header from './components/Header.jsx';
 import Modal from './components/Modal.jsx';
@@ -7,6 +6,7 @@ import ResultsContainer from './components/ResultsContainer.jsx';
 
 import './App.css';
 import './index.js';
+import { cancelQueries, getQueryHistory, streamCorrelations } from './services/featureService.js';
 import { MAX_QUERY_HISTORY_LENGTH } from './utils/constants.js';
 
 function App() {
@@ -18,9 +18,24 @@ function App() {
     const [isSidebarCollapsed, setSidebarCollapsed] = useState(false);
     const [isModalOpen, setIsModalOpen] = useState(false);
     const [isLoading, setIsLoading] = useState(false);
+    const [progress, setProgress] = useState(null);
 
     const abortControllerRef = useRef(null);
 
+    // Load the query history from the backend, which keeps the results of past queries
+    // so they can be replayed without recomputing them
+    useEffect(() => {
+        getQueryHistory(MAX_QUERY_HISTORY_LENGTH).then((history) => {
+            if (history.length > 0) setQueryHistory(history);
+        });
+    }, []);
+
+    // Stop the query still running on the backend when the tab is closed
+    useEffect(() => {
+        window.addEventListener('pagehide', cancelQueries);
+        return () => window.removeEventListener('pagehide', cancelQueries);
+    }, []);
+
     // Whenever queryHistory changes, save to localStorage
     useEffect(() => {
         localStorage.setItem('queryHistory', JSON.stringify(queryHistory));
@@ -45,6 +60,7 @@ function App() {
         const controller = new AbortController();
         abortControllerRef.current = controller;
         setIsLoading(true);
+        setProgress(null);
         scrollToTop();
 
         // Add this query to history, retaining the given max number
@@ -53,25 +69,22 @@ function App() {
             ...prev.slice(0, MAX_QUERY_HISTORY_LENGTH - 1),
         ]);
 
-        // Make API request
-        axios
-            .post(
-                `${process.env.REACT_APP_API_ROOT}correlations/`,
-                {
-                    feature1: query.feature1,
-                    feature2: query.feature2,
-                    database1: query.database1,
-                    database2: query.database2,
-                },
-                {
-                    signal: controller.signal,
-                }
-            )
-            .then((response) => {
-                setCorrelationsMap(response.data.correlations);
+        // Make API request. The form fields are sent along so the query can be restored from
+        // the backend history. The strongest hits are shown while the rest is computed
+        streamCorrelations(query, {
+            signal: controller.signal,
+            onBatch: (batch) => {
+                if (controller.signal.aborted) return;
+                setCorrelationsMap(batch.top);
+                setProgress({ done: batch.done, total: batch.total });
+            },
+        })
+            .then((correlations) => {
+                setCorrelationsMap(correlations);
             })
             .catch((err) => {
                 if (
+                    err.name === 'AbortError' ||
                     err.name === 'CanceledError' ||
                     err.message === 'canceled'
                 ) {
@@ -81,7 +94,9 @@ function App() {
                 }
             })
             .finally(() => {
+                if (abortControllerRef.current !== controller) return;
                 setIsLoading(false);
+                setProgress(null);
                 scrollToTop();
             });
     };
@@ -123,7 +138,11 @@ function App() {
                     lastQuery={queryHistory[0] ?? {}}
                     onRequery={handleRequery}
                     isLoading={isLoading}
-                    onCancel={() => abortControllerRef.current?.abort()}
+                    progress={progress}
+                    onCancel={() => {
+                        abortControllerRef.current?.abort();
+                        cancelQueries();
+                    }}
                 />
             </main>
 
@@ -1,10 +1,14 @@
 import React from 'react';
 
-export default function LoadingIcon({ onCancel }) {
+export default function LoadingIcon({ onCancel, progress }) {
     return (
         <div className="flex items-center justify-center mb-4 space-x-3">
             <div className="loader w-6 h-6"></div>
-            <span className="text-gray-600">Loading query results…</span>
+            <span className="text-gray-600">
+                {progress
+                    ? `Correlated ${progress.done} of ${progress.total} features, showing the strongest so far…`
+                    : 'Loading query results…'}
+            </span>
             <button
                 onClick={onCancel}
                 className="px-3 py-1 bg-red-600 text-white rounded hover:bg-red-700"
@@ -8,6 +8,7 @@ export default function ResultsContainer({
     correlationsMap,
     lastQuery,
     isLoading,
+    progress,
     onRequery,
     onCancel,
 }) {
@@ -71,7 +72,7 @@ export default function ResultsContainer({
             className="flex-1 flex-col overflow-y-auto px-4 py-2 custom-scrollbar"
         >
             {/* Loading icon */}
-            {isLoading && <LoadingIcon onCancel={onCancel} />}
+            {isLoading && <LoadingIcon onCancel={onCancel} progress={progress} />}
 
             {/* Graph (scatter/box/bar plot) */}
             <ScatterPlot
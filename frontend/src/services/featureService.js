@@ -1,5 +1,13 @@
 import axios from 'axios';
 
+/**
+ * Id of this tab's query session. The backend stops a correlation query of the session
+ * when the session submits another one, or when it is cancelled with `cancelQueries`
+ */
+export const QUERY_SESSION = window.crypto?.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
 /**
  * Get all categories/databases
  * @returns {Promise} Promise resolving to array of categories
@@ -73,4 +81,91 @@ export const getFeatures = async (databaseList, subCategoryList) => {
         console.error('Error fetching features:', error);
         return [];
     }
-}; 
\ No newline at end of file
+}; 
+
+/**
+ * Get the most recent correlation queries, as archived by the backend
+ * @param {number} limit - Max number of queries to return
+ * @returns {Promise} Promise resolving to array of queries, most recent first
+ */
+export const getQueryHistory = async (limit) => {
+    try {
+        const response = await axios.get(`${process.env.REACT_APP_API_ROOT}history/`, {
+            params: { limit },
+        });
+        return response.data.history;
+    } catch (error) {
+        console.error('Error fetching query history:', error);
+        return [];
+    }
+};
+
+/**
+ * Split a Server-Sent Events message into its event name and JSON data
+ * @param {string} message - Lines of one message, without the blank line ending it
+ * @returns {{event: string, data: Object}}
+ */
+const parseEvent = (message) => {
+    let event = 'message';
+    const data = [];
+    for (const line of message.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+    }
+    return { event, data: JSON.parse(data.join('\n') || 'null') };
+};
+
+/**
+ * Run a correlation query on the streaming endpoint, which sends the strongest hits while it runs.
+ * Uses the async endpoint, since the backend is served over ASGI (under `runserver`, the events
+ * all arrive at the end)
+ * @param {Object} query - Same body as for /correlations/
+ * @param {Object} options - `signal` to abort the request, and `onBatch` called with each
+ *     batch ({done, total, top}: progress in feature 2 rows, and strongest hits so far)
+ * @returns {Promise} Promise resolving to the full correlations map
+ */
+export const streamCorrelations = async (query, { signal, onBatch } = {}) => {
+    const response = await fetch(
+        `${process.env.REACT_APP_API_ROOT}async/correlations/stream/?session=${encodeURIComponent(QUERY_SESSION)}`,
+        {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(query),
+            signal,
+        }
+    );
+    if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.error ?? body.Error ?? `Request failed with status ${response.status}`);
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+
+        // Messages end with a blank line
+        let end;
+        while ((end = buffer.indexOf('\n\n')) >= 0) {
+            const { event, data } = parseEvent(buffer.slice(0, end));
+            buffer = buffer.slice(end + 2);
+            if (event === 'batch') onBatch?.(data);
+            else if (event === 'result') return data.correlations;
+            else if (event === 'error') throw new Error(data.error ?? data.Error);
+        }
+    }
+    throw new Error('The correlation stream ended without a result');
+};
+
+/**
+ * Stop the correlation query this tab is still running on the backend.
+ * Uses a beacon, so the request is still sent while the page is being closed
+ */
+export const cancelQueries = () => {
+    const url = `${process.env.REACT_APP_API_ROOT}correlations/cancel/?session=${encodeURIComponent(QUERY_SESSION)}`;
+    if (!navigator.sendBeacon?.(url)) {
+        axios.post(url).catch(() => {});
+    }
+};